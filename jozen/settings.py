@@ -62,6 +62,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so queries made by the other middleware are counted too.
+    'onnanoko.query_budget.QueryBudgetMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -158,6 +160,123 @@ STATICFILES_DIRS = [BASE_DIR / 'static']
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Perceptual-hash Hamming distance at which uploads are flagged as near-duplicates,
+# and how often (seconds) each process fully rebuilds its in-memory index.
+NEAR_DUPLICATE_DISTANCE = 10
+NEAR_DUPLICATE_INDEX_TTL = 3600
+
+# Background job queue (see the run_worker command): seconds before a job left
+# running by a dead worker is requeued, and the base delay between retries.
+JOB_LOCK_TIMEOUT = 600
+JOB_RETRY_DELAY = 30
+
+# Resumable chunked uploads (/api/images/uploads/): where partial files are
+# assembled, the largest upload and single chunk accepted, the chunk size
+# suggested to clients, and how long unfinished sessions are kept (seconds).
+CHUNKED_UPLOAD_TEMP_DIR = os.environ.get('CHUNKED_UPLOAD_TEMP_DIR', str(BASE_DIR / 'tmp' / 'uploads'))
+CHUNKED_UPLOAD_MAX_SIZE = 50 * 1024 * 1024
+CHUNKED_UPLOAD_MAX_CHUNK = 8 * 1024 * 1024
+CHUNKED_UPLOAD_CHUNK_SIZE = 2 * 1024 * 1024
+CHUNKED_UPLOAD_EXPIRY = 24 * 3600
+
+# Multi-file uploads are verified on a bounded per-process thread pool; images
+# over IMAGE_MAX_PIXELS are rejected before decoding (decompression bombs).
+UPLOAD_VALIDATION_WORKERS = int(os.environ.get('UPLOAD_VALIDATION_WORKERS', 4))
+IMAGE_MAX_PIXELS = 50_000_000
+
+# Full-text search: most hits ranked per query, and the largest number of
+# documents a single rename reindexes inline before deferring to the job queue.
+SEARCH_MAX_RESULTS = 1000
+SEARCH_SYNC_REINDEX_LIMIT = 200
+
+# Tag queries (?q=cute -swimsuit character:...) run against a per-process index
+# that is rebuilt when another process stamps a change in the 'pages' cache
+# (shared by the workers unless PAGE_CACHE_BACKEND is locmem) and at least
+# this often.
+TAG_QUERY_INDEX_TTL = 600
+
+# Cursor-paginated lists show the planner's row estimate (Postgres) instead of
+# an exact COUNT(*) once it exceeds this many rows.
+PAGINATION_EXACT_COUNT_LIMIT = 10000
+
+# Related images: neighbours stored per image, extra weight of a shared
+# character over a shared tag, newest images of a key considered as
+# candidates, and the largest change refreshed inline before the job queue.
+RELATED_IMAGES_LIMIT = 12
+RELATED_CHARACTER_WEIGHT = 2.0
+RELATED_MAX_POSTINGS = 250
+RELATED_SYNC_LIMIT = 50
+
+# Girls sharing a group shown on a character page; more than this links to
+# the full list instead.
+CHARACTER_OTHER_GIRLS_LIMIT = 12
+
+# Dashboard totals (see onnanoko/stats.py) move by deltas on every write and
+# are recounted by the job queue when older than this many seconds.
+STATS_RECONCILE_INTERVAL = 3600
+
+# Site settings are cached per process and reloaded when a save stamps a new
+# version in the 'pages' cache (shared by the workers unless
+# PAGE_CACHE_BACKEND is locmem) and at least this often.
+SITE_SETTINGS_TTL = 300
+
+# Anonymous GETs of the public pages are kept whole in the 'pages' cache for
+# PAGE_CACHE_TIMEOUT seconds (0 turns the page cache off) and purged by the
+# writes they depend on (onnanoko/page_cache.py). PAGE_CACHE_BACKEND picks the
+# store: 'file' (shared by the workers of one host, in the PAGE_CACHE_LOCATION
+# directory), 'redis' (PAGE_CACHE_LOCATION is a redis:// URL; needs the redis
+# package) or 'locmem' (per process, the DEBUG default). A purge only reaches
+# the store of the process that made it, so locmem is for a single process:
+# with several workers, or run_worker, the others serve stale pages. The
+# store also carries the version stamps of the site settings and tag index.
+PAGE_CACHE_TIMEOUT = int(os.environ.get('PAGE_CACHE_TIMEOUT', 300))
+PAGE_CACHE_BACKEND = os.environ.get('PAGE_CACHE_BACKEND', 'locmem' if DEBUG else 'file')
+PAGE_CACHE_BACKENDS = {
+    'locmem': ('django.core.cache.backends.locmem.LocMemCache', 'onnanoko-pages'),
+    'file': ('django.core.cache.backends.filebased.FileBasedCache', str(BASE_DIR / 'tmp' / 'page-cache')),
+    'redis': ('django.core.cache.backends.redis.RedisCache', 'redis://127.0.0.1:6379/1'),
+}
+PAGE_CACHE_ALIAS = 'pages'
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    PAGE_CACHE_ALIAS: {
+        'BACKEND': PAGE_CACHE_BACKENDS[PAGE_CACHE_BACKEND][0],
+        'LOCATION': os.environ.get('PAGE_CACHE_LOCATION', PAGE_CACHE_BACKENDS[PAGE_CACHE_BACKEND][1]),
+        'TIMEOUT': PAGE_CACHE_TIMEOUT,
+        # Culling only makes entries miss: version tokens that go are read as changed.
+        **({} if PAGE_CACHE_BACKEND == 'redis' else {'OPTIONS': {'MAX_ENTRIES': 10000}}),
+    },
+}
+
+# Rendered gallery and character cards are kept in the 'pages' cache for
+# CARD_CACHE_TIMEOUT seconds (0 renders them on every request), keyed by each
+# row's card_version; `manage.py warm_cards` fills them after a deploy.
+CARD_CACHE_TIMEOUT = int(os.environ.get('CARD_CACHE_TIMEOUT', 24 * 3600))
+
+# Pages and API reads carry ETag/Last-Modified validators (onnanoko/conditional.py)
+# and answer 304 when they still match. Set RELEASE per deploy (e.g. the git
+# revision) so pages whose templates changed are not revalidated. Logged-out
+# pages may be kept by shared caches for PUBLIC_CACHE_MAX_AGE seconds.
+RELEASE = os.environ.get('RELEASE', '')
+PUBLIC_CACHE_MAX_AGE = int(os.environ.get('PUBLIC_CACHE_MAX_AGE', 60))
+
+# API lists are rendered from values_list() rows (onnanoko/fast_read.py) with the
+# same output as the serializers; turn off to serialize model instances instead.
+API_FAST_READ = os.environ.get('API_FAST_READ', 'True').lower() == 'true'
+
+# Requests running more SQL statements than this are logged as warnings by
+# QueryBudgetMiddleware (logger "onnanoko.queries"), with the repeated ones.
+QUERY_COUNT_WARNING = 50
+
+# Hash uploads while they stream in so duplicates can be detected without re-reading them.
+FILE_UPLOAD_HANDLERS = [
+    'onnanoko.upload_handlers.HashingMemoryFileUploadHandler',
+    'onnanoko.upload_handlers.HashingTemporaryFileUploadHandler',
+]
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
@@ -168,6 +287,11 @@ REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticatedOrReadOnly',
     ],
+    'DEFAULT_PAGINATION_CLASS': 'onnanoko.pagination.CursorPagination',
+    'DEFAULT_RENDERER_CLASSES': [
+        'onnanoko.renderers.JSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
 }
 
 # Logging configuration for production
@@ -30,11 +30,17 @@ LOGGING = {
     },
 }
 
-# Use in-memory cache for testing
+# Use in-memory caches for testing
 CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
-    }
+    },
+    PAGE_CACHE_ALIAS: {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'onnanoko-pages',
+        'TIMEOUT': PAGE_CACHE_TIMEOUT,
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
 }
 
 # Disable debug mode
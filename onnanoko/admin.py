@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Series, Group, Tag, Character, Image, SiteSetting
+from .models import Series, Group, Tag, Character, Image, Job, SiteSetting
 
 @admin.register(Series)
 class SeriesAdmin(admin.ModelAdmin):
@@ -30,10 +30,16 @@ class CharacterAdmin(admin.ModelAdmin):
 @admin.register(Image)
 class ImageAdmin(admin.ModelAdmin):
     search_fields = ["uploader__username", "description", "illustrator"]
-    list_display = ("id", "uploader", "illustrator", "uploaded_at", "is_approved")
-    list_filter = ("is_approved", "uploaded_at", "tags")
+    list_display = ("id", "uploader", "illustrator", "uploaded_at", "is_approved", "status")
+    list_filter = ("is_approved", "status", "uploaded_at", "tags")
     filter_horizontal = ("characters", "tags")
 
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ("id", "kind", "status", "attempts", "run_after", "locked_by", "created_at")
+    list_filter = ("kind", "status")
+    readonly_fields = ("last_error",)
+
 @admin.register(SiteSetting)
 class SiteSettingAdmin(admin.ModelAdmin):
     list_display = ("allow_self_registration",)
@@ -1,12 +1,14 @@
 from django.urls import path
 from rest_framework.routers import DefaultRouter
-from .views import SeriesViewSet, GroupViewSet, TagViewSet, CharacterViewSet, ImageViewSet
+from .views import SeriesViewSet, GroupViewSet, TagViewSet, CharacterViewSet, ImageViewSet, UploadSessionViewSet
 
 router = DefaultRouter()
 router.register(r'series', SeriesViewSet)
 router.register(r'groups', GroupViewSet)
 router.register(r'tags', TagViewSet)
 router.register(r'characters', CharacterViewSet)
+# Before 'images' so that images/uploads/ is not taken for an image id.
+router.register(r'images/uploads', UploadSessionViewSet, basename='upload-session')
 router.register(r'images', ImageViewSet)
 
 urlpatterns = router.urls
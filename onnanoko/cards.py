@@ -0,0 +1,75 @@
+from django.conf import settings
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+
+from . import page_cache
+from .models import Character, Group, Image, Tag
+from .pagination import IMAGE_ORDERING
+from .prefetch import annotate_counts, prefetch_top
+
+KEY_PREFIX = 'onnanoko:card:'
+TEMPLATES = {
+    'character': 'onnanoko/character_card.html',
+    'image': 'onnanoko/image_card.html',
+}
+
+
+def character_cards():
+    """Characters with what their cards show: four tags, two groups and how many more of each there are."""
+    return annotate_counts(
+        Character.objects.select_related('series').prefetch_related(
+            prefetch_top('tags', Tag.objects.order_by('name'), 4, 'card_tags'),
+            prefetch_top('groups', Group.objects.order_by('name'), 2, 'card_groups'),
+        ),
+        tag_count='tags', group_count='groups',
+    )
+
+
+def image_cards():
+    """Images with what their cards show: two characters and how many more there are."""
+    return annotate_counts(
+        Image.objects.prefetch_related(prefetch_top('characters', Character.objects.order_by('name'), 2, 'card_characters')),
+        character_count='characters',
+    )
+
+
+def key(obj):
+    kind = obj._meta.model_name
+    # Counters move by F() updates that leave card_version alone.
+    counts = f'.{obj.image_count}' if kind == 'character' else ''
+    return f'{KEY_PREFIX}{kind}:{obj.pk}:{obj.card_version}{counts}'
+
+
+def attach(objects):
+    """Set ``card`` on each of ``objects`` to its rendered card; returns them as a list.
+
+    Cards of the whole page are read with one get_many; only the missing
+    ones are rendered, then stored with one set_many for
+    CARD_CACHE_TIMEOUT seconds (0 renders every card).
+    """
+    objects = list(objects)
+    timeout = getattr(settings, 'CARD_CACHE_TIMEOUT', 0)
+    keys = [key(obj) for obj in objects]
+    found = page_cache.pages().get_many(keys) if timeout and keys else {}
+    rendered = {}
+    for obj, card_key in zip(objects, keys):
+        html = found.get(card_key)
+        if html is None:
+            kind = obj._meta.model_name
+            html = rendered[card_key] = render_to_string(TEMPLATES[kind], {kind: obj})
+        obj.card = mark_safe(html)
+    if timeout and rendered:
+        page_cache.pages().set_many(rendered, timeout)
+    return objects
+
+
+def warm(pages, per_page):
+    """Render the cards of the first ``pages`` gallery pages; returns how many cards they hold."""
+    images = image_cards().filter(is_approved=True).order_by(*IMAGE_ORDERING)
+    total = 0
+    for page in range(pages):
+        batch = attach(images[page * per_page:(page + 1) * per_page])
+        total += len(batch)
+        if len(batch) < per_page:
+            break
+    return total
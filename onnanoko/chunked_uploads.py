@@ -0,0 +1,104 @@
+import hashlib
+import os
+import re
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+
+CONTENT_RANGE = re.compile(r'^bytes (\d+)-(\d+)/(\d+|\*)$')
+COPY_BUFFER = 64 * 1024
+
+
+class RangeError(ValueError):
+    pass
+
+
+def upload_dir():
+    path = settings.CHUNKED_UPLOAD_TEMP_DIR
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def part_path(session):
+    return os.path.join(upload_dir(), f'{session.pk}.part')
+
+
+def allocate(session):
+    """Create the sparse temp file that chunks are written into."""
+    with open(part_path(session), 'wb') as fh:
+        fh.truncate(session.size)
+
+
+def discard(session):
+    try:
+        os.remove(part_path(session))
+    except FileNotFoundError:
+        pass
+
+
+def parse_content_range(header, size):
+    """Return the inclusive-exclusive (start, end) byte range from a Content-Range header."""
+    match = CONTENT_RANGE.match(header or '')
+    if not match:
+        raise RangeError('Expected a "Content-Range: bytes <start>-<end>/<size>" header.')
+    start, last, total = match.groups()
+    start, end = int(start), int(last) + 1
+    if total != '*' and int(total) != size:
+        raise RangeError(f'Upload size is {size} bytes, not {total}.')
+    if start >= end or end > size:
+        raise RangeError(f'Range {start}-{last} is outside the {size}-byte upload.')
+    return start, end
+
+
+def write_range(session, start, end, stream):
+    """Stream ``end - start`` bytes from ``stream`` into the temp file at ``start``.
+
+    The body is copied in small pieces, so a chunk is never held in memory
+    whole. Returns the SHA-256 of the bytes written.
+    """
+    hasher = hashlib.sha256()
+    remaining = end - start
+    with open(part_path(session), 'r+b') as fh:
+        fh.seek(start)
+        while remaining:
+            data = stream.read(min(COPY_BUFFER, remaining))
+            if not data:
+                raise RangeError(f'Body ended {remaining} bytes short of the declared range.')
+            fh.write(data)
+            hasher.update(data)
+            remaining -= len(data)
+    return hasher.hexdigest()
+
+
+def merge_range(ranges, start, end):
+    """Add [start, end) to a sorted list of disjoint [start, end) ranges."""
+    merged = []
+    for lo, hi in sorted([*ranges, [start, end]]):
+        if merged and lo <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], hi)
+        else:
+            merged.append([lo, hi])
+    return merged
+
+
+def is_complete(ranges, size):
+    return ranges == [[0, size]]
+
+
+def sha256_part(session):
+    hasher = hashlib.sha256()
+    with open(part_path(session), 'rb') as fh:
+        for chunk in iter(lambda: fh.read(1024 * 1024), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class AssembledUpload(UploadedFile):
+    """A finished part file handed to the normal Image creation path.
+
+    Like TemporaryUploadedFile it exposes its path, so Pillow validation reads
+    it from disk and file system storage moves it into place instead of copying.
+    """
+
+    def temporary_file_path(self):
+        return self.file.name
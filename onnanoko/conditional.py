@@ -0,0 +1,101 @@
+import hashlib
+
+from django.conf import settings
+from django.db.models import Subquery
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+
+from .models import Character, Group, Image, Series, Statistic, Tag
+from .site_settings import site_settings
+
+# model -> the totals (stats.py) that move when one of its rows is created or deleted.
+TOTALS = {
+    Image: ('images', 'pending_images'),
+    Character: ('characters',),
+    Series: ('series',),
+    Group: ('groups',),
+    Tag: ('tags',),
+}
+
+
+def _latest(model):
+    # Leans on the updated_at index: one row read per table.
+    return Subquery(model.objects.order_by('-updated_at').values('updated_at')[:1])
+
+
+def validators(models, request, variant=''):
+    """(ETag, Last-Modified) of a response showing rows of ``models``, read in one query.
+
+    Collection-level: the newest updated_at of each table, which saves, link
+    changes and renames move (see models.touch), plus the totals of
+    stats.py, which creations and deletions move. Any change to a table
+    changes every validator that names it; stale validators never match.
+    ETags also depend on who asks, so per-user pages never share one, and
+    on ``variant`` (the API format, the site settings of a page). Returns
+    (None, None) until the totals exist.
+    """
+    names = [name for model in models for name in TOTALS[model]]
+    latest = {model._meta.model_name: _latest(model) for model in models}
+    rows = list(
+        Statistic.objects.filter(name__in=names).annotate(**latest)
+        .order_by('name').values_list('name', 'value', 'changed_at', *latest)
+    )
+    if len(rows) < len(names):
+        return None, None
+    user = request.user
+    key = [settings.RELEASE, variant, user.pk, user.is_staff, rows]
+    times = [changed_at for _, _, changed_at, *_ in rows] + [value for value in rows[0][3:] if value is not None]
+    etag = quote_etag(hashlib.md5(repr(key).encode(), usedforsecurity=False).hexdigest())
+    return f'W/{etag}', max(times)
+
+
+def cache_control(request, response):
+    """Public pages may be kept by shared caches for PUBLIC_CACHE_MAX_AGE seconds; per-user ones only by the browser, revalidated."""
+    if request.user.is_authenticated:
+        patch_cache_control(response, private=True, no_cache=True)
+    else:
+        patch_cache_control(response, public=True, max_age=settings.PUBLIC_CACHE_MAX_AGE)
+    patch_vary_headers(response, ['Cookie', 'Authorization'])
+    return response
+
+
+def respond(request, models, render, variant=''):
+    """304 if the client's validators still match, else ``render()``; either way with validators and Cache-Control."""
+    etag, last_modified = validators(models, request, variant)
+    response = None
+    if etag is not None:
+        response = get_conditional_response(request, etag=etag, last_modified=int(last_modified.timestamp()))
+    if response is None:
+        response = render()
+    if response.status_code in (200, 304):
+        if etag is not None:
+            response.headers.setdefault('ETag', etag)
+            response.headers.setdefault('Last-Modified', http_date(last_modified.timestamp()))
+        cache_control(request, response)
+    return response
+
+
+class ConditionalPageMixin:
+    """Answer GETs of a page showing ``conditional_models`` with 304 when nothing they hold changed."""
+
+    conditional_models = ()
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return super().dispatch(request, *args, **kwargs)
+        # The base template shows the site settings.
+        site = site_settings.get()
+        variant = [getattr(site, field.attname) for field in site._meta.concrete_fields]
+        return respond(request, self.conditional_models, lambda: super(ConditionalPageMixin, self).dispatch(request, *args, **kwargs), variant)
+
+
+class ConditionalViewSetMixin:
+    """list() and retrieve() answer 304 before any serializing when nothing ``conditional_models`` hold changed."""
+
+    conditional_models = ()
+
+    def list(self, request, *args, **kwargs):
+        return respond(request, self.conditional_models, lambda: super(ConditionalViewSetMixin, self).list(request, *args, **kwargs), request.accepted_renderer.format)
+
+    def retrieve(self, request, *args, **kwargs):
+        return respond(request, self.conditional_models, lambda: super(ConditionalViewSetMixin, self).retrieve(request, *args, **kwargs), request.accepted_renderer.format)
@@ -1,7 +1,9 @@
-from .models import SiteSetting
+from django.utils.functional import SimpleLazyObject
+
+from .site_settings import site_settings as cached_settings
 
 def site_settings(request):
-    s = SiteSetting.get_solo()
+    # Lazy: pages that never read site_settings do not even check the cache.
     return {
-        'site_settings': s,
+        'site_settings': SimpleLazyObject(cached_settings.get),
     }
@@ -0,0 +1,160 @@
+from collections import defaultdict
+
+from django.db.models import Count, F, IntegerField, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+
+from . import stats
+from .models import Character, Group, Image, Series, Tag, User, UserStats
+
+COUNTED = (Tag, Character, Series, Group, UserStats)
+
+
+def _count(rows, column, counted):
+    counts = rows.filter(**{column: OuterRef('pk')}).order_by().values(column).annotate(n=Count(counted, distinct=True)).values('n')
+    return Coalesce(Subquery(counts, output_field=IntegerField()), 0)
+
+
+def expressions(model):
+    """{counter field: correlated COUNT} computing the true value of each of ``model``'s counters."""
+    if model is UserStats:
+        rows, column, counted, approval = Image.objects.all(), 'uploader_id', 'pk', 'is_approved'
+    else:
+        through = Image.tags.through if model is Tag else Image.characters.through
+        column = {Tag: 'tag_id', Character: 'character_id', Series: 'character__series', Group: 'character__groups'}[model]
+        rows, counted, approval = through.objects.all(), 'image_id', 'image__is_approved'
+    counters = {
+        'image_count': _count(rows.filter(**{approval: True}), column, counted),
+        'pending_image_count': _count(rows.filter(**{approval: False}), column, counted),
+    }
+    if model is Series:
+        counters['character_count'] = _count(Character.objects.all(), 'series', 'pk')
+    elif model is Group:
+        counters['character_count'] = _count(Character.groups.through.objects.all(), 'group_id', 'character_id')
+    return counters
+
+
+def recount(model, ids=None):
+    """Set the counters of ``model`` rows (all of them if ``ids`` is None) to their true values."""
+    rows = model.objects.all()
+    if ids is not None:
+        ids = set(ids) - {None}
+        if not ids:
+            return 0
+        rows = rows.filter(pk__in=ids)
+    return rows.update(**expressions(model))
+
+
+def drifted(model):
+    """Pks of ``model`` rows whose stored counters differ from their true values."""
+    counters = expressions(model)
+    differs = Q()
+    for field in counters:
+        differs |= ~Q(**{field: F(f'true_{field}')})
+    rows = model.objects.annotate(**{f'true_{field}': expression for field, expression in counters.items()})
+    return list(rows.filter(differs).values_list('pk', flat=True))
+
+
+def reconcile(dry_run=False):
+    """Recount every drifted row; returns {model: number of drifted rows}."""
+    missing = User.objects.filter(stats__isnull=True).values_list('pk', flat=True)
+    if not dry_run:
+        UserStats.objects.bulk_create([UserStats(user_id=pk) for pk in missing], ignore_conflicts=True)
+    report = {}
+    for model in COUNTED:
+        ids = drifted(model)
+        if not dry_run:
+            recount(model, ids)
+        report[model] = len(ids)
+    return report
+
+
+def recount_collections(character_ids=(), series_ids=(), group_ids=()):
+    """Recount the series and groups of ``character_ids`` plus the given ones.
+
+    One image reaches a series or group through any number of its
+    characters, so a link change cannot be turned into a +1/-1 without
+    knowing the others; a targeted recount is exact and still one UPDATE.
+    """
+    series_ids, group_ids = set(series_ids), set(group_ids)
+    if character_ids:
+        for series_id, group_id in Character.objects.filter(pk__in=character_ids).values_list('series_id', 'groups'):
+            series_ids.add(series_id)
+            group_ids.add(group_id)
+    recount(Series, series_ids)
+    recount(Group, group_ids)
+
+
+def links(image_ids):
+    """(model, related pk, image id) for every tag and character of ``image_ids``."""
+    found = []
+    for model, through, column in ((Tag, Image.tags.through, 'tag_id'), (Character, Image.characters.through, 'character_id')):
+        found.extend((model, pk, image_id) for image_id, pk in through.objects.filter(image_id__in=image_ids).values_list('image_id', column))
+    return found
+
+
+class Deltas:
+    """Counter changes gathered in memory, then written as one UPDATE per model and distinct change.
+
+    Counters move by F() expressions, so concurrent writers never lose an
+    update, and they share the caller's transaction.
+    """
+
+    def __init__(self):
+        self.changes = defaultdict(lambda: defaultdict(lambda: [0, 0]))
+        self.characters = set()
+
+    def add(self, model, pk, approved, sign):
+        self.changes[model][pk][0 if approved else 1] += sign
+        if model is Character:
+            self.characters.add(pk)
+        return self
+
+    def images(self, states, sign, found=None):
+        """Count (sign=1) or uncount (sign=-1) whole images given as {pk: (approved, uploader id)}."""
+        for model, pk, image_id in links(list(states)) if found is None else found:
+            self.add(model, pk, states[image_id][0], sign)
+        for approved, uploader_id in states.values():
+            self.add(UserStats, uploader_id, approved, sign)
+        return self
+
+    def apply(self):
+        """Write the changes; returns the characters touched, whose collections need a recount.
+
+        Every image is counted once per uploader, so the UserStats changes
+        also move the site-wide image totals.
+        """
+        uploads = self.changes.get(UserStats, {}).values()
+        stats.adjust(images=sum(approved for approved, _ in uploads), pending_images=sum(pending for _, pending in uploads))
+        for model, changes in self.changes.items():
+            grouped = defaultdict(list)
+            for pk, (approved, pending) in changes.items():
+                if approved or pending:
+                    grouped[approved, pending].append(pk)
+            for (approved, pending), ids in grouped.items():
+                model.objects.filter(pk__in=ids).update(
+                    image_count=F('image_count') + approved,
+                    pending_image_count=F('pending_image_count') + pending,
+                )
+        self.changes.clear()
+        return self.characters
+
+
+def states(images):
+    return {image.pk: (image.is_approved, image.uploader_id) for image in images}
+
+
+def added(images):
+    """New images were inserted without signals (Image.create_uploads)."""
+    recount_collections(Deltas().images(states(images), 1).apply())
+
+
+def moved(before, after):
+    """Images changed approval or uploader: {pk: (approved, uploader id)} before and after."""
+    found = links(list(after))
+    recount_collections(Deltas().images(before, -1, found).images(after, 1, found).apply())
+
+
+def approved(image_ids):
+    """Pending images were approved with a queryset update()."""
+    after = {pk: (True, uploader_id) for pk, uploader_id in Image.objects.filter(pk__in=image_ids).values_list('pk', 'uploader_id')}
+    moved({pk: (False, uploader_id) for pk, (_, uploader_id) in after.items()}, after)
@@ -0,0 +1,234 @@
+from collections import defaultdict
+from functools import partial
+
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist
+from django.core.files.storage import FileSystemStorage
+from django.db.models import QuerySet
+from django.utils.encoding import filepath_to_uri
+from rest_framework import fields as drf_fields
+from rest_framework.relations import ManyRelatedField, PrimaryKeyRelatedField
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.serializers import ListSerializer, Serializer
+
+
+class Unsupported(Exception):
+    """A serializer shape the read path cannot render exactly; the view falls back to DRF."""
+
+
+class Urls:
+    """``request.build_absolute_uri(storage.url(name))`` with the per-call work hoisted.
+
+    A FileSystemStorage URL is its base URL followed by the quoted name, so
+    the base is made absolute once per storage. Other storages, and names
+    urljoin() would rewrite (``.`` and ``..`` segments), take the long way.
+    """
+
+    def __init__(self, request):
+        self.request = request
+        self.prefixes = {}
+
+    def _prefix(self, storage):
+        if storage not in self.prefixes:
+            base = storage.base_url if isinstance(storage, FileSystemStorage) else None
+            simple = (
+                base is not None and base.endswith('/') and '/.' not in base
+                and (base.startswith(('http://', 'https://')) or (base.startswith('/') and not base.startswith('//')))
+            )
+            self.prefixes[storage] = self.request.build_absolute_uri(base) if simple else None
+        return self.prefixes[storage]
+
+    def url(self, storage, name):
+        prefix = self._prefix(storage)
+        if prefix is not None:
+            path = filepath_to_uri(name).lstrip('/')
+            segments = path.split('/')
+            if '.' not in segments and '..' not in segments:
+                return prefix + path
+        return self.request.build_absolute_uri(storage.url(name))
+
+
+class ManyToMany:
+    """Targets of one many-to-many relation per owner, read from its through table in one query."""
+
+    def __init__(self, model, name, plan=None):
+        field = model._meta.get_field(name)
+        self.through = field.remote_field.through
+        self.owner = self.through._meta.get_field(field.m2m_field_name()).attname
+        self.target = self.through._meta.get_field(field.m2m_reverse_field_name()).attname
+        self.plan = plan
+        self.ids, self.rendered = {}, {}
+
+    def load(self, ids, rows):
+        # Ordered like the prefetches of FieldSetSerializerMixin.shape_queryset.
+        links = self.through.objects.filter(**{f'{self.owner}__in': ids}).order_by(self.target).values_list(self.owner, self.target)
+        self.ids = defaultdict(list)
+        for owner, target in links:
+            self.ids[owner].append(target)
+        if self.plan is not None:
+            self.rendered = self.plan.by_pk({target for targets in self.ids.values() for target in targets})
+
+    def keys(self, row):
+        return self.ids.get(row[0], [])
+
+    def objects(self, row):
+        return [self.rendered[target] for target in self.ids.get(row[0], [])]
+
+
+class ForeignKey:
+    """An expanded foreign key: the related rows of a whole page rendered at once."""
+
+    def __init__(self, index, plan):
+        self.index = index
+        self.plan = plan
+        self.rendered = {}
+
+    def load(self, ids, rows):
+        self.rendered = self.plan.by_pk({row[self.index] for row in rows} - {None})
+
+    def object(self, row):
+        pk = row[self.index]
+        return None if pk is None else self.rendered[pk]
+
+
+def _value(index, row):
+    return row[index]
+
+
+def _represent(index, to_representation, row):
+    value = row[index]
+    return None if value is None else to_representation(value)
+
+
+def _file(index, storage, urls, row):
+    name = row[index]
+    return urls.url(storage, name) if name else None
+
+
+def _hook(indexes, hook, urls, row):
+    return hook(urls, *[row[index] for index in indexes])
+
+
+# Serializer fields whose to_representation() returns a database value unchanged.
+IDENTITY = (drf_fields.CharField, drf_fields.IntegerField, drf_fields.BooleanField, drf_fields.ReadOnlyField)
+
+
+class Plan:
+    """How a bound serializer renders a row of ``values_list(*plan.columns)``.
+
+    Built once per request from the serializer's fields, so no field tree is
+    made per object. Method and string-related fields need a
+    ``row_<name>(urls, *columns)`` on the serializer, reading the columns in
+    its ``row_columns[name]``; a field the plan cannot render exactly raises
+    Unsupported.
+    """
+
+    def __init__(self, serializer, urls):
+        self.model = serializer.Meta.model
+        self.urls = urls
+        self.columns = ['pk']
+        self.steps = []
+        self.relations = []
+        for field in serializer._readable_fields:
+            self.steps.append((field.field_name, self._step(serializer, field)))
+
+    def column(self, name):
+        if name not in self.columns:
+            self.columns.append(name)
+        return self.columns.index(name)
+
+    def _model_field(self, source):
+        try:
+            return self.model._meta.get_field(source)
+        except FieldDoesNotExist:
+            raise Unsupported(f'{self.model.__name__}.{source}')
+
+    def _step(self, serializer, field):
+        name, source = field.field_name, field.source
+        hook = getattr(serializer, f'row_{name}', None)
+        if hook is not None:
+            indexes = [self.column(column) for column in serializer.row_columns[name]]
+            return partial(_hook, indexes, hook, self.urls)
+        if '.' in source or source == '*':
+            raise Unsupported(f'{self.model.__name__}.{name}')
+        if isinstance(field, ListSerializer):
+            relation = ManyToMany(self.model, source, Plan(field.child, self.urls))
+            self.relations.append(relation)
+            return relation.objects
+        if isinstance(field, ManyRelatedField):
+            if type(field.child_relation) is not PrimaryKeyRelatedField or field.child_relation.pk_field is not None:
+                raise Unsupported(f'{self.model.__name__}.{name}')
+            relation = ManyToMany(self.model, source)
+            self.relations.append(relation)
+            return relation.keys
+        model_field = self._model_field(source)
+        if isinstance(field, Serializer):
+            relation = ForeignKey(self.column(model_field.attname), Plan(field, self.urls))
+            self.relations.append(relation)
+            return relation.object
+        if isinstance(field, PrimaryKeyRelatedField):
+            if type(field) is not PrimaryKeyRelatedField or field.pk_field is not None or not model_field.many_to_one:
+                raise Unsupported(f'{self.model.__name__}.{name}')
+            return partial(_value, self.column(model_field.attname))
+        if model_field.is_relation:
+            raise Unsupported(f'{self.model.__name__}.{name}')
+        if isinstance(field, drf_fields.FileField):
+            if not getattr(field, 'use_url', api_settings.UPLOADED_FILES_USE_URL):
+                raise Unsupported(f'{self.model.__name__}.{name}')
+            return partial(_file, self.column(source), model_field.storage, self.urls)
+        if type(field).to_representation in {cls.to_representation for cls in IDENTITY}:
+            return partial(_value, self.column(source))
+        return partial(_represent, self.column(source), field.to_representation)
+
+    def render(self, rows):
+        """``rows`` (tuples of ``self.columns``) as the serializer would render them."""
+        ids = [row[0] for row in rows]
+        if ids:
+            for relation in self.relations:
+                relation.load(ids, rows)
+        steps = self.steps
+        return [{name: step(row) for name, step in steps} for row in rows]
+
+    def by_pk(self, pks):
+        """{pk: rendered row} of ``pks``, read with one query."""
+        if not pks:
+            return {}
+        rows = list(self.model.objects.filter(pk__in=pks).values_list(*self.columns))
+        return {row[0]: data for row, data in zip(rows, self.render(rows))}
+
+
+class FastListMixin:
+    """list() from values_list() rows through a Plan instead of model instances and a field tree per object.
+
+    The output is identical to the serializer's, which stays in charge of
+    everything else (retrieve, writes), of shapes the plan cannot render and
+    of all lists when API_FAST_READ is off.
+    Responses are marked ``plain_json``: they hold no floats and no types
+    JSON lacks, so onnanoko.renderers.JSONRenderer may encode them with orjson.
+    """
+
+    def list(self, request, *args, **kwargs):
+        if not getattr(settings, 'API_FAST_READ', True):
+            return super().list(request, *args, **kwargs)
+        try:
+            plan = Plan(self.get_serializer(), Urls(request))
+        except Unsupported:
+            return super().list(request, *args, **kwargs)
+        queryset = self.filter_queryset(self.get_queryset())
+        columns = list(plan.columns)
+        paginator = self.paginator
+        if isinstance(queryset, QuerySet):
+            queryset = queryset.prefetch_related(None)
+            if hasattr(paginator, 'get_ordering'):
+                # CursorPaginator reads the ordering columns of each row by name.
+                columns += [name.lstrip('-') for name in paginator.get_ordering(queryset, self) if name.lstrip('-') not in columns]
+        # Ranked search results (search.SearchResults) take values_list() too.
+        rows = queryset.values_list(*columns, named=True)
+        page = self.paginate_queryset(rows)
+        if page is None:
+            response = Response(plan.render(list(rows)))
+        else:
+            response = self.get_paginated_response(plan.render(page))
+        response.plain_json = True
+        return response
@@ -0,0 +1,136 @@
+from functools import cached_property
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Prefetch
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.relations import ManyRelatedField
+
+
+def _tree(paths):
+    """``['characters.series', 'tags']`` -> ``{'characters': {'series': {}}, 'tags': {}}``."""
+    tree = {}
+    for path in paths:
+        node = tree
+        for part in path.split('.'):
+            node = node.setdefault(part, {})
+    return tree
+
+
+def _param(request, name):
+    return [part.strip() for value in request.query_params.getlist(name) for part in value.split(',') if part.strip()]
+
+
+class FieldSet:
+    """The shape of an API representation: ``?fields=``, ``?omit=`` and ``?expand=``.
+
+    Each is a comma-separated list of field names; dotted names reach into
+    expanded relations (``?expand=characters.series&omit=characters.description``).
+    Expandable relations are primary keys unless expanded. Unknown names are
+    ignored.
+    """
+
+    def __init__(self, fields=None, omit=None, expand=None):
+        self.fields = fields
+        self.omit = omit or {}
+        self.expand = expand or {}
+
+    @classmethod
+    def from_request(cls, request):
+        fields = _param(request, 'fields')
+        return cls(_tree(fields) if fields else None, _tree(_param(request, 'omit')), _tree(_param(request, 'expand')))
+
+    def includes(self, name):
+        if self.fields is not None and name not in self.fields:
+            return False
+        # Only a leaf is omitted: omit=characters.description keeps the characters.
+        return self.omit.get(name) != {}
+
+    def expands(self, name):
+        return name in self.expand
+
+    def child(self, name):
+        """The shape of the expanded relation ``name``."""
+        fields = self.fields.get(name) if self.fields is not None else None
+        return FieldSet(fields or None, self.omit.get(name), self.expand.get(name))
+
+
+class FieldSetSerializerMixin:
+    """A ModelSerializer rendering the shape a FieldSet asks for.
+
+    Relations listed in ``expandable`` ({field: serializer class}) are
+    declared as read-only primary key fields and replaced by that serializer
+    when expanded. Write-only fields are never dropped.
+    """
+
+    expandable = {}
+
+    def __init__(self, *args, fieldset=None, **kwargs):
+        self.fieldset = fieldset or FieldSet()
+        super().__init__(*args, **kwargs)
+
+    def get_fields(self):
+        fields = super().get_fields()
+        for name, field in list(fields.items()):
+            if field.write_only:
+                continue
+            if not self.fieldset.includes(name):
+                del fields[name]
+            elif name in self.expandable and self.fieldset.expands(name):
+                fields[name] = self.expandable[name](
+                    many=isinstance(field, ManyRelatedField), read_only=True, fieldset=self.fieldset.child(name),
+                )
+        return fields
+
+    @classmethod
+    def shape_queryset(cls, queryset, fieldset):
+        """``queryset`` loading the relations ``fieldset`` shows, and no others.
+
+        Expanded relations are prefetched shaped by their own serializer;
+        unexpanded many-to-many ones as bare keys; foreign keys rendered as
+        keys need no query at all. Related rows come in primary key order.
+        """
+        model = queryset.model
+        select, prefetch = [], []
+        for name in cls.Meta.fields:
+            if not fieldset.includes(name):
+                continue
+            try:
+                field = model._meta.get_field(name)
+            except FieldDoesNotExist:
+                continue
+            # get_field() also answers to attnames, e.g. the write-only series_id.
+            if not field.is_relation or field.name != name:
+                continue
+            if name in cls.expandable and fieldset.expands(name):
+                related = cls.expandable[name].shape_queryset(field.related_model.objects.order_by('pk'), fieldset.child(name))
+                prefetch.append(Prefetch(name, queryset=related))
+            elif field.many_to_many:
+                prefetch.append(Prefetch(name, queryset=field.related_model.objects.only('pk').order_by('pk')))
+            elif name not in cls.expandable:
+                select.append(name)
+        if select:
+            queryset = queryset.select_related(*select)
+        if prefetch:
+            queryset = queryset.prefetch_related(*prefetch)
+        return queryset
+
+
+class FieldSetMixin:
+    """API views whose reads honour ``?fields=``, ``?omit=`` and ``?expand=``.
+
+    The queryset is shaped to match (see FieldSetSerializerMixin.shape_queryset).
+    Writes answer with the default shape.
+    """
+
+    @cached_property
+    def fieldset(self):
+        if self.request.method not in SAFE_METHODS:
+            return FieldSet()
+        return FieldSet.from_request(self.request)
+
+    def get_queryset(self):
+        return self.get_serializer_class().shape_queryset(super().get_queryset(), self.fieldset)
+
+    def get_serializer(self, *args, **kwargs):
+        kwargs.setdefault('fieldset', self.fieldset)
+        return super().get_serializer(*args, **kwargs)
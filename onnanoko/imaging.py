@@ -0,0 +1,85 @@
+import hashlib
+
+from PIL import Image as PILImage
+
+
+def probe_image(fileobj):
+    """Return (width, height, format) read from the image header.
+
+    Pillow only parses the header on open, so no pixel data is decoded. Works on
+    any file-like object (in-memory or temporary uploads, storage files) and
+    leaves its position unchanged.
+    """
+    pos = fileobj.tell()
+    fileobj.seek(0)
+    try:
+        with PILImage.open(fileobj) as img:
+            return img.width, img.height, img.format
+    finally:
+        fileobj.seek(pos)
+
+
+class InvalidImage(ValueError):
+    pass
+
+
+def verify_image(fileobj, max_pixels):
+    """Fully check an uploaded image and return (width, height, format).
+
+    Rejects images over ``max_pixels`` before decoding anything (decompression
+    bombs), then runs Pillow's structural checks and a decode to catch
+    truncated or corrupt data. Raises InvalidImage with a user-facing message.
+    """
+    try:
+        fileobj.seek(0)
+        with PILImage.open(fileobj) as img:
+            width, height, fmt = img.width, img.height, img.format
+            if width * height > max_pixels:
+                raise InvalidImage(f'Image is too large ({width}×{height} pixels).')
+            img.verify()
+        # verify() leaves the image unusable, so decode from a fresh open. JPEGs
+        # are decoded at reduced scale; that still reads every byte of the stream.
+        fileobj.seek(0)
+        with PILImage.open(fileobj) as img:
+            img.draft('RGB', (256, 256))
+            img.load()
+    except InvalidImage:
+        raise
+    except Exception:
+        raise InvalidImage('Invalid image file.')
+    finally:
+        fileobj.seek(0)
+    return width, height, fmt
+
+
+def sha256_file(fileobj, chunk_size=1024 * 1024):
+    """Hex SHA-256 of a file-like object, preferring a digest computed during upload."""
+    digest = getattr(fileobj, 'sha256', None)
+    if digest:
+        return digest
+    pos = fileobj.tell()
+    fileobj.seek(0)
+    hasher = hashlib.sha256()
+    try:
+        for chunk in iter(lambda: fileobj.read(chunk_size), b''):
+            hasher.update(chunk)
+    finally:
+        fileobj.seek(pos)
+    return hasher.hexdigest()
+
+
+def dhash(img, hash_size=8):
+    """64-bit difference hash of a PIL image, as a signed integer for BigIntegerField.
+
+    Each bit records whether a pixel of the downscaled greyscale image is
+    brighter than its right-hand neighbour, so re-encodes and resized copies
+    land within a few bits of each other.
+    """
+    small = img.convert('L').resize((hash_size + 1, hash_size), PILImage.Resampling.LANCZOS)
+    pixels = small.tobytes()
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value - (1 << 64) if value >= 1 << 63 else value
@@ -0,0 +1,118 @@
+import logging
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import ANALYSED_FIELDS, Image, Job
+
+logger = logging.getLogger(__name__)
+
+# kind -> (handler, on_failure)
+HANDLERS = {}
+
+
+def handler(kind, on_failure=None):
+    """Register a function as the handler for jobs of ``kind``.
+
+    The handler is called with the job payload as keyword arguments. If it
+    still raises on the job's last attempt, ``on_failure`` is called with the
+    same arguments.
+    """
+    def register(func):
+        HANDLERS[kind] = (func, on_failure)
+        return func
+    return register
+
+
+def claim(worker, limit=1):
+    """Atomically take up to ``limit`` due jobs and mark them running for ``worker``."""
+    now = timezone.now()
+    with transaction.atomic():
+        # SKIP LOCKED lets several workers poll the same table without blocking each
+        # other; backends without row locks (SQLite) serialise the whole transaction.
+        ids = list(
+            Job.objects.select_for_update(skip_locked=True)
+            .filter(status=Job.QUEUED, run_after__lte=now)
+            .order_by('run_after', 'pk')
+            .values_list('pk', flat=True)[:limit]
+        )
+        if not ids:
+            return []
+        Job.objects.filter(pk__in=ids).update(
+            status=Job.RUNNING, locked_by=worker, locked_at=now, attempts=F('attempts') + 1,
+        )
+    return list(Job.objects.filter(pk__in=ids).order_by('run_after', 'pk'))
+
+
+def requeue_stale(timeout=None):
+    """Hand jobs left running by a worker that died back to the queue."""
+    if timeout is None:
+        timeout = getattr(settings, 'JOB_LOCK_TIMEOUT', 600)
+    cutoff = timezone.now() - timedelta(seconds=timeout)
+    return Job.objects.filter(status=Job.RUNNING, locked_at__lt=cutoff).update(
+        status=Job.QUEUED, locked_by='', locked_at=None,
+    )
+
+
+def run(job):
+    """Run one claimed job. Finished jobs are deleted; returns True on success."""
+    func, on_failure = HANDLERS.get(job.kind, (None, None))
+    try:
+        if func is None:
+            raise LookupError(f'No handler registered for job kind {job.kind!r}')
+        func(**job.payload)
+    except Exception:
+        error = traceback.format_exc()
+        logger.exception('Job %s failed (attempt %s of %s)', job, job.attempts, job.max_attempts)
+        job.last_error = error
+        job.locked_by, job.locked_at = '', None
+        if func is not None and job.attempts < job.max_attempts:
+            delay = getattr(settings, 'JOB_RETRY_DELAY', 30) * 2 ** (job.attempts - 1)
+            job.status = Job.QUEUED
+            job.run_after = timezone.now() + timedelta(seconds=delay)
+        else:
+            job.status = Job.FAILED
+            if on_failure is not None:
+                on_failure(**job.payload)
+        job.save(update_fields=['status', 'run_after', 'last_error', 'locked_by', 'locked_at'])
+        return False
+    job.delete()
+    return True
+
+
+def mark_image_failed(image_id):
+    Image.objects.filter(pk=image_id).update(status=Image.FAILED)
+
+
+@handler('image.process', on_failure=mark_image_failed)
+def process_image(image_id):
+    """Decode a stored upload once for its dimensions, perceptual hash and derivatives."""
+    image = Image.objects.filter(pk=image_id).first()
+    if image is None or not image.file:
+        return
+    with image.file.storage.open(image.file.name, 'rb') as fh:
+        image._analyse(fh)
+    image.status = Image.READY
+    image.save(update_fields=[*ANALYSED_FIELDS, 'status'])
+
+
+@handler('search.reindex')
+def reindex_search(document, ids):
+    from . import search
+    search.index(document, ids)
+
+
+@handler('stats.reconcile')
+def reconcile_stats():
+    from . import stats
+    stats.reconcile()
+
+
+@handler('related.refresh')
+def refresh_related(ids):
+    from . import related
+    related.changed(ids)
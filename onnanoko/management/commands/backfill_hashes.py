@@ -0,0 +1,68 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from onnanoko.imaging import dhash, sha256_file
+from onnanoko.models import Image
+from PIL import Image as PILImage
+
+
+def hash_stored_file(row):
+    pk, name, digest, phash = row
+    try:
+        with default_storage.open(name, 'rb') as fh:
+            if not digest:
+                digest = sha256_file(fh)
+            if phash is None:
+                with PILImage.open(fh) as img:
+                    img.draft('L', (64, 64))
+                    phash = dhash(img)
+        return pk, digest, phash, None
+    except Exception as e:
+        return pk, None, None, f'{name}: {e}'
+
+
+class Command(BaseCommand):
+    help = (
+        'Compute missing SHA-256 content hashes and perceptual hashes for existing images. '
+        'Running web processes pick up backfilled perceptual hashes on their next full '
+        'near-duplicate index rebuild (NEAR_DUPLICATE_INDEX_TTL).'
+    )
+
+    def add_arguments(self, parser):
+        # hashlib and Pillow release the GIL while hashing/decoding, so threads run in parallel.
+        parser.add_argument('--workers', type=int, default=(os.cpu_count() or 1) * 2,
+                            help='Hashing threads.')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Rows fetched and written back per batch.')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        hashed = failed = 0
+        last_pk = 0
+        pending = Image.objects.filter(Q(sha256='') | Q(phash=None)).exclude(file='').order_by('pk')
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            while True:
+                rows = list(pending.filter(pk__gt=last_pk).values_list('pk', 'file', 'sha256', 'phash')[:options['batch_size']])
+                if not rows:
+                    break
+                updates = []
+                for pk, digest, phash, error in executor.map(hash_stored_file, rows):
+                    if error:
+                        failed += 1
+                        self.stdout.write(self.style.ERROR(f'Error with {error}'))
+                    else:
+                        updates.append(Image(pk=pk, sha256=digest, phash=phash))
+                Image.objects.bulk_update(updates, ['sha256', 'phash'])
+                hashed += len(updates)
+                last_pk = rows[-1][0]
+                self.stdout.write(f'Hashed through pk {last_pk} ({hashed} so far)')
+
+        elapsed = time.perf_counter() - started
+        rate = hashed / elapsed if elapsed else 0.0
+        self.stdout.write(self.style.SUCCESS(
+            f'Done. {hashed} hashed, {failed} failed in {elapsed:.1f}s ({rate:.1f} images/s).'
+        ))
@@ -0,0 +1,79 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from onnanoko import page_cache
+from onnanoko.models import Character, Image, new_card_version
+from onnanoko.thumbnails import render_placeholder
+from PIL import Image as PILImage
+
+# (model, file field, derivatives field, placeholder field, colour field)
+TARGETS = (
+    (Image, 'file', 'derivatives', 'placeholder', 'dominant_color'),
+    (Character, 'primary_image', 'primary_image_derivatives', 'primary_image_placeholder', 'primary_image_color'),
+)
+
+
+def placeholder_for(row):
+    pk, name, derivatives = row
+    # The smallest stored thumbnail is plenty for a 16px preview and far cheaper to decode.
+    sizes = (derivatives or {}).get('sizes', {})
+    smallest = sizes[min(sizes, key=int)].get('jpeg') if sizes else None
+    try:
+        with default_storage.open(smallest or name, 'rb') as fh:
+            with PILImage.open(fh) as img:
+                img.draft('RGB', (64, 64))
+                placeholder, color = render_placeholder(img)
+        return pk, placeholder, color, None
+    except Exception as e:
+        return pk, None, None, f'{name}: {e}'
+
+
+class Command(BaseCommand):
+    help = 'Compute missing inline placeholders and dominant colours for images and character portraits.'
+
+    def add_arguments(self, parser):
+        # Pillow releases the GIL while decoding, so threads run in parallel.
+        parser.add_argument('--workers', type=int, default=(os.cpu_count() or 1) * 2,
+                            help='Decoding threads.')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Rows fetched and written back per batch.')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        done = failed = 0
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            for model, file_field, derivatives_field, placeholder_field, color_field in TARGETS:
+                pending = (
+                    model.objects.filter(**{placeholder_field: ''})
+                    .exclude(**{file_field: ''}).exclude(**{f'{file_field}__isnull': True})
+                    .order_by('pk')
+                )
+                last_pk = 0
+                while True:
+                    rows = list(pending.filter(pk__gt=last_pk).values_list('pk', file_field, derivatives_field)[:options['batch_size']])
+                    if not rows:
+                        break
+                    updates = []
+                    now = timezone.now()
+                    for pk, placeholder, color, error in executor.map(placeholder_for, rows):
+                        if error:
+                            failed += 1
+                            self.stdout.write(self.style.ERROR(f'Error with {error}'))
+                        else:
+                            updates.append(model(pk=pk, card_version=new_card_version(), updated_at=now,
+                                                 **{placeholder_field: placeholder, color_field: color}))
+                    model.objects.bulk_update(updates, [placeholder_field, color_field, 'card_version', 'updated_at'])
+                    done += len(updates)
+                    last_pk = rows[-1][0]
+                    self.stdout.write(f'{model._meta.verbose_name_plural}: through pk {last_pk} ({done} so far)')
+        page_cache.purge('images', 'characters')
+
+        elapsed = time.perf_counter() - started
+        rate = done / elapsed if elapsed else 0.0
+        self.stdout.write(self.style.SUCCESS(
+            f'Done. {done} placeholders computed, {failed} failed in {elapsed:.1f}s ({rate:.1f} images/s).'
+        ))
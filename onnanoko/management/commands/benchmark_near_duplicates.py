@@ -0,0 +1,59 @@
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from onnanoko.near_duplicates import MultiIndexHash, hamming
+
+
+class Command(BaseCommand):
+    help = 'Benchmark near-duplicate index build time and query latency on synthetic perceptual hashes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=1_000_000, help='Hashes in the index.')
+        parser.add_argument('--queries', type=int, default=1000, help='Lookups to time.')
+        parser.add_argument('--distance', type=int, default=10, help='Query radius in bits.')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        size, radius = options['size'], options['distance']
+        hashes = [rng.getrandbits(64) for _ in range(size)]
+
+        started = time.perf_counter()
+        index = MultiIndexHash()
+        for item_id, value in enumerate(hashes):
+            index.add(item_id, value)
+        build = time.perf_counter() - started
+        self.stdout.write(f'Built index of {size} hashes in {build:.2f}s ({size / build:,.0f} hashes/s)')
+
+        # Half the queries are perturbed copies of indexed hashes (the moderation
+        # case), half are unrelated hashes that should find nothing.
+        latencies = []
+        hits = 0
+        for i in range(options['queries']):
+            if i % 2 == 0:
+                target = rng.randrange(size)
+                query = hashes[target]
+                for bit in rng.sample(range(64), rng.randint(0, radius)):
+                    query ^= 1 << bit
+            else:
+                target, query = None, rng.getrandbits(64)
+            started = time.perf_counter()
+            found = index.search(query, radius)
+            latencies.append(time.perf_counter() - started)
+            wrong = [(d, item_id) for d, item_id in found if hamming(hashes[item_id], query) != d]
+            if wrong:
+                raise CommandError(f'Query {query:016x} reported wrong distances for (distance, id) {wrong}')
+            if target is not None:
+                if not any(item_id == target for _, item_id in found):
+                    raise CommandError(f'Query {query:016x} missed item {target} ({hashes[target]:016x}); found {found}')
+                hits += 1
+
+        latencies.sort()
+        p50 = statistics.median(latencies) * 1000
+        p99 = latencies[int(len(latencies) * 0.99) - 1] * 1000
+        self.stdout.write(self.style.SUCCESS(
+            f'{len(latencies)} queries at distance <= {radius}: p50 {p50:.3f} ms, p99 {p99:.3f} ms, '
+            f'{hits} planted near-duplicates all found'
+        ))
@@ -0,0 +1,101 @@
+import random
+import statistics
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+from onnanoko.models import Character, Image, Series, Tag
+from onnanoko import search
+from onnanoko.search import ranked
+
+WORDS = (
+    'sakura hoshi yume kaze tsuki hana umi sora yuki kawaii idol school summer winter maid '
+    'witch knight pilot singer dancer shrine forest city night festival ribbon twintails'
+).split()
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare search latency of the old icontains joins with the full-text index. '
+        'With --populate, synthetic rows are created inside a transaction that is rolled back.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--populate', type=int, default=0,
+                            help='Create this many synthetic images (and a tenth as many characters) first.')
+        parser.add_argument('--queries', nargs='*', default=['sakura', 'idol school', 'kaz', 'night festival'])
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                if options['populate']:
+                    self.populate(options['populate'], random.Random(options['seed']))
+                self.run(options['queries'], options['repeat'])
+                raise Rollback
+        except Rollback:
+            pass
+
+    def populate(self, count, rng):
+        started = time.perf_counter()
+        user, _ = get_user_model().objects.get_or_create(username='benchmark-search')
+        tags = [Tag.objects.get_or_create(name=f'bench {word}')[0] for word in WORDS]
+        series = [Series.objects.get_or_create(name=f'Bench {word.title()}')[0] for word in WORDS[:6]]
+        characters = []
+        for i in range(max(1, count // 10)):
+            character = Character.objects.create(
+                name=f'{rng.choice(WORDS).title()} {rng.choice(WORDS).title()} {i}',
+                description=' '.join(rng.choices(WORDS, k=12)), series=rng.choice(series),
+            )
+            character.tags.set(rng.sample(tags, 3))
+            characters.append(character)
+        for start in range(0, count, 1000):
+            images = Image.objects.bulk_create([
+                Image(uploader=user, file=f'images/bench-{i}.jpg', width=1, height=1,
+                      description=' '.join(rng.choices(WORDS, k=8)))
+                for i in range(start, min(count, start + 1000))
+            ])
+            Image.characters.through.objects.bulk_create([
+                Image.characters.through(image_id=image.pk, character_id=rng.choice(characters).pk) for image in images
+            ])
+            Image.tags.through.objects.bulk_create([
+                Image.tags.through(image_id=image.pk, tag_id=tag.pk) for image in images for tag in rng.sample(tags, 2)
+            ])
+            search.index(search.IMAGE, [image.pk for image in images])
+        self.stdout.write(f'Populated {count} images in {time.perf_counter() - started:.1f}s')
+
+    def icontains(self, term):
+        characters = Character.objects.filter(
+            Q(name__icontains=term) | Q(description__icontains=term) | Q(tags__name__icontains=term)
+            | Q(series__name__icontains=term) | Q(groups__name__icontains=term)
+        ).distinct()
+        images = Image.objects.filter(
+            Q(description__icontains=term) | Q(illustrator__icontains=term) | Q(uploader__username__icontains=term)
+            | Q(characters__name__icontains=term) | Q(tags__name__icontains=term)
+        ).distinct()
+        return characters, images
+
+    def indexed(self, term):
+        return ranked(Character.objects.all(), 'character', term), ranked(Image.objects.all(), 'image', term)
+
+    def run(self, queries, repeat):
+        for query in queries:
+            for label, build in (('icontains', self.icontains), ('index', self.indexed)):
+                timings = []
+                for _ in range(repeat):
+                    started = time.perf_counter()
+                    # What a paginated list view does: count, then fetch the first page.
+                    hits = tuple((results.count(), len(list(results[:24]))) for results in build(query))
+                    timings.append(time.perf_counter() - started)
+                timings.sort()
+                p50 = statistics.median(timings) * 1000
+                p99 = timings[max(0, int(len(timings) * 0.99) - 1)] * 1000
+                self.stdout.write(f'{query!r:>18} {label:>9}: p50 {p50:7.2f} ms, p99 {p99:7.2f} ms, (count, first page) per model {hits}')
+        self.stdout.write(self.style.SUCCESS('Done.'))
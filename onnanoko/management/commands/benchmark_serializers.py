@@ -0,0 +1,109 @@
+import random
+import statistics
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test import RequestFactory, override_settings
+from django.urls import resolve
+from onnanoko.models import Character, Group, Image, Series, Tag
+
+# (path, query parameters) of the list calls compared.
+CALLS = [
+    ('/api/images/', {}),
+    ('/api/images/', {'expand': 'characters,tags'}),
+    ('/api/images/', {'expand': 'characters.series,characters.groups,characters.tags,tags'}),
+    ('/api/characters/', {}),
+    ('/api/characters/', {'expand': 'series,groups,tags'}),
+    ('/api/tags/', {}),
+    ('/api/series/', {}),
+    ('/api/groups/', {}),
+]
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare API list latency of the serializers with the values_list() read path, and check both render the same bytes. '
+        'With --populate, synthetic rows are created inside a transaction that is rolled back.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--populate', type=int, default=0,
+                            help='Create this many synthetic images (and a tenth as many characters) first.')
+        parser.add_argument('--page-size', type=int, default=100)
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                if options['populate']:
+                    self.populate(options['populate'], random.Random(options['seed']))
+                self.run(options['page_size'], options['repeat'])
+                raise Rollback
+        except Rollback:
+            pass
+
+    def populate(self, count, rng):
+        started = time.perf_counter()
+        user, _ = get_user_model().objects.get_or_create(username='benchmark-serializers')
+        tags = [Tag.objects.get_or_create(name=f'bench tag {i}')[0] for i in range(30)]
+        groups = [Group.objects.get_or_create(name=f'Bench Group {i}')[0] for i in range(8)]
+        series = [Series.objects.get_or_create(name=f'Bench Series {i}')[0] for i in range(6)]
+        characters = Character.objects.bulk_create([
+            Character(name=f'Bench Girl {i}', slug=f'bench-girl-{i}', series=rng.choice(series), description='benchmark')
+            for i in range(max(1, count // 10))
+        ])
+        Character.groups.through.objects.bulk_create([
+            Character.groups.through(character_id=character.pk, group_id=group.pk)
+            for character in characters for group in rng.sample(groups, 2)
+        ])
+        Character.tags.through.objects.bulk_create([
+            Character.tags.through(character_id=character.pk, tag_id=tag.pk)
+            for character in characters for tag in rng.sample(tags, 4)
+        ])
+        for start in range(0, count, 1000):
+            images = Image.objects.bulk_create([
+                Image(uploader=user, file=f'images/bench-{i}.jpg', width=1, height=1, is_approved=True,
+                      description=f'Benchmark image {i}', derivatives={'sizes': {'256': {'jpeg': f'thumbs/bench-{i}.jpg'}}})
+                for i in range(start, min(count, start + 1000))
+            ])
+            Image.characters.through.objects.bulk_create([
+                Image.characters.through(image_id=image.pk, character_id=character.pk)
+                for image in images for character in rng.sample(characters, min(2, len(characters)))
+            ])
+            Image.tags.through.objects.bulk_create([
+                Image.tags.through(image_id=image.pk, tag_id=tag.pk) for image in images for tag in rng.sample(tags, 3)
+            ])
+        self.stdout.write(f'Populated {count} images in {time.perf_counter() - started:.1f}s')
+
+    def call(self, path, params, fast):
+        request = RequestFactory().get(path, params, HTTP_HOST=settings.ALLOWED_HOSTS[0])
+        with override_settings(API_FAST_READ=fast):
+            started = time.perf_counter()
+            response = resolve(path).func(request)
+            response.render()
+            return time.perf_counter() - started, response.content
+
+    def run(self, page_size, repeat):
+        for path, params in CALLS:
+            params = {**params, 'page_size': page_size}
+            timings, contents = {}, {}
+            for label, fast in (('serializers', False), ('read path', True)):
+                runs = [self.call(path, params, fast) for _ in range(repeat)]
+                timings[label] = sorted(elapsed for elapsed, _ in runs)
+                contents[label] = runs[-1][1]
+            same = 'identical' if contents['serializers'] == contents['read path'] else 'DIFFERENT'
+            shape = ' '.join(f'{key}={value}' for key, value in params.items() if key != 'page_size') or 'default'
+            p50 = {label: statistics.median(values) * 1000 for label, values in timings.items()}
+            self.stdout.write(
+                f'{path:>17} {shape:<70} serializers p50 {p50["serializers"]:8.2f} ms, read path p50 {p50["read path"]:8.2f} ms '
+                f'({p50["serializers"] / max(p50["read path"], 1e-9):4.1f}x), {len(contents["read path"])} bytes {same}'
+            )
+        self.stdout.write(self.style.SUCCESS('Done.'))
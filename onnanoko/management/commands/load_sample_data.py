@@ -53,11 +53,10 @@ class Command(BaseCommand):
             buf.seek(0)
             image = Image.objects.create(
                 uploader=user,
+                file=ContentFile(buf.read(), name=f'sample_{i}.jpg'),
                 description=f"Sample image for {char.name}",
+                is_approved=True,
             )
-            image.file.save(f'sample_{i}.jpg', ContentFile(buf.read()), save=True)
             image.characters.set([char])
             image.tags.set([t1])
-            image.is_approved = True
-            image.save()
         self.stdout.write(self.style.SUCCESS('Sample data loaded.'))
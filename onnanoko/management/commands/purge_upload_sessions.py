@@ -0,0 +1,24 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from onnanoko import chunked_uploads
+from onnanoko.models import UploadSession
+
+
+class Command(BaseCommand):
+    help = 'Delete chunked upload sessions (and their partial files) not touched within CHUNKED_UPLOAD_EXPIRY.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, default=settings.CHUNKED_UPLOAD_EXPIRY,
+                            help='Age in seconds since the last chunk.')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(seconds=options['older_than'])
+        purged = 0
+        for session in UploadSession.objects.filter(updated_at__lt=cutoff).iterator():
+            chunked_uploads.discard(session)
+            session.delete()
+            purged += 1
+        self.stdout.write(self.style.SUCCESS(f'Done. {purged} upload sessions purged.'))
@@ -0,0 +1,18 @@
+import time
+
+from django.core.management.base import BaseCommand
+from onnanoko import related
+
+
+class Command(BaseCommand):
+    help = 'Recompute the stored related images of every approved image.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Rows inserted per query.')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        images, rows = related.rebuild(options['batch_size'])
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(f'Done. {rows} related images stored for {images} images in {elapsed:.1f}s.'))
@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand
+from onnanoko import search
+from onnanoko.models import Character, Image, SearchDocument
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text search documents of every character and image.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Documents rebuilt per batch.')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        total = 0
+        for kind, model in ((search.CHARACTER, Character), (search.IMAGE, Image)):
+            ids = list(model.objects.order_by('pk').values_list('pk', flat=True))
+            for start in range(0, len(ids), options['batch_size']):
+                search.index(kind, ids[start:start + options['batch_size']])
+            stale = SearchDocument.objects.filter(kind=kind).exclude(object_id__in=model.objects.values('pk'))
+            stale.delete()
+            total += len(ids)
+            self.stdout.write(f'{model._meta.verbose_name_plural}: {len(ids)} documents')
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(f'Done. {total} documents rebuilt in {elapsed:.1f}s.'))
@@ -1,19 +1,167 @@
+import json
+import os
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.apps import apps
+from django.conf import settings
+from django.core.files.storage import default_storage
 from django.core.management.base import BaseCommand
-from onnanoko.models import Image
-from PIL import Image as PILImage
+from django.db import connections
+from django.utils import timezone
+from onnanoko import page_cache
+from onnanoko.models import Character, Image, new_card_version
+from onnanoko.thumbnails import is_current, open_source, render_thumbnails, source_fingerprint
+
+REBUILT, SKIPPED, FAILED = 'rebuilt', 'skipped', 'failed'
+
+# (checkpoint key, model, file field, derivatives field, extra fields written back)
+TARGETS = (
+    ('image', Image, 'file', 'derivatives', ('width', 'height')),
+    ('character', Character, 'primary_image', 'primary_image_derivatives', ()),
+)
+
+
+def _init_worker():
+    # Only needed with the spawn start method; forked workers inherit the setup.
+    if not apps.ready:
+        django.setup()
+
+
+def process_source(task):
+    """Decode and resize one source file. Runs inside a worker process."""
+    pk, name, previous, force = task
+    timings = {}
+    try:
+        started = time.perf_counter()
+        fingerprint = source_fingerprint(name, default_storage)
+        timings['stat'] = time.perf_counter() - started
+        if not force and is_current(previous, name, fingerprint):
+            return pk, SKIPPED, None, timings
+        started = time.perf_counter()
+        with default_storage.open(name, 'rb') as fh:
+            width, height, img = open_source(fh)
+            with img:
+                timings['decode'] = time.perf_counter() - started
+                started = time.perf_counter()
+                derivatives = render_thumbnails(img, name, default_storage, fingerprint)
+                timings['render'] = time.perf_counter() - started
+        return pk, REBUILT, (width, height, derivatives), timings
+    except Exception as e:
+        return pk, FAILED, f'{name}: {e}', timings
+
 
 class Command(BaseCommand):
-    help = 'Rebuild thumbnails and update width/height for all images.'
+    help = (
+        'Rebuild thumbnail derivatives and width/height for all images and character portraits. '
+        'Runs in parallel, resumes from a checkpoint and skips sources that have not changed.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help='Decode/resize worker processes (1 runs inline).')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Rows fetched and written back per batch.')
+        parser.add_argument('--checkpoint', default=str(settings.BASE_DIR / '.rebuild_thumbnails.json'),
+                            help='File recording the last processed primary key per model.')
+        parser.add_argument('--restart', action='store_true',
+                            help='Ignore any existing checkpoint and start from the beginning.')
+        parser.add_argument('--force', action='store_true',
+                            help='Rebuild even if the source file is unchanged since the last run.')
 
     def handle(self, *args, **options):
-        count = 0
-        for img in Image.objects.all():
-            try:
-                pil_img = PILImage.open(img.file.path)
-                img.width, img.height = pil_img.size
-                img.save(update_fields=['width', 'height'])
-                self.stdout.write(self.style.SUCCESS(f'Rebuilt: {img.file.name}'))
-                count += 1
-            except Exception as e:
-                self.stdout.write(self.style.ERROR(f'Error with {img.file.name}: {e}'))
-        self.stdout.write(self.style.SUCCESS(f'Done. {count} images processed.'))
+        self.batch_size = options['batch_size']
+        self.force = options['force']
+        self.checkpoint_path = options['checkpoint']
+        self.checkpoint = {} if options['restart'] else self.load_checkpoint()
+        self.counts = Counter()
+        self.timings = defaultdict(float)
+        started = time.perf_counter()
+
+        executor = None
+        if options['workers'] > 1:
+            # Never hand open database connections to forked children.
+            connections.close_all()
+            executor = ProcessPoolExecutor(max_workers=options['workers'], initializer=_init_worker)
+        try:
+            for target in TARGETS:
+                self.rebuild(target, executor)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        page_cache.purge('images', 'characters')
+
+        elapsed = time.perf_counter() - started
+        processed = sum(self.counts.values())
+        rate = processed / elapsed if elapsed else 0.0
+        self.stdout.write(self.style.SUCCESS(
+            f'Done. {self.counts[REBUILT]} rebuilt, {self.counts[SKIPPED]} unchanged, '
+            f'{self.counts[FAILED]} failed in {elapsed:.1f}s ({rate:.1f} images/s).'
+        ))
+        stages = ', '.join(f'{stage} {seconds:.2f}s' for stage, seconds in sorted(self.timings.items()))
+        self.stdout.write(f'Stage timings (summed across workers): {stages}')
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+    def rebuild(self, target, executor):
+        key, model, file_field, derivatives_field, extra_fields = target
+        last_pk = self.checkpoint.get(key, 0)
+        base = model.objects.exclude(**{file_field: ''}).exclude(**{f'{file_field}__isnull': True}).order_by('pk')
+        while True:
+            started = time.perf_counter()
+            rows = list(base.filter(pk__gt=last_pk).values_list('pk', file_field, derivatives_field)[:self.batch_size])
+            self.timings['fetch'] += time.perf_counter() - started
+            if not rows:
+                break
+
+            tasks = [(pk, name, previous or {}, self.force) for pk, name, previous in rows]
+            if executor is None:
+                results = map(process_source, tasks)
+            else:
+                results = executor.map(process_source, tasks, chunksize=max(1, len(tasks) // 32))
+
+            updates = []
+            now = timezone.now()
+            for pk, status, payload, timings in results:
+                self.counts[status] += 1
+                for stage, seconds in timings.items():
+                    self.timings[stage] += seconds
+                if status == FAILED:
+                    self.stdout.write(self.style.ERROR(f'Error with {payload}'))
+                elif status == REBUILT:
+                    width, height, derivatives = payload
+                    obj = model(pk=pk, card_version=new_card_version(), updated_at=now)
+                    setattr(obj, derivatives_field, derivatives)
+                    if extra_fields:
+                        obj.width, obj.height = width, height
+                    updates.append(obj)
+
+            started = time.perf_counter()
+            if updates:
+                model.objects.bulk_update(updates, [derivatives_field, *extra_fields, 'card_version', 'updated_at'])
+            self.timings['write'] += time.perf_counter() - started
+
+            last_pk = rows[-1][0]
+            self.checkpoint[key] = last_pk
+            self.save_checkpoint()
+            self.stdout.write(
+                f'{model._meta.verbose_name_plural}: through pk {last_pk}, '
+                f'{len(updates)} rebuilt in this batch of {len(rows)}'
+            )
+
+    def load_checkpoint(self):
+        try:
+            with open(self.checkpoint_path) as fh:
+                checkpoint = json.load(fh)
+        except (OSError, ValueError):
+            return {}
+        self.stdout.write(f'Resuming from checkpoint {self.checkpoint_path}: {checkpoint}')
+        return checkpoint
+
+    def save_checkpoint(self):
+        tmp = f'{self.checkpoint_path}.tmp'
+        with open(tmp, 'w') as fh:
+            json.dump(self.checkpoint, fh)
+        os.replace(tmp, self.checkpoint_path)
@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+from onnanoko import counters, stats
+
+
+class Command(BaseCommand):
+    help = 'Recount the denormalized counters and dashboard totals that have drifted from the data.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report how many rows have drifted.')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        report = counters.reconcile(dry_run=options['dry_run'])
+        for model, drifted in report.items():
+            self.stdout.write(f'{model._meta.verbose_name_plural}: {drifted} drifted')
+        totals = stats.reconcile(dry_run=options['dry_run'])
+        for name, drift in totals.items():
+            self.stdout.write(f'total {name}: off by {-drift:+d}')
+        elapsed = time.perf_counter() - started
+        verb = 'found' if options['dry_run'] else 'fixed'
+        self.stdout.write(self.style.SUCCESS(f'Done. {sum(report.values()) + len(totals)} rows {verb} in {elapsed:.1f}s.'))
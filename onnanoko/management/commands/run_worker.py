@@ -0,0 +1,55 @@
+import os
+import signal
+import socket
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from onnanoko import jobs
+
+
+class Command(BaseCommand):
+    help = (
+        'Run queued background jobs (upload post-processing and the like) from the database. '
+        'Several workers may run side by side; no external broker is needed.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10,
+                            help='Jobs claimed per poll.')
+        parser.add_argument('--poll-interval', type=float, default=2.0,
+                            help='Seconds to sleep when the queue is empty.')
+        parser.add_argument('--burst', action='store_true',
+                            help='Exit once no jobs are due instead of waiting for more.')
+
+    def handle(self, *args, **options):
+        worker = f'{socket.gethostname()}:{os.getpid()}'
+        self.stopping = False
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        done = failed = 0
+        requeued = jobs.requeue_stale()
+        if requeued:
+            self.stdout.write(f'Requeued {requeued} stale jobs')
+        self.stdout.write(f'Worker {worker} started')
+        while not self.stopping:
+            close_old_connections()
+            claimed = jobs.claim(worker, options['batch_size'])
+            if not claimed:
+                if options['burst']:
+                    break
+                time.sleep(options['poll_interval'])
+                jobs.requeue_stale()
+                continue
+            for job in claimed:
+                if jobs.run(job):
+                    done += 1
+                else:
+                    failed += 1
+                    self.stdout.write(self.style.ERROR(f'Error with {job}: {job.last_error.splitlines()[-1]}'))
+        self.stdout.write(self.style.SUCCESS(f'Done. {done} jobs completed, {failed} failed.'))
+
+    def stop(self, signum, frame):
+        # Finish the batch in hand, then exit.
+        self.stopping = True
@@ -0,0 +1,158 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from onnanoko import page_cache
+from onnanoko.models import Character, Image, new_card_version
+from onnanoko.storage import character_upload_to, image_upload_to
+from onnanoko.thumbnails import THUMBNAIL_FORMATS, source_fingerprint, thumbnail_name
+
+# (model, file field, derivatives field, flat directory, upload_to, extra fields for upload_to)
+TARGETS = (
+    (Image, 'file', 'derivatives', 'images', image_upload_to, ('sha256', 'format')),
+    (Character, 'primary_image', 'primary_image_derivatives', 'characters', character_upload_to, ()),
+)
+
+
+def copy_file(old, new):
+    """Make ``new`` hold the same bytes as ``old`` without touching ``old``."""
+    if default_storage.exists(new):
+        return
+    try:
+        # Same file system: a hard link is instant and needs no extra space.
+        target = default_storage.path(new)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.link(default_storage.path(old), target)
+        return
+    except (NotImplementedError, OSError):
+        pass
+    with default_storage.open(old, 'rb') as fh:
+        saved = default_storage.save(new, fh)
+    if saved != new:
+        raise OSError(f'{new} was stored as {saved}')
+
+
+def move_source(task):
+    """Copy one source file and its derivatives to their sharded names."""
+    old, new, derivatives = task
+    try:
+        copy_file(old, new)
+        moved = {}
+        if derivatives.get('sizes'):
+            sizes = {}
+            for size, entry in derivatives['sizes'].items():
+                sizes[size] = dict(entry)
+                for ext, _, _ in THUMBNAIL_FORMATS:
+                    if entry.get(ext):
+                        sizes[size][ext] = thumbnail_name(new, size, ext)
+                        copy_file(entry[ext], sizes[size][ext])
+            moved = {'source': new, 'fingerprint': source_fingerprint(new), 'sizes': sizes}
+        return old, moved, None
+    except Exception as e:
+        return old, None, f'{old}: {e}'
+
+
+class Command(BaseCommand):
+    help = (
+        'Move images and character portraits from the flat images/ and characters/ directories '
+        'into hash-prefixed subdirectories. Safe to run while the site is up: files are copied '
+        '(hard-linked where possible) and rows repointed in batches, and the old files are only '
+        'removed once no row refers to them.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=(os.cpu_count() or 1) * 2,
+                            help='Copying threads.')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Rows repointed per batch.')
+        parser.add_argument('--keep-old', action='store_true',
+                            help='Leave the old flat files in place after migrating.')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        self.moved = self.failed = 0
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            for target in TARGETS:
+                self.migrate(target, executor, options['batch_size'])
+        # Before the old files go: cached lists still link to them.
+        page_cache.purge('images', 'characters')
+        if not options['keep_old']:
+            for target in TARGETS:
+                self.cleanup(target)
+
+        elapsed = time.perf_counter() - started
+        rate = self.moved / elapsed if elapsed else 0.0
+        self.stdout.write(self.style.SUCCESS(
+            f'Done. {self.moved} rows moved, {self.failed} failed in {elapsed:.1f}s ({rate:.1f} rows/s).'
+        ))
+
+    def flat_rows(self, model, file_field):
+        return (
+            model.objects.exclude(**{file_field: ''}).exclude(**{f'{file_field}__isnull': True})
+            .exclude(**{f'{file_field}__regex': r'^[^/]+/[^/]+/[^/]+/'})
+            .order_by('pk')
+        )
+
+    def migrate(self, target, executor, batch_size):
+        model, file_field, derivatives_field, _, upload_to, extra = target
+        rows_qs = self.flat_rows(model, file_field)
+        last_pk = 0
+        while True:
+            rows = list(rows_qs.filter(pk__gt=last_pk).values_list('pk', file_field, derivatives_field, *extra)[:batch_size])
+            if not rows:
+                break
+            last_pk = rows[-1][0]
+
+            # Rows sharing one blob (identical uploads) are copied once.
+            tasks = {}
+            for pk, name, derivatives, *values in rows:
+                if name not in tasks:
+                    instance = model(**dict(zip(extra, values)))
+                    new = upload_to(instance, os.path.basename(name))
+                    tasks[name] = (name, new, derivatives or {})
+            results = {}
+            for old, derivatives, error in executor.map(move_source, tasks.values()):
+                if error:
+                    self.failed += 1
+                    self.stdout.write(self.style.ERROR(f'Error with {error}'))
+                else:
+                    results[old] = derivatives
+
+            updates = []
+            now = timezone.now()
+            for pk, name, derivatives, *_ in rows:
+                if name in results:
+                    obj = model(pk=pk, card_version=new_card_version(), updated_at=now,
+                                **{file_field: tasks[name][1], derivatives_field: results[name] or derivatives or {}})
+                    updates.append(obj)
+            model.objects.bulk_update(updates, [file_field, derivatives_field, 'card_version', 'updated_at'])
+            self.moved += len(updates)
+            self.stdout.write(f'{model._meta.verbose_name_plural}: through pk {last_pk}, {len(updates)} moved in this batch')
+
+    def cleanup(self, target):
+        """Delete flat files (and their flat thumbnails) that no row points at any more."""
+        model, file_field, derivatives_field, directory, _, _ = target
+        remaining = self.flat_rows(model, file_field).values_list(file_field, derivatives_field)
+        keep = set()
+        for name, derivatives in remaining.iterator():
+            keep.add(name)
+            for entry in (derivatives or {}).get('sizes', {}).values():
+                keep.update(entry.get(ext) for ext, _, _ in THUMBNAIL_FORMATS)
+        if keep:
+            self.stdout.write(f'{len(keep)} {directory} files are still referenced and were kept')
+
+        removed = 0
+        for folder in (directory, f'thumbs/{directory}'):
+            try:
+                _, files = default_storage.listdir(folder)
+            except FileNotFoundError:
+                continue
+            for filename in files:
+                name = f'{folder}/{filename}'
+                if name not in keep:
+                    default_storage.delete(name)
+                    removed += 1
+        self.stdout.write(f'Removed {removed} old files from {directory}/')
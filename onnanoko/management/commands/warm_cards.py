@@ -0,0 +1,26 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from onnanoko import cards, page_cache
+from onnanoko.views import ImageGalleryView
+
+
+class Command(BaseCommand):
+    help = 'Render and cache the image cards of the first gallery pages, e.g. after a deploy.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pages', type=int, default=10,
+                            help='Gallery pages to warm.')
+
+    def handle(self, *args, **options):
+        if not page_cache.shared():
+            # The cards would be stored in this process and go with it.
+            raise CommandError(
+                f'The {settings.PAGE_CACHE_ALIAS!r} cache is per process, so the web workers would not see the '
+                f'warmed cards. Set PAGE_CACHE_BACKEND to file or redis.'
+            )
+        started = time.perf_counter()
+        count = cards.warm(options['pages'], ImageGalleryView.paginate_by)
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(f'Done. {count} cards of the first {options["pages"]} gallery pages cached in {elapsed:.1f}s.'))
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.30 on 2026-10-17 18:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('onnanoko', '0003_image_illustrator'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='character',
+            name='primary_image_derivatives',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='derivatives',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+    ]
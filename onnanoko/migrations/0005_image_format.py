@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-17 18:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('onnanoko', '0004_character_primary_image_derivatives_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='format',
+            field=models.CharField(blank=True, max_length=16),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 4.2.30 on 2026-10-17 18:40
+
+from django.db import migrations, models
+import onnanoko.storage
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('onnanoko', '0005_image_format'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='sha256',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=64),
+        ),
+        migrations.AlterField(
+            model_name='image',
+            name='file',
+            field=models.ImageField(upload_to=onnanoko.storage.image_upload_to),
+        ),
+    ]
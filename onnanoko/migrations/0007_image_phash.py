@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-17 18:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('onnanoko', '0006_image_sha256_alter_image_file'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='phash',
+            field=models.BigIntegerField(blank=True, editable=False, help_text='64-bit perceptual (difference) hash', null=True),
+        ),
+    ]
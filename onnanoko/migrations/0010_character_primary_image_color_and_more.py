@@ -0,0 +1,33 @@
+# Generated by Django 4.2.30 on 2026-10-17 18:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('onnanoko', '0009_uploadsession'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='character',
+            name='primary_image_color',
+            field=models.CharField(blank=True, editable=False, max_length=7),
+        ),
+        migrations.AddField(
+            model_name='character',
+            name='primary_image_placeholder',
+            field=models.TextField(blank=True, editable=False),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='dominant_color',
+            field=models.CharField(blank=True, editable=False, max_length=7),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='placeholder',
+            field=models.TextField(blank=True, editable=False, help_text='Inline data URI of a tiny preview'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.2.30 on 2026-10-17 18:54
+
+from django.db import migrations, models
+import onnanoko.storage
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('onnanoko', '0010_character_primary_image_color_and_more'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='character',
+            name='primary_image',
+            field=models.ImageField(blank=True, null=True, upload_to=onnanoko.storage.character_upload_to),
+        ),
+    ]
@@ -0,0 +1,97 @@
+# Generated by Django 4.2.30 on 2026-10-17 18:57
+
+from django.db import migrations, models
+
+FTS5_SQL = [
+    "CREATE VIRTUAL TABLE onnanoko_searchdocument_fts USING fts5("
+    "title, body, content='onnanoko_searchdocument', content_rowid='id', "
+    "tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+    "CREATE TRIGGER onnanoko_searchdocument_ai AFTER INSERT ON onnanoko_searchdocument BEGIN "
+    "INSERT INTO onnanoko_searchdocument_fts(rowid, title, body) VALUES (new.id, new.title, new.body); END",
+    "CREATE TRIGGER onnanoko_searchdocument_ad AFTER DELETE ON onnanoko_searchdocument BEGIN "
+    "INSERT INTO onnanoko_searchdocument_fts(onnanoko_searchdocument_fts, rowid, title, body) "
+    "VALUES ('delete', old.id, old.title, old.body); END",
+    "CREATE TRIGGER onnanoko_searchdocument_au AFTER UPDATE ON onnanoko_searchdocument BEGIN "
+    "INSERT INTO onnanoko_searchdocument_fts(onnanoko_searchdocument_fts, rowid, title, body) "
+    "VALUES ('delete', old.id, old.title, old.body); "
+    "INSERT INTO onnanoko_searchdocument_fts(rowid, title, body) VALUES (new.id, new.title, new.body); END",
+]
+FTS5_REVERSE_SQL = [
+    "DROP TRIGGER IF EXISTS onnanoko_searchdocument_ai",
+    "DROP TRIGGER IF EXISTS onnanoko_searchdocument_ad",
+    "DROP TRIGGER IF EXISTS onnanoko_searchdocument_au",
+    "DROP TABLE IF EXISTS onnanoko_searchdocument_fts",
+]
+
+POSTGRES_SQL = [
+    "ALTER TABLE onnanoko_searchdocument ADD COLUMN vector tsvector GENERATED ALWAYS AS ("
+    "setweight(to_tsvector('simple', title), 'A') || setweight(to_tsvector('simple', body), 'B')) STORED",
+    "CREATE INDEX onnanoko_searchdocument_vector ON onnanoko_searchdocument USING GIN (vector)",
+]
+POSTGRES_REVERSE_SQL = [
+    "DROP INDEX IF EXISTS onnanoko_searchdocument_vector",
+    "ALTER TABLE onnanoko_searchdocument DROP COLUMN IF EXISTS vector",
+]
+
+
+def run_for_vendor(sqlite, postgresql):
+    def run(apps, schema_editor):
+        statements = {'sqlite': sqlite, 'postgresql': postgresql}.get(schema_editor.connection.vendor, [])
+        for statement in statements:
+            schema_editor.execute(statement)
+    return run
+
+
+def build_documents(apps, schema_editor):
+    Character = apps.get_model('onnanoko', 'Character')
+    Image = apps.get_model('onnanoko', 'Image')
+    SearchDocument = apps.get_model('onnanoko', 'SearchDocument')
+
+    def join(*parts):
+        return ' '.join(part for part in parts if part)
+
+    docs = []
+    for character in Character.objects.select_related('series').prefetch_related('groups', 'tags').iterator(chunk_size=2000):
+        docs.append(SearchDocument(
+            kind='character', object_id=character.pk, title=character.name,
+            body=join(
+                character.description, character.series.name if character.series else '',
+                *(group.name for group in character.groups.all()), *(tag.name for tag in character.tags.all()),
+            ),
+        ))
+    for image in Image.objects.select_related('uploader').prefetch_related('characters', 'tags').iterator(chunk_size=2000):
+        docs.append(SearchDocument(
+            kind='image', object_id=image.pk,
+            title=join(*(character.name for character in image.characters.all()), *(tag.name for tag in image.tags.all())),
+            body=join(image.description, image.illustrator, image.uploader.username),
+        ))
+    SearchDocument.objects.bulk_create(docs, batch_size=2000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('onnanoko', '0011_alter_character_primary_image'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchDocument',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('character', 'Character'), ('image', 'Image')], max_length=16)),
+                ('object_id', models.PositiveBigIntegerField()),
+                ('title', models.TextField(blank=True)),
+                ('body', models.TextField(blank=True)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='searchdocument',
+            constraint=models.UniqueConstraint(fields=('kind', 'object_id'), name='unique_search_document'),
+        ),
+        migrations.RunPython(
+            run_for_vendor(FTS5_SQL, POSTGRES_SQL),
+            run_for_vendor(FTS5_REVERSE_SQL, POSTGRES_REVERSE_SQL),
+        ),
+        migrations.RunPython(build_documents, migrations.RunPython.noop),
+    ]
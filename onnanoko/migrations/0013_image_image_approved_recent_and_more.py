@@ -0,0 +1,21 @@
+# Generated by Django 4.2.30 on 2026-10-17 19:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('onnanoko', '0012_searchdocument'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(condition=models.Q(('is_approved', True)), fields=['-uploaded_at', '-id'], name='image_approved_recent'),
+        ),
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(condition=models.Q(('is_approved', False)), fields=['-uploaded_at', '-id'], name='image_pending_recent'),
+        ),
+    ]
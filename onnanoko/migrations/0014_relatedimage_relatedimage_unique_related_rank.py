@@ -0,0 +1,28 @@
+# Generated by Django 4.2.30 on 2026-10-17 19:22
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('onnanoko', '0013_image_image_approved_recent_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RelatedImage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rank', models.PositiveSmallIntegerField()),
+                ('score', models.FloatField()),
+                ('image', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='related_rows', to='onnanoko.image')),
+                ('related', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='onnanoko.image')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='relatedimage',
+            constraint=models.UniqueConstraint(fields=('image', 'rank'), name='unique_related_rank'),
+        ),
+    ]
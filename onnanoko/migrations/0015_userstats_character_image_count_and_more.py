@@ -0,0 +1,105 @@
+# Generated by Django 4.2.30 on 2026-10-17 19:32
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+import django.db.models.deletion
+
+
+def count(rows, column, counted):
+    counts = rows.filter(**{column: OuterRef('pk')}).order_by().values(column).annotate(n=Count(counted, distinct=True)).values('n')
+    return Coalesce(Subquery(counts, output_field=models.IntegerField()), 0)
+
+
+def fill_counters(apps, schema_editor):
+    User = apps.get_model(settings.AUTH_USER_MODEL)
+    Image = apps.get_model('onnanoko', 'Image')
+    Character = apps.get_model('onnanoko', 'Character')
+    UserStats = apps.get_model('onnanoko', 'UserStats')
+    UserStats.objects.bulk_create([UserStats(user_id=pk) for pk in User.objects.values_list('pk', flat=True)], batch_size=2000)
+    tags, characters = Image.tags.through.objects, Image.characters.through.objects
+    for name, rows, column in (
+        ('Tag', tags, 'tag_id'), ('Character', characters, 'character_id'),
+        ('Series', characters, 'character__series'), ('Group', characters, 'character__groups'),
+    ):
+        apps.get_model('onnanoko', name).objects.update(
+            image_count=count(rows.filter(image__is_approved=True), column, 'image_id'),
+            pending_image_count=count(rows.filter(image__is_approved=False), column, 'image_id'),
+        )
+    apps.get_model('onnanoko', 'Series').objects.update(character_count=count(Character.objects.all(), 'series', 'pk'))
+    apps.get_model('onnanoko', 'Group').objects.update(character_count=count(Character.groups.through.objects.all(), 'group_id', 'character_id'))
+    UserStats.objects.update(
+        image_count=count(Image.objects.filter(is_approved=True), 'uploader_id', 'pk'),
+        pending_image_count=count(Image.objects.filter(is_approved=False), 'uploader_id', 'pk'),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('onnanoko', '0014_relatedimage_relatedimage_unique_related_rank'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserStats',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('image_count', models.IntegerField(default=0, editable=False, help_text='Approved images, maintained by counters.py')),
+                ('pending_image_count', models.IntegerField(default=0, editable=False)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='character',
+            name='image_count',
+            field=models.IntegerField(default=0, editable=False, help_text='Approved images, maintained by counters.py'),
+        ),
+        migrations.AddField(
+            model_name='character',
+            name='pending_image_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='group',
+            name='character_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='group',
+            name='image_count',
+            field=models.IntegerField(default=0, editable=False, help_text='Approved images, maintained by counters.py'),
+        ),
+        migrations.AddField(
+            model_name='group',
+            name='pending_image_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='series',
+            name='character_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='series',
+            name='image_count',
+            field=models.IntegerField(default=0, editable=False, help_text='Approved images, maintained by counters.py'),
+        ),
+        migrations.AddField(
+            model_name='series',
+            name='pending_image_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='tag',
+            name='image_count',
+            field=models.IntegerField(default=0, editable=False, help_text='Approved images, maintained by counters.py'),
+        ),
+        migrations.AddField(
+            model_name='tag',
+            name='pending_image_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.2.30 on 2026-10-17 19:37
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('onnanoko', '0015_userstats_character_image_count_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Statistic',
+            fields=[
+                ('name', models.CharField(max_length=32, primary_key=True, serialize=False)),
+                ('value', models.BigIntegerField(default=0)),
+                ('reconciled_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
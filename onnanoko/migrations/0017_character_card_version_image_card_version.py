@@ -0,0 +1,23 @@
+# Generated by Django 4.2.30 on 2026-10-17 19:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('onnanoko', '0016_statistic'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='character',
+            name='card_version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='card_version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
@@ -1,15 +1,84 @@
-from django.db import models
+import os
+import random
+import uuid
+
+from django.db import models, transaction
 from django.contrib.auth import get_user_model
 from django.utils.text import slugify
 from django.core.validators import MinValueValidator
 from django.utils import timezone
 
+from .imaging import dhash, probe_image, sha256_file
+from .storage import character_upload_to, image_upload_to
+from .thumbnails import ThumbnailSet, delete_thumbnails, open_source, render_placeholder, render_thumbnails
+
 User = get_user_model()
 
-class Series(models.Model):
+class CountedModel(models.Model):
+    """A model with counters that only counters.py writes, with F() updates.
+
+    Saving an instance loaded before those updates would write its stale
+    counts back, so updates leave the counter columns out.
+    """
+    COUNTER_FIELDS = {'image_count', 'pending_image_count', 'character_count'}
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding and not args and kwargs.get('update_fields') is None and not kwargs.get('force_insert'):
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.COUNTER_FIELDS
+            ]
+        super().save(*args, **kwargs)
+
+    class Meta:
+        abstract = True
+
+def new_card_version():
+    return random.getrandbits(31)
+
+class CardModel(models.Model):
+    """A model shown as a card whose rendering is cached under its card_version (see cards.py).
+
+    Every save stamps a new version and updated_at, update_fields or not.
+    Changes that do not go through save() (links, renamed relations) are
+    stamped by touch(). Stamps are random rather than incremented, so a save
+    of an instance loaded before such an update cannot reuse a version
+    already cached.
+    """
+    card_version = models.PositiveIntegerField(default=0, editable=False)
+
+    def save(self, *args, **kwargs):
+        self.card_version = new_card_version()
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = {*kwargs['update_fields'], 'card_version', 'updated_at'}
+        super().save(*args, **kwargs)
+
+    class Meta:
+        abstract = True
+
+def touch(model, ids=None, **lookups):
+    """Mark ``model`` rows ``ids`` (or those matching ``lookups``) changed without saving them, in one UPDATE.
+
+    Moves updated_at, and card_version where the model has one.
+    """
+    if ids is not None:
+        ids = set(ids)
+        if not ids:
+            return 0
+        lookups['pk__in'] = ids
+    changes = {'updated_at': timezone.now()}
+    if issubclass(model, CardModel):
+        changes['card_version'] = new_card_version()
+    return model.objects.filter(**lookups).update(**changes)
+
+class Series(CountedModel):
     name = models.CharField(max_length=128, unique=True)
     slug = models.SlugField(max_length=128, unique=True)
     description = models.TextField(blank=True)
+    image_count = models.IntegerField(default=0, editable=False, help_text="Approved images, maintained by counters.py")
+    pending_image_count = models.IntegerField(default=0, editable=False)
+    character_count = models.IntegerField(default=0, editable=False)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     def save(self, *args, **kwargs):
         if not self.slug:
@@ -22,10 +91,14 @@ class Series(models.Model):
     class Meta:
         indexes = [models.Index(fields=['slug'])]
 
-class Group(models.Model):
+class Group(CountedModel):
     name = models.CharField(max_length=128, unique=True)
     slug = models.SlugField(max_length=128, unique=True)
     description = models.TextField(blank=True)
+    image_count = models.IntegerField(default=0, editable=False, help_text="Approved images, maintained by counters.py")
+    pending_image_count = models.IntegerField(default=0, editable=False)
+    character_count = models.IntegerField(default=0, editable=False)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     def save(self, *args, **kwargs):
         if not self.slug:
@@ -38,9 +111,12 @@ class Group(models.Model):
     class Meta:
         indexes = [models.Index(fields=['slug'])]
 
-class Tag(models.Model):
+class Tag(CountedModel):
     name = models.CharField(max_length=64, unique=True)
     slug = models.SlugField(max_length=64, unique=True)
+    image_count = models.IntegerField(default=0, editable=False, help_text="Approved images, maintained by counters.py")
+    pending_image_count = models.IntegerField(default=0, editable=False)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     def save(self, *args, **kwargs):
         if not self.slug:
@@ -53,7 +129,7 @@ class Tag(models.Model):
     class Meta:
         indexes = [models.Index(fields=['slug'])]
 
-class Character(models.Model):
+class Character(CountedModel, CardModel):
     name = models.CharField(max_length=128)
     slug = models.SlugField(max_length=128, unique=True, blank=True)
     birth_date = models.DateField(null=True, blank=True)
@@ -68,16 +144,56 @@ class Character(models.Model):
     groups = models.ManyToManyField(Group, blank=True, related_name='characters')
     tags = models.ManyToManyField(Tag, blank=True, related_name='characters')
     description = models.TextField(blank=True)
-    primary_image = models.ImageField(upload_to='characters/', null=True, blank=True)
+    primary_image = models.ImageField(upload_to=character_upload_to, null=True, blank=True)
+    primary_image_derivatives = models.JSONField(default=dict, blank=True, editable=False)
+    primary_image_placeholder = models.TextField(blank=True, editable=False)
+    primary_image_color = models.CharField(max_length=7, blank=True, editable=False)
+    image_count = models.IntegerField(default=0, editable=False, help_text="Approved images, maintained by counters.py")
+    pending_image_count = models.IntegerField(default=0, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
-    updated_at = models.DateTimeField(auto_now=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     def save(self, *args, **kwargs):
         if not self.slug:
             self.slug = slugify(self.name)
         if self.age and self.birth_date:
             raise ValueError('Provide either age or birth_date, not both.')
+        if self.primary_image and not self.primary_image._committed:
+            upload = self.primary_image.file
+            self.primary_image.save(self.primary_image.name, upload, save=False)
+            self._analyse_primary_image(upload)
         super().save(*args, **kwargs)
+        source = self.primary_image.name if self.primary_image else None
+        if self.primary_image_derivatives.get('source') != source:
+            if source:
+                with self.primary_image.storage.open(source, 'rb') as fh:
+                    self._analyse_primary_image(fh)
+            else:
+                self.primary_image_derivatives, self.primary_image_placeholder, self.primary_image_color = {}, '', ''
+            super().save(update_fields=['primary_image_derivatives', 'primary_image_placeholder', 'primary_image_color'])
+        release_thumbnails(getattr(self, '_stored_derivatives', None), keep=source)
+        self._stored_derivatives = self.primary_image_derivatives
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # The thumbnails a save that changes the portrait leaves behind.
+        instance._stored_derivatives = instance.__dict__.get('primary_image_derivatives')
+        return instance
+
+    def _analyse_primary_image(self, fh):
+        fh.seek(0)
+        _, _, img = open_source(fh)
+        with img:
+            self.primary_image_derivatives = render_thumbnails(img, self.primary_image.name, self.primary_image.storage)
+            self.primary_image_placeholder, self.primary_image_color = render_placeholder(img)
+
+    @property
+    def primary_thumbnails(self):
+        return ThumbnailSet(
+            self.primary_image_derivatives, self.primary_image,
+            placeholder=self.primary_image_placeholder, color=self.primary_image_color,
+        )
 
     def __str__(self):
         return self.name
@@ -86,8 +202,20 @@ class Character(models.Model):
         indexes = [models.Index(fields=['slug'])]
         unique_together = ('name', 'series')
 
-class Image(models.Model):
-    file = models.ImageField(upload_to='images/')
+# Fields filled in by Image._analyse.
+ANALYSED_FIELDS = ['width', 'height', 'phash', 'derivatives', 'placeholder', 'dominant_color']
+
+class Image(CardModel):
+    PROCESSING, READY, FAILED = 'processing', 'ready', 'failed'
+    STATUS_CHOICES = [
+        (PROCESSING, 'Processing'),
+        (READY, 'Ready'),
+        (FAILED, 'Failed'),
+    ]
+
+    file = models.ImageField(upload_to=image_upload_to)
+    sha256 = models.CharField(max_length=64, blank=True, db_index=True, editable=False)
+    phash = models.BigIntegerField(null=True, blank=True, editable=False, help_text="64-bit perceptual (difference) hash")
     uploader = models.ForeignKey(User, on_delete=models.CASCADE, related_name='uploaded_images')
     uploaded_at = models.DateTimeField(auto_now_add=True)
     characters = models.ManyToManyField(Character, related_name='images', blank=True)
@@ -97,20 +225,236 @@ class Image(models.Model):
     is_approved = models.BooleanField(default=False)
     description = models.TextField(blank=True)
     illustrator = models.CharField(max_length=128, blank=True, help_text="Name of the artist/illustrator")
+    format = models.CharField(max_length=16, blank=True)
+    derivatives = models.JSONField(default=dict, blank=True, editable=False)
+    placeholder = models.TextField(blank=True, editable=False, help_text="Inline data URI of a tiny preview")
+    dominant_color = models.CharField(max_length=7, blank=True, editable=False)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=READY, db_index=True, editable=False)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     def save(self, *args, **kwargs):
+        deferred = False
+        if self.file and not self.file._committed:
+            deferred = self._prepare_upload()
         super().save(*args, **kwargs)
-        if self.file and (not self.width or not self.height):
-            from PIL import Image as PILImage
-            import os
-            img_path = self.file.path
-            with PILImage.open(img_path) as img:
-                self.width, self.height = img.size
-            super().save(update_fields=['width', 'height'])
+        if deferred:
+            Job.enqueue('image.process', image_id=self.pk)
+        elif self.file and self.status == self.READY and (
+            not self.width or not self.height or self.derivatives.get('source') != self.file.name
+        ):
+            # Rows whose file was written outside save(), e.g. by older code.
+            with self.file.storage.open(self.file.name, 'rb') as fh:
+                self._analyse(fh)
+            super().save(update_fields=ANALYSED_FIELDS)
+        release_thumbnails(getattr(self, '_stored_derivatives', None), keep=self.derivatives.get('source'))
+        self._stored_derivatives = self.derivatives
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # The thumbnails a save that changes the file leaves behind.
+        instance._stored_derivatives = instance.__dict__.get('derivatives')
+        return instance
+
+    def _prepare_upload(self):
+        """Fill in everything derived from a new upload so the row is written once.
+
+        Images saved with status PROCESSING only get the header probe and hash
+        here; the decode is left to the job queue. Returns True in that case.
+        """
+        upload = self.file.file
+        self.width, self.height, self.format = probe_image(upload)
+        self.sha256 = sha256_file(upload)
+        name = self.file.field.generate_filename(self, os.path.basename(self.file.name))
+        if self.file.storage.exists(name):
+            # Identical bytes are already stored: share the blob and its derivatives.
+            self.file = name
+            twins = Image.objects.filter(sha256=self.sha256).values_list('phash', 'derivatives', 'placeholder', 'dominant_color')
+            for phash, derivatives, placeholder, color in twins:
+                if derivatives.get('source') == name:
+                    self.phash, self.derivatives, self.placeholder, self.dominant_color = phash, derivatives, placeholder, color
+                    self.status = self.READY
+                    return False
+        else:
+            self.file.save(self.file.name, upload, save=False)
+        if self.status == self.PROCESSING:
+            return True
+        upload.seek(0)
+        self._analyse(upload)
+        return False
+
+    def _analyse(self, fh):
+        """Decode the source once for its size, perceptual hash, derivatives and placeholder."""
+        self.width, self.height, img = open_source(fh)
+        with img:
+            self.phash = dhash(img)
+            self.derivatives = render_thumbnails(img, self.file.name, self.file.storage)
+            self.placeholder, self.dominant_color = render_placeholder(img)
+
+    @classmethod
+    def create_uploads(cls, images, characters=(), tags=()):
+        """Insert several new uploads, with their characters and tags, in one query per table."""
+        deferred = [image for image in images if image._prepare_upload()]
+        with transaction.atomic():
+            cls.objects.bulk_create(images)
+            Job.objects.bulk_create([Job(kind='image.process', payload={'image_id': image.pk}) for image in deferred])
+            cls.characters.through.objects.bulk_create([
+                cls.characters.through(image_id=image.pk, character_id=character.pk)
+                for image in images for character in characters
+            ])
+            cls.tags.through.objects.bulk_create([
+                cls.tags.through(image_id=image.pk, tag_id=tag.pk)
+                for image in images for tag in tags
+            ])
+            # bulk_create sends no signals, so index the batch here.
+            from .search import index
+            from .tag_query import tag_index
+            from . import counters, page_cache, related
+            counters.added(images)
+            index(SearchDocument.IMAGE, [image.pk for image in images])
+            tag_index.changed([image.pk for image in images if image.is_approved])
+            related.changed([image.pk for image in images if image.is_approved])
+            page_cache.changed(cls, [image.pk for image in images if image.is_approved])
+        return images
+
+    @classmethod
+    def find_duplicate(cls, upload):
+        """Return an existing Image with exactly the same bytes as upload, if any."""
+        return cls.objects.filter(sha256=sha256_file(upload)).order_by('pk').first()
+
+    @property
+    def thumbnails(self):
+        return ThumbnailSet(self.derivatives, self.file, placeholder=self.placeholder, color=self.dominant_color)
 
     def __str__(self):
         return f"Image {self.id} by {self.uploader}"
 
+    class Meta:
+        indexes = [
+            # Keyset pagination of the gallery and the pending queue (see pagination.py).
+            # Partial rather than led by is_approved: SQLite cannot seek on a bare boolean column.
+            models.Index(fields=['-uploaded_at', '-id'], condition=models.Q(is_approved=True), name='image_approved_recent'),
+            models.Index(fields=['-uploaded_at', '-id'], condition=models.Q(is_approved=False), name='image_pending_recent'),
+        ]
+
+def release_thumbnails(derivatives, keep=None):
+    """Delete the thumbnails of ``derivatives`` once the transaction commits, unless they are ``keep``'s.
+
+    Identical uploads share one stored source and its thumbnails, so they
+    are kept while any image or portrait still shows that source.
+    """
+    source = (derivatives or {}).get('source')
+    if not source or source == keep:
+        return
+
+    def delete():
+        if not Image.objects.filter(file=source).exists() and not Character.objects.filter(primary_image=source).exists():
+            delete_thumbnails(derivatives)
+
+    transaction.on_commit(delete)
+
+class RelatedImage(models.Model):
+    """One of an image's precomputed most similar images (see related.py)."""
+    image = models.ForeignKey(Image, on_delete=models.CASCADE, related_name='related_rows')
+    related = models.ForeignKey(Image, on_delete=models.CASCADE, related_name='+')
+    rank = models.PositiveSmallIntegerField()
+    score = models.FloatField()
+
+    def __str__(self):
+        return f"{self.image_id} ~ {self.related_id} (#{self.rank})"
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['image', 'rank'], name='unique_related_rank')]
+
+class UserStats(models.Model):
+    """Per-user upload counts, kept current by counters.py."""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='stats')
+    image_count = models.IntegerField(default=0, editable=False, help_text="Approved images, maintained by counters.py")
+    pending_image_count = models.IntegerField(default=0, editable=False)
+
+    def __str__(self):
+        return f"Stats for {self.user_id}"
+
+class Statistic(models.Model):
+    """A site-wide total for the dashboards, moved by deltas and reconciled (see stats.py)."""
+    name = models.CharField(max_length=32, primary_key=True)
+    value = models.BigIntegerField(default=0)
+    reconciled_at = models.DateTimeField(default=timezone.now)
+    changed_at = models.DateTimeField(default=timezone.now, help_text="Last time the value moved; deletions show up here")
+
+    def __str__(self):
+        return f"{self.name} = {self.value}"
+
+class SearchDocument(models.Model):
+    """Denormalized text of a Character or Image for full-text search (see search.py).
+
+    The database-specific index (FTS5 table or tsvector column) is created by
+    migration and maintained from these rows.
+    """
+    CHARACTER, IMAGE = 'character', 'image'
+    KIND_CHOICES = [(CHARACTER, 'Character'), (IMAGE, 'Image')]
+
+    kind = models.CharField(max_length=16, choices=KIND_CHOICES)
+    object_id = models.PositiveBigIntegerField()
+    title = models.TextField(blank=True)
+    body = models.TextField(blank=True)
+
+    def __str__(self):
+        return f"{self.kind} {self.object_id}"
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['kind', 'object_id'], name='unique_search_document')]
+
+class UploadSession(models.Model):
+    """A resumable upload: byte ranges are written to a temp file until finalized."""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    uploader = models.ForeignKey(User, on_delete=models.CASCADE, related_name='upload_sessions')
+    filename = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=100, blank=True)
+    size = models.PositiveBigIntegerField()
+    sha256 = models.CharField(max_length=64)
+    received = models.JSONField(default=list, blank=True, help_text="Sorted, merged [start, end) byte ranges")
+    image = models.ForeignKey(Image, null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    @property
+    def received_bytes(self):
+        return sum(end - start for start, end in self.received)
+
+    def __str__(self):
+        return f"Upload {self.pk} of {self.filename}"
+
+class Job(models.Model):
+    """A unit of background work, claimed and run by the run_worker command."""
+    QUEUED, RUNNING, FAILED = 'queued', 'running', 'failed'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (FAILED, 'Failed'),
+    ]
+
+    kind = models.CharField(max_length=64)
+    payload = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=3)
+    run_after = models.DateTimeField(default=timezone.now)
+    locked_by = models.CharField(max_length=128, blank=True)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    @classmethod
+    def enqueue(cls, kind, **payload):
+        return cls.objects.create(kind=kind, payload=payload)
+
+    def __str__(self):
+        return f"{self.kind} #{self.pk} ({self.status})"
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'run_after'])]
+
 class SiteSetting(models.Model):
     allow_self_registration = models.BooleanField(default=True)
 
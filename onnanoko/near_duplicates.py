@@ -0,0 +1,154 @@
+import itertools
+import threading
+import time
+
+from django.conf import settings
+
+MASK64 = (1 << 64) - 1
+BANDS = 4
+BAND_BITS = 64 // BANDS
+BAND_MASK = (1 << BAND_BITS) - 1
+
+
+def hamming(a, b):
+    return ((a ^ b) & MASK64).bit_count()
+
+
+def _flip_masks(bits, radius):
+    masks = []
+    for r in range(radius + 1):
+        for positions in itertools.combinations(range(bits), r):
+            mask = 0
+            for position in positions:
+                mask |= 1 << position
+            masks.append(mask)
+    return masks
+
+
+class MultiIndexHash:
+    """Multi-index hashing over 64-bit perceptual hashes.
+
+    Each hash is split into four 16-bit bands with one exact-match table per
+    band. Two hashes within distance ``r`` must agree to within ``r // 4``
+    bits on at least one band (pigeonhole), so a query only probes the band
+    values within that sub-radius and verifies the few candidates it finds.
+    """
+
+    def __init__(self):
+        self.hashes = {}
+        self.tables = [{} for _ in range(BANDS)]
+        self._masks = {}
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def add(self, item_id, value):
+        value &= MASK64
+        if item_id in self.hashes:
+            self.discard(item_id)
+        self.hashes[item_id] = value
+        for band, table in enumerate(self.tables):
+            table.setdefault((value >> (band * BAND_BITS)) & BAND_MASK, []).append(item_id)
+
+    def discard(self, item_id):
+        value = self.hashes.pop(item_id, None)
+        if value is None:
+            return
+        for band, table in enumerate(self.tables):
+            key = (value >> (band * BAND_BITS)) & BAND_MASK
+            bucket = table.get(key)
+            if bucket is not None:
+                bucket.remove(item_id)
+                if not bucket:
+                    del table[key]
+
+    def search(self, value, radius):
+        """Return [(distance, item_id), ...] within radius, closest first."""
+        value &= MASK64
+        masks = self._masks.get(radius // BANDS)
+        if masks is None:
+            masks = self._masks[radius // BANDS] = _flip_masks(BAND_BITS, radius // BANDS)
+        seen = set()
+        found = []
+        hashes = self.hashes
+        for band, table in enumerate(self.tables):
+            key = (value >> (band * BAND_BITS)) & BAND_MASK
+            for mask in masks:
+                for item_id in table.get(key ^ mask, ()):
+                    if item_id in seen:
+                        continue
+                    seen.add(item_id)
+                    distance = ((hashes[item_id] ^ value)).bit_count()
+                    if distance <= radius:
+                        found.append((distance, item_id))
+        found.sort()
+        return found
+
+
+class NearDuplicateIndex:
+    """Process-local index of every Image.phash, built lazily from the database.
+
+    Rows added by other processes are picked up by a cheap ``id > last seen``
+    query before each lookup, and the whole index is rebuilt after
+    NEAR_DUPLICATE_INDEX_TTL seconds to catch backfilled or deleted rows.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.index = None
+        self.last_id = 0
+        self.built_at = 0.0
+
+    def rebuild(self):
+        from .models import Image
+        index = MultiIndexHash()
+        last_id = 0
+        for item_id, value in Image.objects.exclude(phash=None).order_by('pk').values_list('pk', 'phash').iterator(chunk_size=10000):
+            index.add(item_id, value)
+            last_id = item_id
+        with self.lock:
+            self.index, self.last_id, self.built_at = index, last_id, time.monotonic()
+
+    def refresh(self):
+        from .models import Image
+        ttl = getattr(settings, 'NEAR_DUPLICATE_INDEX_TTL', 3600)
+        if self.index is None or time.monotonic() - self.built_at > ttl:
+            self.rebuild()
+            return
+        new_rows = Image.objects.filter(pk__gt=self.last_id).exclude(phash=None).order_by('pk').values_list('pk', 'phash')
+        with self.lock:
+            for item_id, value in new_rows:
+                self.index.add(item_id, value)
+                self.last_id = item_id
+
+    def candidates(self, images, radius=None):
+        """Map image id -> [(distance, other id), ...] for each image with a phash."""
+        if radius is None:
+            radius = getattr(settings, 'NEAR_DUPLICATE_DISTANCE', 10)
+        self.refresh()
+        result = {}
+        for image in images:
+            if image.phash is None:
+                result[image.pk] = []
+                continue
+            result[image.pk] = [(d, other) for d, other in self.index.search(image.phash, radius) if other != image.pk]
+        return result
+
+
+near_duplicate_index = NearDuplicateIndex()
+
+
+def attach_near_duplicates(images, radius=None, limit=6, queryset=None):
+    """Set ``image.near_duplicates`` to a list of (distance, Image) for each image.
+
+    The matches are loaded through ``queryset`` when given, so callers can
+    prefetch what they display.
+    """
+    from .models import Image
+    images = list(images)
+    matches = near_duplicate_index.candidates(images, radius)
+    wanted = {other for found in matches.values() for _, other in found[:limit]}
+    by_id = (Image.objects.all() if queryset is None else queryset).in_bulk(wanted)
+    for image in images:
+        image.near_duplicates = [(d, by_id[other]) for d, other in matches[image.pk][:limit] if other in by_id]
+    return images
@@ -0,0 +1,168 @@
+import hashlib
+import uuid
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import parse_http_date_safe
+
+PAGE_PREFIX = 'onnanoko:page:'
+TOKEN_PREFIX = 'onnanoko:page-token:'
+# Every page depends on the site settings through the base template.
+SITE = 'site'
+# Response headers kept with a page.
+HEADERS = ('Content-Type', 'ETag', 'Last-Modified', 'Cache-Control', 'Vary')
+
+
+def enabled():
+    return getattr(settings, 'PAGE_CACHE_TIMEOUT', 0) > 0
+
+
+def pages():
+    return caches[getattr(settings, 'PAGE_CACHE_ALIAS', 'pages')]
+
+
+def shared():
+    """Whether every process sees the same page cache (a LocMemCache is one per process)."""
+    return not isinstance(pages(), LocMemCache)
+
+
+def name(kind, pk):
+    """The dependency name of one row, e.g. ``name('image', 5) == 'image:5'``."""
+    return f'{kind}:{pk}'
+
+
+def key(request):
+    """Cache key of an anonymous GET: its URL with blank parameters dropped and the rest sorted."""
+    params = sorted((param, value) for param, values in request.GET.lists() for value in values if value)
+    url = request.build_absolute_uri(request.path)
+    if params:
+        url = f'{url}?{urlencode(params)}'
+    return PAGE_PREFIX + hashlib.md5(url.encode(), usedforsecurity=False).hexdigest()
+
+
+def cacheable(request):
+    return enabled() and request.method in ('GET', 'HEAD') and not request.user.is_authenticated
+
+
+def tokens(names, create=False):
+    """{name: token} of the dependencies that have one; ``create`` gives the others one."""
+    cache = pages()
+    keys = {TOKEN_PREFIX + dependency: dependency for dependency in names}
+    found = cache.get_many(keys)
+    missing = [token_key for token_key in keys if token_key not in found]
+    if create and missing:
+        for token_key in missing:
+            cache.add(token_key, uuid.uuid4().hex, None)
+        found.update(cache.get_many(missing))
+    return {keys[token_key]: token for token_key, token in found.items()}
+
+
+def get(page_key):
+    """The stored response for ``page_key`` if none of its dependencies changed since."""
+    entry = pages().get(page_key)
+    if entry is None:
+        return None
+    stamped, content, headers = entry
+    if tokens(stamped) != stamped:
+        return None
+    return HttpResponse(content, headers=headers)
+
+
+def store(page_key, response, names):
+    """Keep a 200 response that sets no cookies, stamped with the current tokens of ``names``."""
+    if response.status_code != 200 or response.cookies or response.streaming:
+        return
+    stamped = tokens({SITE, *names}, create=True)
+    headers = {header: response[header] for header in HEADERS if response.has_header(header)}
+    pages().set(page_key, (stamped, response.content, headers), settings.PAGE_CACHE_TIMEOUT)
+
+
+def purge(*names):
+    """Give ``names`` new tokens, so every page stored under the old ones is stale.
+
+    Done at once and again when the transaction commits: a page rendered in
+    between from the old rows would otherwise be stored under the new tokens.
+    """
+    if not enabled() or not names:
+        return
+
+    def replace():
+        pages().set_many({TOKEN_PREFIX + dependency: uuid.uuid4().hex for dependency in names}, None)
+
+    replace()
+    transaction.on_commit(replace)
+
+
+def dependencies(model, ids):
+    """Names of everything shown next to ``model`` rows ``ids`` (an Image or a Character).
+
+    An image appears on the galleries and the pages of its characters, their
+    series and groups, and its tags; a character on the character lists and
+    the pages of its series, groups and tags.
+    """
+    from .models import Character, Image
+    ids = set(ids)
+    if not ids:
+        return set()
+    kind = model._meta.model_name
+    found = {'images' if model is Image else 'characters'}
+    found.update(name(kind, pk) for pk in ids)
+    if model is Image:
+        characters = Image.characters.through.objects.filter(image_id__in=ids).values_list('character_id', 'character__series_id', 'character__groups')
+        tags = Image.tags.through.objects.filter(image_id__in=ids).values_list('tag_id', flat=True)
+    else:
+        characters = Character.objects.filter(pk__in=ids).values_list('pk', 'series_id', 'groups')
+        tags = Character.tags.through.objects.filter(character_id__in=ids).values_list('tag_id', flat=True)
+    for character_id, series_id, group_id in characters:
+        found.add(name('character', character_id))
+        if series_id is not None:
+            found.add(name('series', series_id))
+        if group_id is not None:
+            found.add(name('group', group_id))
+    found.update(name('tag', pk) for pk in tags)
+    return found
+
+
+def changed(model, ids):
+    """``model`` rows ``ids`` (Images or Characters) changed: purge the pages that show them."""
+    if enabled():
+        purge(*dependencies(model, ids))
+
+
+class CachedPageMixin:
+    """Serve anonymous GETs from the page cache.
+
+    Views name what a rendered page shows in ``page_dependencies(context)``
+    (``context`` is empty for responses without a template); the signal
+    handlers purge those names when the rows change. Pages are kept for
+    PAGE_CACHE_TIMEOUT seconds at most, with their validators: a hit whose
+    ETag or Last-Modified the client already has is answered with a 304.
+    """
+
+    def page_dependencies(self, context):
+        return ()
+
+    def dispatch(self, request, *args, **kwargs):
+        if not cacheable(request):
+            return super().dispatch(request, *args, **kwargs)
+        page_key = key(request)
+        response = get(page_key)
+        if response is not None:
+            return get_conditional_response(
+                request, etag=response.get('ETag'), last_modified=parse_http_date_safe(response.get('Last-Modified', '')), response=response,
+            )
+        response = super().dispatch(request, *args, **kwargs)
+
+        def remember(response):
+            store(page_key, response, self.page_dependencies(getattr(response, 'context_data', None) or {}))
+
+        if getattr(response, 'is_rendered', True):
+            remember(response)
+        else:
+            response.add_post_render_callback(remember)
+        return response
@@ -0,0 +1,285 @@
+import base64
+import binascii
+import json
+from functools import cached_property
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import connections
+from django.db.models import Q, QuerySet
+from django.http import Http404
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+IMAGE_ORDERING = ('-uploaded_at', '-id')
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(values, reverse=False):
+    raw = json.dumps([[str(value) for value in values], reverse], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token, width):
+    """Return (values, reverse) from a token made by encode_cursor."""
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        values, reverse = json.loads(raw)
+    except (binascii.Error, UnicodeDecodeError, ValueError, TypeError):
+        raise InvalidCursor('Invalid cursor.')
+    if not isinstance(values, list) or len(values) != width or not isinstance(reverse, bool):
+        raise InvalidCursor('Invalid cursor.')
+    return values, reverse
+
+
+def approximate_count(queryset):
+    """Row count from the planner's estimate where the database offers one.
+
+    Postgres estimates come from EXPLAIN and are only trusted above
+    PAGINATION_EXACT_COUNT_LIMIT rows; below that, and on other databases,
+    an exact COUNT(*) is cheap enough. Returns (count, is_approximate).
+    """
+    connection = connections[queryset.db]
+    if connection.vendor == 'postgresql':
+        sql, params = queryset.order_by().values('pk').query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        estimate = int(plan[0]['Plan']['Plan Rows'])
+        if estimate >= settings.PAGINATION_EXACT_COUNT_LIMIT:
+            return estimate, True
+    return queryset.count(), False
+
+
+class CursorPaginator:
+    """Keyset pagination over a unique, non-null ordering such as (uploaded_at, id).
+
+    Each page is one ``WHERE (uploaded_at, id) < (last seen)`` query, so
+    page 2000 costs the same as page 1 and no total count is needed. The
+    count is only computed if asked for, approximately when ``approximate``.
+    """
+
+    def __init__(self, queryset, per_page, ordering=IMAGE_ORDERING, approximate=False):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.fields = [(name.lstrip('-'), name.startswith('-')) for name in ordering]
+        self.approximate = approximate
+
+    @cached_property
+    def _count(self):
+        if self.approximate:
+            return approximate_count(self.queryset)
+        return self.queryset.count(), False
+
+    @property
+    def count(self):
+        return self._count[0]
+
+    @property
+    def count_is_approximate(self):
+        return self._count[1]
+
+    def _ordering(self, reverse):
+        return [f'{"-" if descending != reverse else ""}{name}' for name, descending in self.fields]
+
+    def _after(self, values, reverse):
+        """Rows strictly after ``values`` in the (possibly reversed) ordering."""
+        condition = Q()
+        for i, (name, descending) in enumerate(self.fields):
+            lookup = 'lt' if descending != reverse else 'gt'
+            step = Q(**{f'{name}__{lookup}': values[i]})
+            for j in range(i):
+                step &= Q(**{self.fields[j][0]: values[j]})
+            condition |= step
+        # The redundant bound on the leading column lets the index be range-scanned.
+        name, descending = self.fields[0]
+        return Q(**{f'{name}__{"lte" if descending != reverse else "gte"}': values[0]}) & condition
+
+    def values(self, obj):
+        return [getattr(obj, name) for name, _ in self.fields]
+
+    def page(self, cursor=None):
+        reverse = False
+        qs = self.queryset
+        if cursor:
+            values, reverse = decode_cursor(cursor, len(self.fields))
+            try:
+                qs = qs.filter(self._after(values, reverse))
+            except (TypeError, ValueError, ValidationError):
+                raise InvalidCursor('Invalid cursor.')
+        rows = list(qs.order_by(*self._ordering(reverse))[:self.per_page + 1])
+        more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if reverse:
+            rows.reverse()
+            return CursorPage(rows, self, has_next=True, has_previous=more)
+        return CursorPage(rows, self, has_next=more, has_previous=bool(cursor))
+
+
+class CursorPage:
+    is_cursor = True
+
+    def __init__(self, object_list, paginator, has_next, has_previous):
+        self.object_list = object_list
+        self.paginator = paginator
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self):
+        return self._has_next and bool(self.object_list)
+
+    def has_previous(self):
+        return self._has_previous and bool(self.object_list)
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    @property
+    def next_cursor(self):
+        return encode_cursor(self.paginator.values(self.object_list[-1])) if self.has_next() else None
+
+    @property
+    def previous_cursor(self):
+        return encode_cursor(self.paginator.values(self.object_list[0]), reverse=True) if self.has_previous() else None
+
+
+class PositionPaginator:
+    """Pages of an already ordered sequence, such as ranked search results, by ``?cursor=``.
+
+    The cursor holds a position: there is no key to seek by, and the
+    sequence only fetches the rows of the slice asked for.
+    """
+
+    def __init__(self, results, per_page):
+        self.results = results
+        self.per_page = per_page
+
+    def page(self, cursor=None):
+        start = 0
+        if cursor:
+            (value,), _ = decode_cursor(cursor, 1)
+            try:
+                start = int(value)
+            except ValueError:
+                raise InvalidCursor('Invalid cursor.')
+            if start < 0:
+                raise InvalidCursor('Invalid cursor.')
+        rows = list(self.results[start:start + self.per_page + 1])
+        more = len(rows) > self.per_page
+        return PositionPage(rows[:self.per_page], self, start, has_next=more)
+
+
+class PositionPage(CursorPage):
+    def __init__(self, object_list, paginator, start, has_next):
+        super().__init__(object_list, paginator, has_next=has_next, has_previous=start > 0)
+        self.start = start
+        # Ranked search results that stopped at SEARCH_MAX_RESULTS.
+        self.truncated = getattr(paginator.results, 'truncated', False)
+
+    @property
+    def next_cursor(self):
+        return encode_cursor([self.start + len(self.object_list)]) if self.has_next() else None
+
+    @property
+    def previous_cursor(self):
+        return encode_cursor([max(0, self.start - self.paginator.per_page)]) if self._has_previous else None
+
+
+class CursorPaginationMixin:
+    """ListView pagination by ``?cursor=`` for querysets; ranked results keep page numbers."""
+
+    cursor_ordering = IMAGE_ORDERING
+    approximate_count = True
+
+    def paginate_queryset(self, queryset, page_size):
+        if not isinstance(queryset, QuerySet):
+            return super().paginate_queryset(queryset, page_size)
+        paginator = CursorPaginator(queryset, page_size, self.cursor_ordering, self.approximate_count)
+        try:
+            page = paginator.page(self.request.GET.get('cursor'))
+        except InvalidCursor:
+            raise Http404('Invalid cursor.')
+        return paginator, page, page.object_list, page.has_other_pages()
+
+
+class CursorPagination(BasePagination):
+    """DRF pagination with the same cursors; every list is paged.
+
+    Responses look like ``{"next": url, "previous": url, "results": [...]}``.
+    Querysets are paged by key in their ``?ordering=`` if one was asked for,
+    else in the view's ``cursor_ordering`` (``ordering`` by default), with
+    the primary key appended to break ties. Ranked search results are
+    paged by position, and their responses add ``"truncated": true`` when
+    only the best SEARCH_MAX_RESULTS matches are listed.
+    """
+
+    ordering = ('id',)
+    page_size = 24
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(size, self.max_page_size))
+
+    def get_ordering(self, queryset, view):
+        ordering = list(queryset.query.order_by)
+        if not ordering or not all(isinstance(name, str) for name in ordering):
+            ordering = list(getattr(view, 'cursor_ordering', self.ordering))
+        if not {'id', 'pk'} & {name.lstrip('-') for name in ordering}:
+            ordering.append('id')
+        return ordering
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        size = self.get_page_size(request)
+        if isinstance(queryset, QuerySet):
+            paginator = CursorPaginator(queryset, size, self.get_ordering(queryset, view))
+        else:
+            paginator = PositionPaginator(queryset, size)
+        try:
+            self.page = paginator.page(request.query_params.get(self.cursor_query_param))
+        except InvalidCursor:
+            raise NotFound('Invalid cursor.')
+        return list(self.page)
+
+    def _link(self, cursor):
+        if cursor is None:
+            return None
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, cursor)
+
+    def get_next_link(self):
+        return self._link(self.page.next_cursor)
+
+    def get_previous_link(self):
+        return self._link(self.page.previous_cursor)
+
+    def get_paginated_response(self, data):
+        body = {
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        }
+        if getattr(self.page, 'truncated', False):
+            body['truncated'] = True
+        return Response(body)
@@ -0,0 +1,41 @@
+from django.db.models import Count, IntegerField, OuterRef, Prefetch, Subquery
+from django.db.models.functions import Coalesce
+
+
+def prefetch_top(lookup, queryset, limit, to_attr):
+    """Prefetch at most ``limit`` rows of ``lookup`` per parent, in ``queryset``'s order.
+
+    Django turns a sliced prefetch queryset into one query that numbers the
+    rows with ROW_NUMBER() OVER (PARTITION BY parent ORDER BY ...) and keeps
+    the first ``limit`` of each partition, so a page of cards loads at most
+    ``limit * page size`` related rows however many exist. ``to_attr`` is
+    required so the partial list is never mistaken for the full relation.
+    """
+    if not queryset.ordered:
+        queryset = queryset.order_by('pk')
+    return Prefetch(lookup, queryset=queryset[:limit], to_attr=to_attr)
+
+
+def related_count(model, relation):
+    """A correlated COUNT of ``model.relation`` rows, for annotating each parent.
+
+    Unlike Count() it needs no join of the parent queryset, so several
+    counts on one queryset do not multiply each other's rows.
+    """
+    field = model._meta.get_field(relation)
+    if field.many_to_many:
+        if field.concrete:
+            through, column = field.remote_field.through, field.m2m_field_name()
+        else:
+            through, column = field.through, field.field.m2m_reverse_field_name()
+        rows = through.objects.filter(**{column: OuterRef('pk')})
+    else:
+        column = field.field.name
+        rows = field.related_model.objects.filter(**{column: OuterRef('pk')})
+    counts = rows.order_by().values(column).annotate(n=Count('*')).values('n')
+    return Coalesce(Subquery(counts, output_field=IntegerField()), 0)
+
+
+def annotate_counts(queryset, **relations):
+    """``annotate_counts(qs, tag_count='tags')`` sets ``obj.tag_count`` on every row."""
+    return queryset.annotate(**{name: related_count(queryset.model, relation) for name, relation in relations.items()})
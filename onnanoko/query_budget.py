@@ -0,0 +1,104 @@
+import logging
+import re
+import time
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger('onnanoko.queries')
+
+IN_LIST = re.compile(r'\(\s*%s(?:\s*,\s*%s)*\s*\)')
+NUMBER = re.compile(r'\b\d+\b')
+
+
+def fingerprint(sql):
+    """The shape of a statement: parameters, IN lists and inlined numbers are blanked."""
+    return NUMBER.sub('?', IN_LIST.sub('(...)', sql))
+
+
+class QueryRecorder:
+    """Record every statement run on any database connection while active.
+
+    Uses connection.execute_wrapper, so it works with DEBUG off and costs one
+    timer call per query.
+    """
+
+    def __init__(self):
+        self.queries = []
+        self._stack = None
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((sql, time.perf_counter() - started))
+
+    def __enter__(self):
+        self._stack = ExitStack()
+        for connection in connections.all():
+            self._stack.enter_context(connection.execute_wrapper(self))
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stack.close()
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def duration(self):
+        return sum(duration for _, duration in self.queries)
+
+    def duplicates(self):
+        """{fingerprint: times run} for statements run more than once, commonest first."""
+        counts = Counter(fingerprint(sql) for sql, _ in self.queries)
+        return {sql: n for sql, n in counts.most_common() if n > 1}
+
+    def report(self):
+        lines = [f'{self.count} queries in {self.duration * 1000:.1f} ms']
+        for sql, n in self.duplicates().items():
+            lines.append(f'  {n}x {sql[:300]}')
+        return '\n'.join(lines)
+
+
+class QueryBudgetMiddleware:
+    """Log the query count, SQL time and repeated statements of every request.
+
+    Requests over QUERY_COUNT_WARNING queries are logged as warnings with the
+    repeated statements; in DEBUG the figures are also sent as X-Query-*
+    response headers.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with QueryRecorder() as recorder:
+            response = self.get_response(request)
+        duplicates = recorder.duplicates()
+        repeated = sum(n - 1 for n in duplicates.values())
+        if recorder.count > getattr(settings, 'QUERY_COUNT_WARNING', 50):
+            logger.warning('%s %s: %s', request.method, request.path, recorder.report())
+        else:
+            logger.info('%s %s: %d queries in %.1f ms, %d repeated',
+                        request.method, request.path, recorder.count, recorder.duration * 1000, repeated)
+        if settings.DEBUG:
+            response['X-Query-Count'] = str(recorder.count)
+            response['X-Query-Time-Ms'] = f'{recorder.duration * 1000:.1f}'
+            response['X-Query-Repeated'] = str(repeated)
+        return response
+
+
+class QueryBudgetMixin:
+    """TestCase mixin: ``with self.assertQueryBudget(5): ...`` fails with the repeated statements listed."""
+
+    @contextmanager
+    def assertQueryBudget(self, budget, msg=''):
+        with QueryRecorder() as recorder:
+            yield recorder
+        if recorder.count > budget:
+            self.fail(f'{msg}{" " if msg else ""}over budget of {budget}: {recorder.report()}')
@@ -0,0 +1,177 @@
+import heapq
+import math
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, Window
+from django.db.models.functions import RowNumber
+
+from . import page_cache
+from .models import Image, Job, RelatedImage
+
+CHARACTER, TAG = 'character', 'tag'
+
+
+def _relations():
+    return ((CHARACTER, Image.characters.through, 'character_id'), (TAG, Image.tags.through, 'tag_id'))
+
+
+def _pairs(image_ids=None):
+    """(image id, (kind, id)) for the characters and tags of approved images."""
+    for kind, through, column in _relations():
+        rows = through.objects.filter(image__is_approved=True)
+        if image_ids is not None:
+            rows = rows.filter(image_id__in=image_ids)
+        for image_id, value in rows.values_list('image_id', column).iterator():
+            yield image_id, (kind, value)
+
+
+def _newest(keys, limit):
+    """(postings of the ``limit`` newest approved images of each of ``keys``, {key: approved images with it}).
+
+    One query per kind: window functions number and count each key's
+    images, so whole posting lists are never read.
+    """
+    postings, counts = defaultdict(list), {}
+    for kind, through, column in _relations():
+        values = [value for key_kind, value in keys if key_kind == kind]
+        if not values:
+            continue
+        rows = through.objects.filter(image__is_approved=True, **{f'{column}__in': values}).annotate(
+            position=Window(RowNumber(), partition_by=F(column), order_by=F('image_id').desc()),
+            count=Window(Count('image_id'), partition_by=F(column)),
+        ).filter(position__lte=limit)
+        for image_id, value, count in rows.values_list('image_id', column, 'count').iterator():
+            postings[(kind, value)].append(image_id)
+            counts[(kind, value)] = count
+    for ids in postings.values():
+        ids.sort(reverse=True)
+    return postings, counts
+
+
+def _postings(pairs):
+    """{key: image ids, newest first} for the given pairs."""
+    postings = defaultdict(list)
+    for image_id, key in pairs:
+        postings[key].append(image_id)
+    for ids in postings.values():
+        ids.sort(reverse=True)
+    return postings
+
+
+class Scorer:
+    """Scores image pairs by the IDF-weighted characters and tags they share.
+
+    A key on few images says more about similarity than one on thousands, so
+    each shared key adds log((N + 1) / images with it), characters weighted
+    by RELATED_CHARACTER_WEIGHT. Candidates are gathered from at most
+    RELATED_MAX_POSTINGS of the newest images of each key, which bounds the
+    cost of very common tags whose weight is close to zero anyway. Postings
+    may hold only those: ``counts`` ({key: images with it}) gives the weights.
+    """
+
+    def __init__(self, postings, counts, total):
+        character_weight = getattr(settings, 'RELATED_CHARACTER_WEIGHT', 2.0)
+        self.postings = postings
+        self.weights = {
+            key: math.log((total + 1) / counts[key]) * (character_weight if key[0] == CHARACTER else 1.0)
+            for key in postings
+        }
+        self.max_postings = getattr(settings, 'RELATED_MAX_POSTINGS', 250)
+
+    def top(self, pk, keys, limit):
+        """The ``limit`` best (score, image id) matches for image ``pk`` with ``keys``."""
+        scores = defaultdict(float)
+        for key in keys:
+            weight = self.weights.get(key, 0.0)
+            for other in self.postings.get(key, ())[:self.max_postings]:
+                scores[other] += weight
+        scores.pop(pk, None)
+        return heapq.nlargest(limit, ((score, other) for other, score in scores.items() if score > 0))
+
+
+def _rows(pk, matches):
+    return [RelatedImage(image_id=pk, related_id=other, rank=rank, score=score) for rank, (score, other) in enumerate(matches)]
+
+
+def refresh(image_ids, total=None):
+    """Recompute the stored neighbours of ``image_ids``; returns the new rows.
+
+    Uses a fixed number of queries however many images are given: their
+    keys, the newest RELATED_MAX_POSTINGS images of each key with how many
+    images have it, and one delete and insert; none reads a whole posting
+    list. ``total``, the number of approved images, is counted when
+    not given.
+    """
+    image_ids = set(image_ids)
+    if not image_ids:
+        return []
+    limit = getattr(settings, 'RELATED_IMAGES_LIMIT', 12)
+    features = defaultdict(set)
+    for image_id, key in _pairs(image_ids=image_ids):
+        features[image_id].add(key)
+    rows = []
+    if features:
+        keys = set().union(*features.values())
+        if total is None:
+            total = Image.objects.filter(is_approved=True).count()
+        scorer = Scorer(*_newest(keys, getattr(settings, 'RELATED_MAX_POSTINGS', 250)), total)
+        for pk, image_keys in features.items():
+            rows.extend(_rows(pk, scorer.top(pk, image_keys, limit)))
+    with transaction.atomic():
+        RelatedImage.objects.filter(image_id__in=image_ids).delete()
+        RelatedImage.objects.bulk_create(rows)
+    page_cache.purge(*(page_cache.name('image', pk) for pk in image_ids))
+    return rows
+
+
+def changed(image_ids):
+    """The characters, tags or approval of ``image_ids`` changed: refresh them and their neighbours.
+
+    Images that listed one of them, or that it now lists, are refreshed too,
+    so the relation stays close to symmetric. Weights drift as the library
+    grows; the rebuild_related_images command recomputes everything. Large
+    batches are handed to the job queue.
+    """
+    image_ids = sorted(set(image_ids))
+    limit = getattr(settings, 'RELATED_SYNC_LIMIT', 50)
+    if len(image_ids) > limit:
+        for start in range(0, len(image_ids), limit):
+            Job.enqueue('related.refresh', ids=image_ids[start:start + limit])
+        return
+    if not image_ids:
+        return
+    total = Image.objects.filter(is_approved=True).count()
+    affected = set(RelatedImage.objects.filter(related_id__in=image_ids).values_list('image_id', flat=True))
+    affected.update(row.related_id for row in refresh(image_ids, total))
+    refresh(affected.difference(image_ids), total)
+
+
+def rebuild(batch_size=1000):
+    """Recompute every image's neighbours from one pass over the characters and tags."""
+    limit = getattr(settings, 'RELATED_IMAGES_LIMIT', 12)
+    features = defaultdict(set)
+    pairs = list(_pairs())
+    for image_id, key in pairs:
+        features[image_id].add(key)
+    postings = _postings(pairs)
+    scorer = Scorer(postings, {key: len(ids) for key, ids in postings.items()}, Image.objects.filter(is_approved=True).count())
+    total = 0
+    with transaction.atomic():
+        RelatedImage.objects.all().delete()
+        batch = []
+        for pk in sorted(features):
+            batch.extend(_rows(pk, scorer.top(pk, features[pk], limit)))
+            if len(batch) >= batch_size:
+                total += len(RelatedImage.objects.bulk_create(batch))
+                batch = []
+        total += len(RelatedImage.objects.bulk_create(batch))
+    page_cache.purge('related')
+    return len(features), total
+
+
+def related_images(image, limit=None):
+    """``image``'s stored neighbours that are still approved, best first, in one indexed query."""
+    rows = RelatedImage.objects.filter(image=image, related__is_approved=True).select_related('related').order_by('rank')
+    return [row.related for row in rows[:limit]]
@@ -0,0 +1,30 @@
+from rest_framework import renderers
+
+try:
+    import orjson
+except ImportError:  # optional: pip install orjson
+    orjson = None
+
+
+class JSONRenderer(renderers.JSONRenderer):
+    """DRF's JSONRenderer, encoding responses marked ``plain_json`` with orjson when it is installed.
+
+    Such responses hold only strings, integers, booleans, None, lists and
+    dicts, which orjson writes byte for byte as DRF's compact, unicode
+    output does; floats would differ in their exponents. Anything else, and
+    indented output, goes through json.dumps as before.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        response = (renderer_context or {}).get('response')
+        if (
+            orjson is None or data is None or not getattr(response, 'plain_json', False)
+            or self.ensure_ascii or not self.compact or self.get_indent(accepted_media_type, renderer_context or {}) is not None
+        ):
+            return super().render(data, accepted_media_type, renderer_context)
+        try:
+            ret = orjson.dumps(data)
+        except TypeError:
+            return super().render(data, accepted_media_type, renderer_context)
+        # As DRF does, so the output stays a strict JavaScript subset.
+        return ret.replace('\u2028'.encode(), b'\\u2028').replace('\u2029'.encode(), b'\\u2029')
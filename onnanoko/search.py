@@ -0,0 +1,202 @@
+import re
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from rest_framework import filters
+
+from .models import Character, Image, SearchDocument
+
+CHARACTER, IMAGE = SearchDocument.CHARACTER, SearchDocument.IMAGE
+TOKEN = re.compile(r'\w+')
+
+
+def tokenize(query):
+    return TOKEN.findall((query or '').lower())
+
+
+class FTS5Backend:
+    """SQLite: an external-content FTS5 table kept in sync by triggers (see migration 0012)."""
+
+    def search(self, kind, tokens, limit):
+        # Every term must match as a word prefix; quoting keeps FTS5 syntax out of user input.
+        match = ' '.join(f'"{token}"*' for token in tokens)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT d.object_id FROM onnanoko_searchdocument_fts f '
+                'JOIN onnanoko_searchdocument d ON d.id = f.rowid '
+                'WHERE onnanoko_searchdocument_fts MATCH %s AND d.kind = %s '
+                'ORDER BY bm25(onnanoko_searchdocument_fts, 10.0, 1.0) LIMIT %s',
+                [match, kind, limit],
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+
+class PostgresBackend:
+    """Postgres: a generated, weighted tsvector column with a GIN index (see migration 0012)."""
+
+    def search(self, kind, tokens, limit):
+        query = ' & '.join(f'{token}:*' for token in tokens)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT object_id FROM onnanoko_searchdocument, to_tsquery('simple', %s) query "
+                'WHERE kind = %s AND vector @@ query '
+                'ORDER BY ts_rank(vector, query) DESC, object_id DESC LIMIT %s',
+                [query, kind, limit],
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+
+class LikeBackend:
+    """Any other database: substring match on the denormalized document, title hits first."""
+
+    def search(self, kind, tokens, limit):
+        docs = SearchDocument.objects.filter(kind=kind)
+        for token in tokens:
+            docs = docs.filter(Q(title__icontains=token) | Q(body__icontains=token))
+        ranked = sorted(
+            docs.values_list('object_id', 'title'),
+            key=lambda row: -sum(token in row[1].lower() for token in tokens),
+        )
+        return [object_id for object_id, _ in ranked[:limit]]
+
+
+def backend():
+    if connection.vendor == 'postgresql':
+        return PostgresBackend()
+    if connection.vendor == 'sqlite':
+        return FTS5Backend()
+    return LikeBackend()
+
+
+def search_ids(kind, query, limit=None):
+    """Ids of ``kind`` documents matching every word of ``query``, best match first."""
+    tokens = tokenize(query)
+    if not tokens:
+        return []
+    return backend().search(kind, tokens, limit or settings.SEARCH_MAX_RESULTS)
+
+
+def search_hits(kind, query):
+    """(ids, truncated): the best SEARCH_MAX_RESULTS of search_ids(), and whether more documents matched."""
+    limit = settings.SEARCH_MAX_RESULTS
+    ids = search_ids(kind, query, limit + 1)
+    return ids[:limit], len(ids) > limit
+
+
+class SearchResults:
+    """Search hits restricted to ``queryset``, in relevance order.
+
+    Supports count() and slicing like a queryset, so Paginator and DRF
+    pagination work unchanged, but only the rows of the requested slice are
+    fetched. Ordering a whole queryset by rank in SQL would mean a CASE
+    expression with one branch per hit. ``truncated`` is set when the hits
+    stopped at SEARCH_MAX_RESULTS: count() is then a lower bound.
+    """
+
+    def __init__(self, queryset, ids, truncated=False):
+        self.queryset = queryset
+        self.model = queryset.model
+        self.truncated = truncated
+        self._hits = ids
+        self._ids = None
+
+    @property
+    def ids(self):
+        if self._ids is None:
+            allowed = set(self.queryset.filter(pk__in=self._hits).values_list('pk', flat=True)) if self._hits else set()
+            self._ids = [pk for pk in self._hits if pk in allowed]
+        return self._ids
+
+    def count(self):
+        return len(self.ids)
+
+    __len__ = count
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            return self[key:key + 1][0]
+        page = self.ids[key]
+        # Not in_bulk(), which refuses values_list() querysets; their rows have a pk column.
+        objects = {obj.pk: obj for obj in self.queryset.filter(pk__in=page)} if page else {}
+        return [objects[pk] for pk in page if pk in objects]
+
+    def values_list(self, *fields, **kwargs):
+        """The same hits as rows of ``fields``, the first of which must be 'pk'."""
+        return SearchResults(self.queryset.prefetch_related(None).values_list(*fields, **kwargs), self._hits, self.truncated)
+
+    def __iter__(self):
+        return iter(self[:])
+
+
+def ranked(queryset, kind, query):
+    """Restrict ``queryset`` to search hits, ordered by relevance."""
+    return SearchResults(queryset, *search_hits(kind, query))
+
+
+def _join(*parts):
+    return ' '.join(part for part in parts if part)
+
+
+def character_documents(ids):
+    characters = Character.objects.filter(pk__in=ids).select_related('series').prefetch_related('groups', 'tags')
+    for character in characters:
+        yield SearchDocument(
+            kind=CHARACTER,
+            object_id=character.pk,
+            title=character.name,
+            body=_join(
+                character.description,
+                character.series.name if character.series else '',
+                *(group.name for group in character.groups.all()),
+                *(tag.name for tag in character.tags.all()),
+            ),
+        )
+
+
+def image_documents(ids):
+    images = Image.objects.filter(pk__in=ids).select_related('uploader').prefetch_related('characters', 'tags')
+    for image in images:
+        yield SearchDocument(
+            kind=IMAGE,
+            object_id=image.pk,
+            title=_join(*(character.name for character in image.characters.all()), *(tag.name for tag in image.tags.all())),
+            body=_join(image.description, image.illustrator, image.uploader.username),
+        )
+
+
+BUILDERS = {CHARACTER: character_documents, IMAGE: image_documents}
+
+
+def index(kind, ids):
+    """(Re)build the documents of the given objects; ids that no longer exist are dropped."""
+    ids = list(ids)
+    if not ids:
+        return
+    docs = list(BUILDERS[kind](ids))
+    SearchDocument.objects.bulk_create(
+        docs, update_conflicts=True, unique_fields=['kind', 'object_id'], update_fields=['title', 'body'],
+    )
+    found = {doc.object_id for doc in docs}
+    missing = [pk for pk in ids if pk not in found]
+    if missing:
+        unindex(kind, missing)
+
+
+def unindex(kind, ids):
+    SearchDocument.objects.filter(kind=kind, object_id__in=ids).delete()
+
+
+class FullTextSearchFilter(filters.SearchFilter):
+    """DRF ``?search=`` backed by the search index instead of icontains joins.
+
+    Views opt in with ``search_document = 'character'`` or ``'image'``; others
+    fall back to the stock SearchFilter over ``search_fields``.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        kind = getattr(view, 'search_document', None)
+        query = request.query_params.get(self.search_param, '')
+        if kind is None or not query.strip():
+            return super().filter_queryset(request, queryset, view)
+        return ranked(queryset, kind, query)
@@ -1,29 +1,51 @@
+import re
+
+from django.conf import settings
+from django.core.files.storage import default_storage
 from rest_framework import serializers
-from .models import Series, Group, Tag, Character, Image
+from .fieldsets import FieldSetSerializerMixin
+from .models import Series, Group, Tag, Character, Image, UploadSession
+from .thumbnails import ThumbnailSet
+
+
+def absolute_thumbnail_urls(thumbnails, request):
+    urls = thumbnails.urls()
+    if request is not None:
+        for formats in urls.values():
+            for ext, url in formats.items():
+                formats[ext] = request.build_absolute_uri(url)
+    return urls
+
 
-class SeriesSerializer(serializers.ModelSerializer):
+def row_thumbnail_urls(urls, derivatives):
+    """absolute_thumbnail_urls() of a derivative map, for the read path (fast_read.py)."""
+    return ThumbnailSet(derivatives, None).urls(lambda name: urls.url(default_storage, name))
+
+class SeriesSerializer(FieldSetSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Series
-        fields = ['id', 'name', 'slug', 'description']
+        fields = ['id', 'name', 'slug', 'description', 'character_count', 'image_count']
 
-class GroupSerializer(serializers.ModelSerializer):
+class GroupSerializer(FieldSetSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Group
-        fields = ['id', 'name', 'slug', 'description']
+        fields = ['id', 'name', 'slug', 'description', 'character_count', 'image_count']
 
-class TagSerializer(serializers.ModelSerializer):
+class TagSerializer(FieldSetSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Tag
-        fields = ['id', 'name', 'slug']
+        fields = ['id', 'name', 'slug', 'image_count']
 
-class CharacterSerializer(serializers.ModelSerializer):
-    series = SeriesSerializer(read_only=True)
+class CharacterSerializer(FieldSetSerializerMixin, serializers.ModelSerializer):
+    series = serializers.PrimaryKeyRelatedField(read_only=True)
     series_id = serializers.PrimaryKeyRelatedField(queryset=Series.objects.all(), source='series', write_only=True, required=False, allow_null=True)
-    groups = GroupSerializer(many=True, read_only=True)
+    groups = serializers.PrimaryKeyRelatedField(many=True, read_only=True)
     group_ids = serializers.PrimaryKeyRelatedField(queryset=Group.objects.all(), many=True, source='groups', write_only=True, required=False)
-    tags = TagSerializer(many=True, read_only=True)
+    tags = serializers.PrimaryKeyRelatedField(many=True, read_only=True)
     tag_ids = serializers.PrimaryKeyRelatedField(queryset=Tag.objects.all(), many=True, source='tags', write_only=True, required=False)
     primary_image_url = serializers.SerializerMethodField()
+    primary_image_thumbnails = serializers.SerializerMethodField()
+    expandable = {'series': SeriesSerializer, 'groups': GroupSerializer, 'tags': TagSerializer}
 
     class Meta:
         model = Character
@@ -31,9 +53,13 @@ class CharacterSerializer(serializers.ModelSerializer):
             'id', 'name', 'slug', 'birth_date', 'age', 'height_cm', 'weight_kg',
             'bust_cm', 'waist_cm', 'hips_cm', 'is_2d', 'series', 'series_id',
             'groups', 'group_ids', 'tags', 'tag_ids', 'description',
-            'primary_image', 'primary_image_url', 'created_at', 'updated_at'
+            'primary_image', 'primary_image_url', 'primary_image_thumbnails',
+            'primary_image_placeholder', 'primary_image_color', 'image_count', 'created_at', 'updated_at'
+        ]
+        read_only_fields = [
+            'slug', 'created_at', 'updated_at', 'primary_image_url', 'primary_image_thumbnails',
+            'primary_image_placeholder', 'primary_image_color'
         ]
-        read_only_fields = ['slug', 'created_at', 'updated_at', 'primary_image_url']
 
     def get_primary_image_url(self, obj):
         if obj.primary_image:
@@ -44,22 +70,39 @@ class CharacterSerializer(serializers.ModelSerializer):
             return url
         return None
 
-class ImageSerializer(serializers.ModelSerializer):
+    def get_primary_image_thumbnails(self, obj):
+        return absolute_thumbnail_urls(obj.primary_thumbnails, self.context.get('request'))
+
+    # The same fields for fast_read.Plan, from values_list() columns.
+    row_columns = {'primary_image_url': ['primary_image'], 'primary_image_thumbnails': ['primary_image_derivatives']}
+
+    def row_primary_image_url(self, urls, name):
+        return urls.url(Character.primary_image.field.storage, name) if name else None
+
+    def row_primary_image_thumbnails(self, urls, derivatives):
+        return row_thumbnail_urls(urls, derivatives)
+
+class ImageSerializer(FieldSetSerializerMixin, serializers.ModelSerializer):
     uploader = serializers.StringRelatedField(read_only=True)
-    characters = CharacterSerializer(many=True, read_only=True)
+    characters = serializers.PrimaryKeyRelatedField(many=True, read_only=True)
     character_ids = serializers.PrimaryKeyRelatedField(queryset=Character.objects.all(), many=True, source='characters', write_only=True, required=False)
-    tags = TagSerializer(many=True, read_only=True)
+    tags = serializers.PrimaryKeyRelatedField(many=True, read_only=True)
     tag_ids = serializers.PrimaryKeyRelatedField(queryset=Tag.objects.all(), many=True, source='tags', write_only=True, required=False)
     file_url = serializers.SerializerMethodField()
+    thumbnails = serializers.SerializerMethodField()
+    expandable = {'characters': CharacterSerializer, 'tags': TagSerializer}
 
     class Meta:
         model = Image
         fields = [
-            'id', 'file', 'file_url', 'uploader', 'uploaded_at',
+            'id', 'file', 'file_url', 'thumbnails', 'uploader', 'uploaded_at',
             'characters', 'character_ids', 'tags', 'tag_ids',
-            'width', 'height', 'is_approved', 'description'
+            'width', 'height', 'format', 'placeholder', 'dominant_color', 'status', 'is_approved', 'description'
+        ]
+        read_only_fields = [
+            'uploader', 'uploaded_at', 'width', 'height', 'format', 'placeholder', 'dominant_color',
+            'status', 'is_approved', 'file_url', 'thumbnails'
         ]
-        read_only_fields = ['uploader', 'uploaded_at', 'width', 'height', 'is_approved', 'file_url']
 
     def get_file_url(self, obj):
         if obj.file:
@@ -69,3 +112,45 @@ class ImageSerializer(serializers.ModelSerializer):
                 return request.build_absolute_uri(url)
             return url
         return None
+
+    def get_thumbnails(self, obj):
+        return absolute_thumbnail_urls(obj.thumbnails, self.context.get('request'))
+
+    # The same fields for fast_read.Plan, from values_list() columns.
+    row_columns = {'uploader': ['uploader__username'], 'file_url': ['file'], 'thumbnails': ['derivatives']}
+
+    def row_uploader(self, urls, username):
+        return username
+
+    def row_file_url(self, urls, name):
+        return urls.url(Image.file.field.storage, name) if name else None
+
+    def row_thumbnails(self, urls, derivatives):
+        return row_thumbnail_urls(urls, derivatives)
+
+
+class UploadSessionSerializer(serializers.ModelSerializer):
+    received_bytes = serializers.IntegerField(read_only=True)
+    chunk_size = serializers.SerializerMethodField()
+
+    class Meta:
+        model = UploadSession
+        fields = [
+            'id', 'filename', 'content_type', 'size', 'sha256',
+            'received', 'received_bytes', 'chunk_size', 'image', 'created_at'
+        ]
+        read_only_fields = ['id', 'received', 'received_bytes', 'chunk_size', 'image', 'created_at']
+
+    def get_chunk_size(self, obj):
+        return settings.CHUNKED_UPLOAD_CHUNK_SIZE
+
+    def validate_size(self, value):
+        if not 0 < value <= settings.CHUNKED_UPLOAD_MAX_SIZE:
+            raise serializers.ValidationError(f'Size must be between 1 and {settings.CHUNKED_UPLOAD_MAX_SIZE} bytes.')
+        return value
+
+    def validate_sha256(self, value):
+        value = value.lower()
+        if not re.fullmatch(r'[0-9a-f]{64}', value):
+            raise serializers.ValidationError('Expected a hex SHA-256 digest.')
+        return value
@@ -0,0 +1,471 @@
+from django.conf import settings
+from django.db.models import QuerySet
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from . import counters, page_cache, related, search, stats
+from .site_settings import site_settings
+from .tag_query import tag_index
+from .models import Character, Group, Image, Job, SearchDocument, Series, SiteSetting, Tag, User, UserStats, release_thumbnails, touch
+
+CHARACTER, IMAGE = search.CHARACTER, search.IMAGE
+
+
+def reindex(kind, ids):
+    """Rebuild documents now, or hand large fan-outs (a renamed tag) to the job queue."""
+    ids = sorted(set(ids))
+    limit = settings.SEARCH_SYNC_REINDEX_LIMIT
+    if len(ids) <= limit:
+        search.index(kind, ids)
+        return
+    for start in range(0, len(ids), limit):
+        Job.enqueue('search.reindex', document=kind, ids=ids[start:start + limit])
+
+
+def dependants(instance):
+    """(character ids, image ids) whose documents include ``instance``'s name."""
+    if isinstance(instance, Tag):
+        return (
+            list(instance.characters.values_list('pk', flat=True)),
+            list(instance.images.values_list('pk', flat=True)),
+        )
+    if isinstance(instance, (Series, Group)):
+        return list(instance.characters.values_list('pk', flat=True)), []
+    if isinstance(instance, Character):
+        return [], list(instance.images.values_list('pk', flat=True))
+    return [], []
+
+
+@receiver(post_save, sender=Character)
+def index_character(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    previous = SearchDocument.objects.filter(kind=CHARACTER, object_id=instance.pk).values_list('title', flat=True).first()
+    search.index(CHARACTER, [instance.pk])
+    if previous is not None and previous != instance.name:
+        reindex(IMAGE, dependants(instance)[1])
+
+
+@receiver(post_save, sender=Image)
+def index_image(sender, instance, raw=False, **kwargs):
+    if not raw:
+        search.index(IMAGE, [instance.pk])
+
+
+@receiver(post_save, sender=Tag)
+@receiver(post_save, sender=Series)
+@receiver(post_save, sender=Group)
+def index_dependants(sender, instance, created=False, raw=False, **kwargs):
+    if raw or created:
+        return
+    character_ids, image_ids = dependants(instance)
+    reindex(CHARACTER, character_ids)
+    reindex(IMAGE, image_ids)
+
+
+@receiver(pre_delete, sender=Tag)
+@receiver(pre_delete, sender=Series)
+@receiver(pre_delete, sender=Group)
+@receiver(pre_delete, sender=Character)
+def remember_dependants(sender, instance, **kwargs):
+    instance._search_dependants = dependants(instance)
+
+
+@receiver(post_delete, sender=Tag)
+@receiver(post_delete, sender=Series)
+@receiver(post_delete, sender=Group)
+@receiver(post_delete, sender=Character)
+@receiver(post_delete, sender=Image)
+def unindex_deleted(sender, instance, **kwargs):
+    if sender is Character:
+        search.unindex(CHARACTER, [instance.pk])
+    elif sender is Image:
+        search.unindex(IMAGE, [instance.pk])
+    character_ids, image_ids = getattr(instance, '_search_dependants', ([], []))
+    reindex(CHARACTER, character_ids)
+    reindex(IMAGE, image_ids)
+
+
+@receiver(m2m_changed, sender=Character.tags.through)
+@receiver(m2m_changed, sender=Character.groups.through)
+@receiver(m2m_changed, sender=Image.tags.through)
+@receiver(m2m_changed, sender=Image.characters.through)
+def index_m2m(sender, instance, action, reverse, model, pk_set, **kwargs):
+    owner = Image if sender in (Image.tags.through, Image.characters.through) else Character
+    kind = IMAGE if owner is Image else CHARACTER
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            reindex(kind, [instance.pk])
+    elif action == 'pre_clear':
+        # pk_set is empty for clear(); note who is affected before the rows go.
+        instance._search_cleared = list(
+            sender.objects.filter(**{f'{instance._meta.model_name}_id': instance.pk})
+            .values_list(f'{owner._meta.model_name}_id', flat=True)
+        )
+    elif action == 'post_clear':
+        reindex(kind, getattr(instance, '_search_cleared', []))
+    elif action in ('post_add', 'post_remove'):
+        reindex(kind, pk_set or [])
+
+
+@receiver(post_save, sender=Image)
+def update_tag_index(sender, instance, created=False, raw=False, **kwargs):
+    # New pending uploads cannot match any tag query yet.
+    if not raw and (instance.is_approved or not created):
+        tag_index.changed([instance.pk])
+
+
+@receiver(post_delete, sender=Image)
+def remove_from_tag_index(sender, instance, **kwargs):
+    tag_index.removed([instance.pk])
+
+
+@receiver(post_delete, sender=Image)
+@receiver(post_delete, sender=Character)
+def release_deleted_thumbnails(sender, instance, **kwargs):
+    release_thumbnails(instance.derivatives if sender is Image else instance.primary_image_derivatives)
+
+
+@receiver(post_save, sender=Tag)
+@receiver(post_save, sender=Series)
+@receiver(post_save, sender=Group)
+@receiver(post_save, sender=Character)
+@receiver(post_delete, sender=Tag)
+@receiver(post_delete, sender=Series)
+@receiver(post_delete, sender=Group)
+@receiver(post_delete, sender=Character)
+def invalidate_tag_index(sender, instance, created=False, raw=False, update_fields=None, **kwargs):
+    # A new name has no images yet; a slug, series or deletion can touch thousands.
+    if raw or created or (update_fields and not {'slug', 'series'} & set(update_fields)):
+        return
+    tag_index.invalidate()
+
+
+@receiver(m2m_changed, sender=Image.tags.through)
+@receiver(m2m_changed, sender=Image.characters.through)
+@receiver(m2m_changed, sender=Character.groups.through)
+def update_tag_index_m2m(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if sender is Character.groups.through or (reverse and action == 'post_clear'):
+        tag_index.invalidate()
+    elif reverse:
+        tag_index.changed(pk_set or [])
+    else:
+        tag_index.changed([instance.pk])
+
+
+@receiver(post_save, sender=Image)
+def update_related_images(sender, instance, created=False, raw=False, update_fields=None, **kwargs):
+    # Characters and tags arrive through m2m_changed; only approval matters here.
+    if raw or (created and not instance.is_approved) or (update_fields and 'is_approved' not in update_fields):
+        return
+    related.changed([instance.pk])
+
+
+@receiver(m2m_changed, sender=Image.tags.through)
+@receiver(m2m_changed, sender=Image.characters.through)
+def update_related_images_m2m(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            related.changed([instance.pk])
+    elif action == 'pre_clear':
+        instance._related_cleared = list(
+            sender.objects.filter(**{f'{instance._meta.model_name}_id': instance.pk}).values_list('image_id', flat=True)
+        )
+    elif action == 'post_clear':
+        related.changed(getattr(instance, '_related_cleared', []))
+    elif action in ('post_add', 'post_remove'):
+        related.changed(pk_set or [])
+
+
+@receiver(post_save, sender=User)
+def create_user_stats(sender, instance, created=False, raw=False, **kwargs):
+    if created and not raw:
+        UserStats.objects.get_or_create(user=instance)
+
+
+@receiver(pre_save, sender=Image)
+def remember_counted_state(sender, instance, raw=False, update_fields=None, **kwargs):
+    if raw or instance._state.adding or (update_fields and not {'is_approved', 'uploader', 'uploader_id'} & set(update_fields)):
+        return
+    instance._counted = Image.objects.filter(pk=instance.pk).values_list('is_approved', 'uploader_id').first()
+
+
+@receiver(post_save, sender=Image)
+def count_image(sender, instance, created=False, raw=False, **kwargs):
+    if raw:
+        return
+    after = {instance.pk: (instance.is_approved, instance.uploader_id)}
+    if created:
+        # Tags and characters are counted as m2m_changed adds them.
+        counters.Deltas().images(after, 1, found=[]).apply()
+        return
+    before = getattr(instance, '_counted', None)
+    if before is not None and before != after[instance.pk]:
+        counters.moved({instance.pk: before}, after)
+    instance._counted = None
+
+
+@receiver(pre_delete, sender=Image)
+def uncount_image(sender, instance, origin=None, **kwargs):
+    # Deleting a user or a queryset sends one signal per image; count the whole batch down once.
+    batch = getattr(origin, '_uncounted', None)
+    if batch is None or instance.pk not in batch['images']:
+        if isinstance(origin, QuerySet) and origin.model is Image:
+            before = {pk: (approved, uploader) for pk, approved, uploader in origin.values_list('pk', 'is_approved', 'uploader_id')}
+        elif isinstance(origin, User):
+            before = {pk: (approved, origin.pk) for pk, approved in origin.uploaded_images.values_list('pk', 'is_approved')}
+        else:
+            before = {}
+        before.setdefault(instance.pk, (instance.is_approved, instance.uploader_id))
+        batch = {'images': set(before), 'remaining': set(before), 'characters': counters.Deltas().images(before, -1).apply()}
+        if origin is not None:
+            origin._uncounted = batch
+    instance._uncounted = batch
+
+
+@receiver(post_delete, sender=Image)
+def recount_after_image_delete(sender, instance, **kwargs):
+    batch = getattr(instance, '_uncounted', None)
+    if batch is None:
+        return
+    batch['remaining'].discard(instance.pk)
+    if not batch['remaining']:
+        counters.recount_collections(batch['characters'])
+
+
+@receiver(m2m_changed, sender=Image.tags.through)
+@receiver(m2m_changed, sender=Image.characters.through)
+def count_links(sender, instance, action, reverse, pk_set, **kwargs):
+    model, column = (Tag, 'tag_id') if sender is Image.tags.through else (Character, 'character_id')
+    if action in ('pre_remove', 'pre_clear', 'post_add'):
+        if action != 'pre_clear' and not pk_set:
+            instance._counted_links = []
+            return
+        owner, other = (column, 'image_id') if reverse else ('image_id', column)
+        rows = sender.objects.filter(**{owner: instance.pk})
+        if action != 'pre_clear':
+            rows = rows.filter(**{f'{other}__in': pk_set})
+        # Removes name pks whether or not they are linked, so only the existing links are counted down.
+        instance._counted_links = list(rows.values_list(column, 'image__is_approved'))
+        if action != 'post_add':
+            return
+    elif action not in ('post_remove', 'post_clear'):
+        return
+    sign = 1 if action == 'post_add' else -1
+    deltas = counters.Deltas()
+    for pk, approved in getattr(instance, '_counted_links', []):
+        deltas.add(model, pk, approved, sign)
+    counters.recount_collections(deltas.apply())
+
+
+@receiver(m2m_changed, sender=Character.groups.through)
+def count_group_members(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear' and not reverse:
+        instance._counted_groups = list(instance.groups.values_list('pk', flat=True))
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        if reverse:
+            group_ids = [instance.pk]
+        elif action == 'post_clear':
+            group_ids = getattr(instance, '_counted_groups', [])
+        else:
+            group_ids = pk_set or []
+        counters.recount(Group, group_ids)
+
+
+@receiver(pre_save, sender=Character)
+def remember_series(sender, instance, raw=False, update_fields=None, **kwargs):
+    if raw or instance._state.adding or (update_fields and not {'series', 'series_id'} & set(update_fields)):
+        return
+    instance._counted_series = Character.objects.filter(pk=instance.pk).values_list('series_id', flat=True).first()
+
+
+@receiver(post_save, sender=Character)
+def count_series_members(sender, instance, created=False, raw=False, **kwargs):
+    if raw:
+        return
+    previous = getattr(instance, '_counted_series', instance.series_id)
+    if created or previous != instance.series_id:
+        counters.recount(Series, [instance.series_id, previous])
+    instance._counted_series = instance.series_id
+
+
+@receiver(pre_delete, sender=Character)
+def remember_collections(sender, instance, **kwargs):
+    instance._counted_collections = (instance.series_id, list(instance.groups.values_list('pk', flat=True)))
+
+
+@receiver(post_delete, sender=Character)
+def recount_collections_after_delete(sender, instance, **kwargs):
+    series_id, group_ids = getattr(instance, '_counted_collections', (None, []))
+    counters.recount_collections(series_ids=[series_id], group_ids=group_ids)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_save, sender=Character)
+@receiver(post_save, sender=Series)
+@receiver(post_save, sender=Group)
+@receiver(post_save, sender=Tag)
+def count_created(sender, instance, created=False, raw=False, **kwargs):
+    if created and not raw:
+        stats.adjust(**{stats.MODEL_TOTALS[sender]: 1})
+
+
+@receiver(post_delete, sender=User)
+@receiver(post_delete, sender=Character)
+@receiver(post_delete, sender=Series)
+@receiver(post_delete, sender=Group)
+@receiver(post_delete, sender=Tag)
+def count_deleted(sender, instance, **kwargs):
+    stats.adjust(**{stats.MODEL_TOTALS[sender]: -1})
+
+
+@receiver(post_save, sender=SiteSetting)
+@receiver(post_delete, sender=SiteSetting)
+def invalidate_site_settings(sender, **kwargs):
+    site_settings.invalidate()
+
+
+@receiver(post_save, sender=SiteSetting)
+@receiver(post_delete, sender=SiteSetting)
+def purge_all_pages(sender, **kwargs):
+    page_cache.purge(page_cache.SITE)
+
+
+@receiver(post_save, sender=Image)
+@receiver(post_save, sender=Character)
+def purge_pages(sender, instance, created=False, raw=False, **kwargs):
+    # A new pending upload is on no public page yet.
+    if raw or (sender is Image and created and not instance.is_approved):
+        return
+    page_cache.changed(sender, [instance.pk])
+
+
+@receiver(pre_delete, sender=Image)
+def purge_deleted_image_pages(sender, instance, **kwargs):
+    # uncount_image has gathered the whole batch (a user's or a queryset's images); purge it once.
+    batch = getattr(instance, '_uncounted', None) or {'images': {instance.pk}}
+    if not batch.get('pages_purged'):
+        batch['pages_purged'] = True
+        page_cache.changed(Image, batch['images'])
+
+
+@receiver(pre_delete, sender=Character)
+def purge_deleted_character_pages(sender, instance, **kwargs):
+    page_cache.changed(Character, [instance.pk])
+
+
+@receiver(pre_save, sender=Character)
+def purge_previous_series_page(sender, instance, raw=False, **kwargs):
+    # remember_series has just read the series the character may be leaving.
+    previous = getattr(instance, '_counted_series', None)
+    if not raw and previous and previous != instance.series_id:
+        page_cache.purge(page_cache.name('series', previous))
+
+
+@receiver(post_save, sender=Tag)
+@receiver(post_save, sender=Series)
+@receiver(post_save, sender=Group)
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=Tag)
+@receiver(post_delete, sender=Series)
+@receiver(post_delete, sender=Group)
+@receiver(post_delete, sender=User)
+def purge_named_pages(sender, instance, raw=False, update_fields=None, **kwargs):
+    # Logging in saves last_login, which no page shows.
+    if raw or (update_fields and set(update_fields) == {'last_login'}):
+        return
+    page_cache.purge(page_cache.name(sender._meta.model_name, instance.pk))
+
+
+@receiver(m2m_changed, sender=Image.tags.through)
+@receiver(m2m_changed, sender=Image.characters.through)
+@receiver(m2m_changed, sender=Character.tags.through)
+@receiver(m2m_changed, sender=Character.groups.through)
+def purge_linked_pages(sender, instance, action, reverse, pk_set, **kwargs):
+    # Links about to go are read before they do, new ones once they exist.
+    if action not in ('pre_remove', 'pre_clear', 'post_add') or not page_cache.enabled():
+        return
+    owner = Image if sender in (Image.tags.through, Image.characters.through) else Character
+    if not reverse:
+        owners = [instance.pk]
+    elif action == 'pre_clear':
+        owners = sender.objects.filter(**{f'{instance._meta.model_name}_id': instance.pk}).values_list(f'{owner._meta.model_name}_id', flat=True)
+    else:
+        owners = pk_set or []
+    page_cache.changed(owner, owners)
+
+
+# Cards (cards.py) and API representations show the names of their characters, tags, groups and series.
+CARD_OWNERS = {
+    Character: ((Image, 'characters'),),
+    Tag: ((Character, 'tags'),),
+    Group: ((Character, 'groups'),),
+    Series: ((Character, 'series'),),
+}
+
+
+@receiver(pre_save, sender=Character)
+@receiver(pre_save, sender=Tag)
+@receiver(pre_save, sender=Group)
+@receiver(pre_save, sender=Series)
+def remember_shown_name(sender, instance, raw=False, update_fields=None, **kwargs):
+    # CountedModel.save() names every field, so update_fields alone cannot tell a rename.
+    if raw or instance._state.adding or (update_fields and 'name' not in update_fields):
+        return
+    instance._shown_name = sender.objects.filter(pk=instance.pk).values_list('name', flat=True).first()
+
+
+@receiver(post_save, sender=Character)
+@receiver(post_save, sender=Tag)
+@receiver(post_save, sender=Group)
+@receiver(post_save, sender=Series)
+def touch_showing(sender, instance, created=False, raw=False, **kwargs):
+    # Cards show the names of these rows and nothing else of them.
+    previous = getattr(instance, '_shown_name', None)
+    instance._shown_name = None
+    if raw or created or previous is None or previous == instance.name:
+        return
+    for model, lookup in CARD_OWNERS[sender]:
+        touch(model, **{lookup: instance})
+
+
+@receiver(pre_delete, sender=Character)
+@receiver(pre_delete, sender=Tag)
+@receiver(pre_delete, sender=Group)
+@receiver(pre_delete, sender=Series)
+def remember_showing(sender, instance, **kwargs):
+    instance._touched_owners = [
+        (model, list(model.objects.filter(**{lookup: instance}).values_list('pk', flat=True)))
+        for model, lookup in CARD_OWNERS[sender]
+    ]
+
+
+@receiver(post_delete, sender=Character)
+@receiver(post_delete, sender=Tag)
+@receiver(post_delete, sender=Group)
+@receiver(post_delete, sender=Series)
+def touch_showing_after_delete(sender, instance, **kwargs):
+    for model, ids in getattr(instance, '_touched_owners', []):
+        touch(model, ids)
+
+
+@receiver(m2m_changed, sender=Image.tags.through)
+@receiver(m2m_changed, sender=Image.characters.through)
+@receiver(m2m_changed, sender=Character.tags.through)
+@receiver(m2m_changed, sender=Character.groups.through)
+def touch_linked(sender, instance, action, reverse, pk_set, **kwargs):
+    # Stamped after the links change, so no card rendered before is kept under the new version.
+    owner = Image if sender in (Image.tags.through, Image.characters.through) else Character
+    if action == 'pre_clear' and reverse:
+        instance._touched_cleared = list(
+            sender.objects.filter(**{f'{instance._meta.model_name}_id': instance.pk}).values_list(f'{owner._meta.model_name}_id', flat=True)
+        )
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        if not reverse:
+            touch(owner, [instance.pk])
+        elif action == 'post_clear':
+            touch(owner, getattr(instance, '_touched_cleared', []))
+        else:
+            touch(owner, pk_set or [])
@@ -0,0 +1,53 @@
+import threading
+import time
+import uuid
+
+from django.conf import settings
+
+from .page_cache import pages
+
+VERSION_KEY = 'onnanoko:site-settings:version'
+
+
+class SiteSettingsCache:
+    """A process-local copy of the SiteSetting row.
+
+    Each read compares a version stamp in the 'pages' cache, the store the
+    workers share, with the one the copy was loaded under; saving the
+    settings anywhere writes a new stamp, so every worker reloads on its
+    next read. With a per-process (locmem) store the stamps are not shared
+    and SITE_SETTINGS_TTL bounds how stale another worker's copy can be. The returned instance is shared:
+    read it, never modify it.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.value = None
+        self.version = None
+        self.loaded_at = 0.0
+
+    def _version(self):
+        stamps = pages()
+        version = stamps.get(VERSION_KEY)
+        if version is None:
+            stamps.add(VERSION_KEY, uuid.uuid4().hex, None)
+            version = stamps.get(VERSION_KEY)
+        return version
+
+    def get(self):
+        from .models import SiteSetting
+        version = self._version()
+        ttl = getattr(settings, 'SITE_SETTINGS_TTL', 300)
+        with self.lock:
+            if self.value is None or self.version != version or time.monotonic() - self.loaded_at > ttl:
+                self.value = SiteSetting.get_solo()
+                self.version, self.loaded_at = version, time.monotonic()
+            return self.value
+
+    def invalidate(self):
+        with self.lock:
+            pages().set(VERSION_KEY, uuid.uuid4().hex, None)
+            self.value = None
+
+
+site_settings = SiteSettingsCache()
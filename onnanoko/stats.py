@@ -0,0 +1,86 @@
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Count, F, Q
+from django.utils import timezone
+
+from .models import Character, Group, Image, Job, Series, Statistic, Tag, User, UserStats
+
+# name -> queryset whose COUNT(*) is the true value
+TOTALS = {
+    'users': lambda: User.objects.all(),
+    'characters': lambda: Character.objects.all(),
+    'series': lambda: Series.objects.all(),
+    'groups': lambda: Group.objects.all(),
+    'tags': lambda: Tag.objects.all(),
+    'images': lambda: Image.objects.filter(is_approved=True),
+    'pending_images': lambda: Image.objects.filter(is_approved=False),
+}
+# Models whose every row is one unit of a total.
+MODEL_TOTALS = {User: 'users', Character: 'characters', Series: 'series', Group: 'groups', Tag: 'tags'}
+
+
+def adjust(**deltas):
+    """Move totals by deltas, e.g. ``adjust(images=1, pending_images=-1)``; one UPDATE per distinct delta."""
+    grouped = defaultdict(list)
+    for name, delta in deltas.items():
+        if delta:
+            grouped[delta].append(name)
+    now = timezone.now()
+    for delta, names in grouped.items():
+        Statistic.objects.filter(name__in=names).update(value=F('value') + delta, changed_at=now)
+
+
+def reconcile(names=None, dry_run=False):
+    """Recount totals (all of them by default); returns {name: drift} for those that were off."""
+    drift = {}
+    now = timezone.now()
+    stored = {name: (value, changed_at) for name, value, changed_at in Statistic.objects.values_list('name', 'value', 'changed_at')}
+    rows = []
+    for name in TOTALS if names is None else names:
+        value = TOTALS[name]().count()
+        previous, changed_at = stored.get(name, (None, now))
+        if previous != value:
+            drift[name] = value - (previous or 0)
+            changed_at = now
+        rows.append(Statistic(name=name, value=value, reconciled_at=now, changed_at=changed_at))
+    if not dry_run:
+        Statistic.objects.bulk_create(rows, update_conflicts=True, unique_fields=['name'], update_fields=['value', 'reconciled_at', 'changed_at'])
+    return drift
+
+
+def snapshot():
+    """Every total in one read of the Statistic table.
+
+    Missing totals are counted on the spot. Totals not reconciled for
+    STATS_RECONCILE_INTERVAL seconds get a 'stats.reconcile' job, so drift
+    from writes that bypass the ORM is corrected off the request path.
+    """
+    rows = {name: (value, reconciled_at) for name, value, reconciled_at in Statistic.objects.values_list('name', 'value', 'reconciled_at')}
+    missing = set(TOTALS) - set(rows)
+    if missing:
+        reconcile(missing)
+        rows.update({name: (value, timezone.now()) for name, value in Statistic.objects.filter(name__in=missing).values_list('name', 'value')})
+    cutoff = timezone.now() - timedelta(seconds=getattr(settings, 'STATS_RECONCILE_INTERVAL', 3600))
+    if min(reconciled_at for _, reconciled_at in rows.values()) < cutoff:
+        if not Job.objects.filter(kind='stats.reconcile', status__in=[Job.QUEUED, Job.RUNNING]).exists():
+            Job.enqueue('stats.reconcile')
+    return {name: value for name, (value, _) in rows.items()}
+
+
+def user_counts(user):
+    """{'approved_count', 'pending_count', 'total_uploads'} for ``user``.
+
+    Read from the user's UserStats row; users without one fall back to a
+    single conditional aggregate rather than a COUNT per figure.
+    """
+    row = UserStats.objects.filter(user=user).values_list('image_count', 'pending_image_count').first()
+    if row is None:
+        totals = Image.objects.filter(uploader=user).aggregate(
+            approved=Count('pk', filter=Q(is_approved=True)),
+            pending=Count('pk', filter=Q(is_approved=False)),
+        )
+        row = totals['approved'], totals['pending']
+    approved, pending = row
+    return {'approved_count': approved, 'pending_count': pending, 'total_uploads': approved + pending}
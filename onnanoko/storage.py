@@ -0,0 +1,32 @@
+import hashlib
+import os
+
+# Canonical extension per Pillow format, so identical bytes always map to the
+# same name regardless of what the client called the file.
+FORMAT_EXTENSIONS = {'JPEG': '.jpg', 'PNG': '.png', 'WEBP': '.webp', 'GIF': '.gif'}
+
+
+def content_addressed_name(prefix, digest, extension):
+    return f'{prefix}/{digest[:2]}/{digest[2:4]}/{digest}{extension.lower()}'
+
+
+def sharded_name(prefix, filename):
+    """prefix/ab/cd/<filename>, fanned out by a hash of the file name.
+
+    Keeps any single directory small when the content hash is not known.
+    """
+    digest = hashlib.md5(filename.encode(), usedforsecurity=False).hexdigest()
+    return f'{prefix}/{digest[:2]}/{digest[2:4]}/{filename}'
+
+
+def image_upload_to(instance, filename):
+    """upload_to for Image.file: images/ab/cd/<sha256>.<ext>."""
+    if not instance.sha256:
+        return sharded_name('images', filename)
+    extension = FORMAT_EXTENSIONS.get(instance.format) or os.path.splitext(filename)[1]
+    return content_addressed_name('images', instance.sha256, extension)
+
+
+def character_upload_to(instance, filename):
+    """upload_to for Character.primary_image: characters/ab/cd/<filename>."""
+    return sharded_name('characters', filename)
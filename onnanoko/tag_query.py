@@ -0,0 +1,440 @@
+import threading
+import time
+import uuid
+from array import array
+from bisect import bisect_left, insort
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.text import slugify
+from rest_framework import filters
+from rest_framework.exceptions import ValidationError
+
+from .page_cache import pages
+from .pagination import CursorPage, InvalidCursor, decode_cursor
+from .search import SearchResults
+
+FIELDS = ('tag', 'character', 'series', 'group')
+VERSION_KEY = 'onnanoko:tag-index:version'
+
+
+class QueryError(ValueError):
+    pass
+
+
+class Query:
+    """A parsed tag query: every ``required`` term, at least one ``any`` term, no ``excluded`` term.
+
+    Terms are (field, slug) pairs.
+    """
+
+    def __init__(self, required=(), any=(), excluded=()):
+        self.required = list(required)
+        self.any = list(any)
+        self.excluded = list(excluded)
+
+    def __bool__(self):
+        return bool(self.required or self.any or self.excluded)
+
+    def __eq__(self, other):
+        return isinstance(other, Query) and (self.required, self.any, self.excluded) == (other.required, other.any, other.excluded)
+
+    def __repr__(self):
+        return f'Query(required={self.required!r}, any={self.any!r}, excluded={self.excluded!r})'
+
+
+def parse(text):
+    """Parse ``cute school -swimsuit ~maid ~nurse character:haruka-amami series:idolmaster``.
+
+    Bare words are tags; ``character:``, ``series:`` and ``group:`` (or
+    ``tag:``) pick the field. A leading ``-`` excludes a term and terms with
+    a leading ``~`` form one group of which any may match. Values are
+    compared as slugs.
+    """
+    query = Query()
+    for word in (text or '').split():
+        target = query.required
+        if word[0] in '-~':
+            target = query.excluded if word[0] == '-' else query.any
+            word = word[1:]
+        field, sep, value = word.partition(':')
+        if field.lower() in FIELDS and sep:
+            field = field.lower()
+        else:
+            # Not a field prefix: the colon is part of a tag name such as "re:zero".
+            field, value = 'tag', word
+        slug = slugify(value)
+        if not slug:
+            raise QueryError(f'"{word or "-"}" is not a valid term.')
+        term = (field, slug)
+        if term not in target:
+            target.append(term)
+    if len(query.any) == 1:
+        # A lone "~term" is just a required term.
+        query.required += query.any
+        query.any = []
+    return query
+
+
+def to_bitmap(posting):
+    """Expand a sorted position array into an int bitmap; bitmaps pass through."""
+    if isinstance(posting, int):
+        return posting
+    if not posting:
+        return 0
+    bits = bytearray(posting[-1] // 8 + 1)
+    for position in posting:
+        bits[position >> 3] |= 1 << (position & 7)
+    return int.from_bytes(bits, 'little')
+
+
+class Snapshot:
+    """Posting lists of approved images for every tag, character, series and group.
+
+    Images get positions in ``(uploaded_at, id)`` order, so the highest set
+    bit of a result is the newest image. Each posting is kept as an int
+    bitmap or as a sorted array of positions, whichever is smaller: common
+    tags are dense and cost ``n / 8`` bytes, rare ones a few bytes each.
+    """
+
+    def __init__(self, rows, terms):
+        self.order = []
+        self.position = {}
+        self.newest = None
+        for pk, uploaded_at in rows:
+            self.position[pk] = len(self.order)
+            self.order.append(pk)
+            self.newest = (uploaded_at, pk)
+        self.universe = (1 << len(self.order)) - 1
+
+        collected = {}
+        self.keys = {}
+        for pk, key in terms:
+            position = self.position.get(pk)
+            if position is None:
+                continue
+            self.keys.setdefault(pk, set()).add(key)
+            collected.setdefault(key, set()).add(position)
+        self.postings = {key: self._pack(sorted(positions)) for key, positions in collected.items()}
+
+    def _pack(self, positions):
+        # A position costs 4 bytes in an array and 1/8 byte per image in a bitmap.
+        if len(positions) * 32 >= len(self.order):
+            return to_bitmap(positions)
+        return array('L', positions)
+
+    def bitmap(self, key):
+        return to_bitmap(self.postings.get(key, 0))
+
+    def size(self, key):
+        posting = self.postings.get(key, 0)
+        return posting.bit_count() if isinstance(posting, int) else len(posting)
+
+    def add(self, pk, uploaded_at, keys):
+        """Add or update an approved image; False if it would need an earlier position."""
+        position = self.position.get(pk)
+        if position is None:
+            if self.newest is not None and (uploaded_at, pk) < self.newest:
+                return False
+            position = self.position[pk] = len(self.order)
+            self.order.append(pk)
+            self.newest = (uploaded_at, pk)
+        self.remove(pk)
+        self.universe |= 1 << position
+        self.keys[pk] = set(keys)
+        for key in keys:
+            posting = self.postings.get(key)
+            if isinstance(posting, int):
+                self.postings[key] = posting | (1 << position)
+            elif posting is None:
+                self.postings[key] = array('L', [position])
+            else:
+                insort(posting, position)
+        return True
+
+    def remove(self, pk):
+        position = self.position.get(pk)
+        if position is None:
+            return
+        self.universe &= ~(1 << position)
+        for key in self.keys.pop(pk, ()):
+            posting = self.postings[key]
+            if isinstance(posting, int):
+                self.postings[key] = posting & ~(1 << position)
+            else:
+                index = bisect_left(posting, position)
+                if index < len(posting) and posting[index] == position:
+                    del posting[index]
+
+
+def _terms(image_filter):
+    """(image id, (field, slug)) for every searchable attribute of the filtered images."""
+    from .models import Image
+    tags = Image.tags.through.objects.filter(**image_filter)
+    characters = Image.characters.through.objects.filter(**image_filter)
+    for pk, slug in tags.values_list('image_id', 'tag__slug').iterator(chunk_size=10000):
+        yield pk, ('tag', slug)
+    for pk, slug, series in characters.values_list('image_id', 'character__slug', 'character__series__slug').iterator(chunk_size=10000):
+        yield pk, ('character', slug)
+        if series:
+            yield pk, ('series', series)
+    groups = characters.exclude(character__groups=None).values_list('image_id', 'character__groups__slug')
+    for pk, slug in groups.iterator(chunk_size=10000):
+        yield pk, ('group', slug)
+
+
+class Match:
+    """The images matching a query, as a bitmap over one snapshot."""
+
+    def __init__(self, snapshot, bitmap):
+        self.snapshot = snapshot
+        self.bitmap = bitmap
+
+    def count(self):
+        return self.bitmap.bit_count()
+
+    def __contains__(self, pk):
+        position = self.snapshot.position.get(pk)
+        return position is not None and bool(self.bitmap >> position & 1)
+
+    def restrict(self, ids):
+        position = self.snapshot.position
+        self.bitmap &= to_bitmap(sorted(position[pk] for pk in ids if pk in position))
+        return self
+
+    def before(self, pk):
+        """The matches older than image ``pk``."""
+        position = self.snapshot.position.get(pk)
+        if position is None:
+            # Gone since the last rebuild; ids follow upload order closely enough to resume.
+            position = bisect_left(self.snapshot.order, pk)
+        return Match(self.snapshot, self.bitmap & ((1 << position) - 1))
+
+    def ids(self, start=0, stop=None):
+        """Image ids from ``start`` to ``stop``, newest first."""
+        if stop is not None and stop <= start:
+            return []
+        # bin() renders the bitmap highest bit first in C; find() walks its set bits.
+        bits = bin(self.bitmap)[2:]
+        top = len(bits) - 1
+        order = self.snapshot.order
+        found = []
+        index = bits.find('1')
+        seen = 0
+        while index != -1 and (stop is None or seen < stop):
+            if seen >= start:
+                found.append(order[top - index])
+            seen += 1
+            index = bits.find('1', index + 1)
+        return found
+
+
+class TagIndex:
+    """Process-local inverted index over approved images, built lazily from the database.
+
+    Changes made in this process are applied in place by the signal
+    handlers. Every change also stores a new version stamp in the 'pages'
+    cache, the store the workers share, and other processes rebuild when
+    they see a stamp they did not write. With a per-process (locmem) store
+    only TAG_QUERY_INDEX_TTL bounds how stale they get.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.snapshot = None
+        self.version = None
+        self.built_at = 0.0
+
+    def rebuild(self):
+        from .models import Image
+        version = pages().get(VERSION_KEY)
+        rows = Image.objects.filter(is_approved=True).order_by('uploaded_at', 'pk').values_list('pk', 'uploaded_at')
+        snapshot = Snapshot(rows.iterator(chunk_size=10000), _terms({'image__is_approved': True}))
+        with self.lock:
+            self.snapshot, self.version, self.built_at = snapshot, version, time.monotonic()
+        return snapshot
+
+    def current(self):
+        ttl = getattr(settings, 'TAG_QUERY_INDEX_TTL', 600)
+        with self.lock:
+            if (self.snapshot is None or time.monotonic() - self.built_at > ttl
+                    or pages().get(VERSION_KEY) != self.version):
+                return self.rebuild()
+            return self.snapshot
+
+    def _bump(self):
+        """Stamp a new version now and, inside a transaction, another when it commits.
+
+        A process that sees the first stamp before the commit rebuilds from
+        the old rows and would keep them; the second makes it rebuild again,
+        as page_cache.purge() does for pages. This process read its own
+        writes, so it adopts the second stamp unless another came between.
+        """
+        version = uuid.uuid4().hex
+        pages().set(VERSION_KEY, version, None)
+
+        def restamp():
+            committed = uuid.uuid4().hex
+            pages().set(VERSION_KEY, committed, None)
+            with self.lock:
+                if self.version == version:
+                    self.version = committed
+
+        if transaction.get_connection().in_atomic_block:
+            transaction.on_commit(restamp)
+        return version
+
+    def invalidate(self):
+        """Something many images depend on changed (a slug, a character's series): rebuild lazily."""
+        with self.lock:
+            self._bump()
+            self.snapshot = None
+
+    def changed(self, image_ids):
+        """Re-read the given images (approval, tags, characters) into the index."""
+        from .models import Image
+        image_ids = set(image_ids)
+        if not image_ids:
+            return
+        with self.lock:
+            if pages().get(VERSION_KEY) != self.version:
+                # Another process changed something we have not seen; rebuild instead.
+                self.snapshot = None
+            version = self._bump()
+            snapshot = self.snapshot
+            if snapshot is None:
+                return
+            keys = {}
+            for pk, key in _terms({'image_id__in': image_ids}):
+                keys.setdefault(pk, []).append(key)
+            approved = Image.objects.filter(pk__in=image_ids, is_approved=True).order_by('uploaded_at', 'pk').values_list('pk', 'uploaded_at')
+            for pk, uploaded_at in approved:
+                image_ids.discard(pk)
+                if not snapshot.add(pk, uploaded_at, keys.get(pk, ())):
+                    # An older upload approved late has no free position; renumber.
+                    self.snapshot = None
+                    return
+            for pk in image_ids:
+                snapshot.remove(pk)
+            self.version = version
+
+    def removed(self, image_ids):
+        """Drop deleted images; unlike changed() this needs no queries."""
+        with self.lock:
+            if pages().get(VERSION_KEY) != self.version:
+                self.snapshot = None
+            version = self._bump()
+            if self.snapshot is not None:
+                for pk in image_ids:
+                    self.snapshot.remove(pk)
+                self.version = version
+
+    def match(self, query):
+        snapshot = self.current()
+        result = None
+        for key in sorted(query.required, key=snapshot.size):
+            result = snapshot.bitmap(key) if result is None else result & snapshot.bitmap(key)
+            if not result:
+                return Match(snapshot, 0)
+        if query.any:
+            either = 0
+            for key in query.any:
+                either |= snapshot.bitmap(key)
+            result = either if result is None else result & either
+        if result is None:
+            result = snapshot.universe
+        for key in query.excluded:
+            result &= ~snapshot.bitmap(key)
+        return Match(snapshot, result & snapshot.universe)
+
+
+tag_index = TagIndex()
+
+
+class TagQueryResults:
+    """Matching images, newest first, with count() and slicing for Paginator and DRF.
+
+    Only the requested slice is fetched, through ``queryset`` so its
+    select_related and prefetch_related apply.
+    """
+
+    def __init__(self, queryset, match):
+        self.queryset = queryset
+        self.model = queryset.model
+        self.match = match
+
+    def count(self):
+        return self.match.count()
+
+    __len__ = count
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            return self[key:key + 1][0]
+        start, stop, _ = key.indices(self.count())
+        page = self.match.ids(start, stop)
+        return self._fetch(page)
+
+    def _fetch(self, ids):
+        # Not in_bulk(), which refuses values_list() querysets; their rows have a pk column.
+        objects = {obj.pk: obj for obj in self.queryset.filter(pk__in=ids)} if ids else {}
+        return [objects[pk] for pk in ids if pk in objects]
+
+    def values_list(self, *fields, **kwargs):
+        """The same matches as rows of ``fields``, the first of which must be 'pk'."""
+        return TagQueryResults(self.queryset.prefetch_related(None).values_list(*fields, **kwargs), self.match)
+
+    def __iter__(self):
+        return iter(self[:])
+
+    count_is_approximate = False
+
+    def values(self, obj):
+        return [obj.pk]
+
+    def cursor_page(self, cursor, per_page):
+        """A CursorPage of matches older than the image in ``cursor``."""
+        match = self.match
+        if cursor:
+            (pk,), _ = decode_cursor(cursor, 1)
+            try:
+                match = match.before(int(pk))
+            except (TypeError, ValueError):
+                raise InvalidCursor('Invalid cursor.')
+        ids = match.ids(0, per_page + 1)
+        rows = self._fetch(ids[:per_page])
+        return CursorPage(rows, self, has_next=len(ids) > per_page, has_previous=bool(cursor))
+
+
+def filter_images(queryset, query):
+    """Images of ``queryset`` matching ``query`` (text or Query), newest first.
+
+    The index holds approved images only, and other filters already applied
+    to ``queryset`` are honoured with one extra id query.
+    """
+    if not isinstance(query, Query):
+        query = parse(query)
+    match = tag_index.match(query)
+    if queryset.query.where:
+        match.restrict(queryset.values_list('pk', flat=True))
+    return TagQueryResults(queryset, match)
+
+
+class TagQueryFilter(filters.BaseFilterBackend):
+    """DRF ``?q=cute -swimsuit character:haruka-amami`` over approved images."""
+
+    query_param = 'q'
+
+    def filter_queryset(self, request, queryset, view):
+        text = request.query_params.get(self.query_param, '')
+        try:
+            query = parse(text)
+        except QueryError as e:
+            raise ValidationError({self.query_param: [str(e)]})
+        if not query:
+            return queryset
+        if isinstance(queryset, SearchResults):
+            # Already ranked by ?search=: keep the relevance order, drop non-matches.
+            match = tag_index.match(query)
+            return SearchResults(queryset.queryset, [pk for pk in queryset.ids if pk in match], queryset.truncated)
+        return filter_images(queryset, query)
@@ -1,7 +1,58 @@
-from django.test import TestCase, Client
+import hashlib
+import io
+import json
+import math
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+
+from django.core.management import CommandError, call_command
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.conf import settings
+from django.test import TestCase, Client, RequestFactory, override_settings
 from django.urls import reverse
+from django.utils import timezone
 from django.contrib.auth.models import User
-from .models import Character, Series, Group, Tag, Image, SiteSetting
+from django.core.files.uploadedfile import SimpleUploadedFile
+from PIL import Image as PILImage
+from .models import Character, Series, Group, Tag, Image, Job, RelatedImage, SiteSetting, Statistic, UploadSession, UserStats
+from . import jobs
+from .imaging import dhash
+from .storage import sharded_name
+from . import cards, counters, fast_read, page_cache, related, search, stats
+from .query_budget import QueryBudgetMixin, QueryRecorder, fingerprint
+from .prefetch import annotate_counts, prefetch_top
+from .related import related_images
+from .site_settings import SiteSettingsCache, site_settings
+from .pagination import CursorPaginator, approximate_count
+from .tag_query import Query, QueryError, Snapshot, TagIndex, parse, tag_index
+from .near_duplicates import MultiIndexHash, hamming, near_duplicate_index
+from .serializers import UploadSessionSerializer
+
+
+def make_upload(name='test.jpg', size=(1200, 800), color=(200, 100, 50), fmt='JPEG', content_type='image/jpeg'):
+    buf = io.BytesIO()
+    PILImage.new('RGB', size, color).save(buf, format=fmt)
+    return SimpleUploadedFile(name, buf.getvalue(), content_type=content_type)
+
+
+class MediaTestCase(TestCase):
+    """TestCase that writes uploads to a throwaway MEDIA_ROOT."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls._media_root = tempfile.mkdtemp()
+        cls._media_override = override_settings(MEDIA_ROOT=cls._media_root)
+        cls._media_override.enable()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls._media_override.disable()
+        shutil.rmtree(cls._media_root, ignore_errors=True)
 
 
 class BasicViewsTest(TestCase):
@@ -141,3 +192,1787 @@ class AdminTest(TestCase):
         """Test that admin users view is accessible"""
         response = self.client.get(reverse('admin_users'))
         self.assertEqual(response.status_code, 200)
+
+
+class ThumbnailTest(MediaTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='uploader', password='testpass123')
+
+    def test_image_save_generates_derivatives(self):
+        image = Image.objects.create(file=make_upload(), uploader=self.user, is_approved=True)
+        self.assertEqual((image.width, image.height), (1200, 800))
+        self.assertEqual(image.derivatives['source'], image.file.name)
+        self.assertEqual(set(image.derivatives['sizes']), {'256', '512', '1024'})
+        small = image.derivatives['sizes']['256']
+        with image.file.storage.open(small['webp']) as fh:
+            self.assertEqual(PILImage.open(fh).size, (256, 171))
+        self.assertIn('_512.jpeg', image.thumbnails.url)
+        self.assertIn('256w', image.thumbnails.webp_srcset)
+
+    def test_character_primary_image_derivatives_follow_field(self):
+        character = Character.objects.create(name='Thumb Girl', primary_image=make_upload('portrait.png', (300, 600), fmt='PNG', content_type='image/png'))
+        self.assertEqual(character.primary_image_derivatives['source'], character.primary_image.name)
+        self.assertEqual(character.primary_image_derivatives['sizes']['256']['width'], 128)
+        character.primary_image = None
+        character.save()
+        self.assertEqual(character.primary_image_derivatives, {})
+        self.assertEqual(character.primary_thumbnails.url, '')
+
+    def thumbnail_files(self, derivatives):
+        from django.core.files.storage import default_storage
+        names = [entry[ext] for entry in derivatives['sizes'].values() for ext in ('webp', 'jpeg')]
+        return [name for name in names if default_storage.exists(name)]
+
+    def test_replaced_and_cleared_portraits_release_their_thumbnails(self):
+        character = Character.objects.create(name='Thumb Girl', primary_image=make_upload('portrait.png', (300, 600), fmt='PNG', content_type='image/png'))
+        first = character.primary_image_derivatives
+        character = Character.objects.get(pk=character.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            character.primary_image = make_upload('other.png', (300, 600), color=(0, 0, 255), fmt='PNG', content_type='image/png')
+            character.save()
+        self.assertEqual(self.thumbnail_files(first), [])
+        second = character.primary_image_derivatives
+        self.assertEqual(len(self.thumbnail_files(second)), 6)
+        with self.captureOnCommitCallbacks(execute=True):
+            character.primary_image = None
+            character.save()
+        self.assertEqual(self.thumbnail_files(second), [])
+
+    def test_shared_thumbnails_go_with_the_last_image(self):
+        first = Image.objects.create(file=make_upload('a.jpg'), uploader=self.user)
+        second = Image.objects.create(file=make_upload('b.jpg'), uploader=self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertEqual(len(self.thumbnail_files(second.derivatives)), 6)
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertEqual(self.thumbnail_files(second.derivatives), [])
+
+    def test_gallery_and_api_use_thumbnails(self):
+        image = Image.objects.create(file=make_upload(), uploader=self.user, is_approved=True)
+        response = self.client.get(reverse('image_gallery'))
+        self.assertContains(response, image.thumbnails.url)
+        self.assertNotContains(response, f'src="{image.file.url}"')
+        data = self.client.get(f'/api/images/{image.pk}/').json()
+        self.assertTrue(data['thumbnails']['1024']['webp'].startswith('http://testserver/'))
+
+
+class RebuildThumbnailsCommandTest(MediaTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='uploader', password='testpass123')
+        self.images = [Image.objects.create(file=make_upload(f'img{i}.jpg'), uploader=self.user) for i in range(3)]
+        self.checkpoint = os.path.join(self._media_root, 'checkpoint.json')
+
+    def rebuild(self, *args):
+        out = io.StringIO()
+        call_command('rebuild_thumbnails', '--workers', '1', '--batch-size', '2', '--checkpoint', self.checkpoint, *args, stdout=out)
+        return out.getvalue()
+
+    def test_unchanged_sources_are_skipped(self):
+        output = self.rebuild()
+        self.assertIn('0 rebuilt, 3 unchanged', output)
+        self.assertIn('images/s', output)
+        output = self.rebuild('--force')
+        self.assertIn('3 rebuilt, 0 unchanged', output)
+
+    def test_missing_derivatives_are_rebuilt_in_bulk(self):
+        Image.objects.update(width=None, height=None, derivatives={})
+        self.rebuild()
+        for image in Image.objects.all():
+            self.assertEqual((image.width, image.height), (1200, 800))
+            self.assertEqual(image.derivatives['source'], image.file.name)
+            self.assertIn('fingerprint', image.derivatives)
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+    def test_resumes_from_checkpoint(self):
+        Image.objects.update(derivatives={})
+        with open(self.checkpoint, 'w') as fh:
+            json.dump({'image': self.images[1].pk}, fh)
+        self.rebuild()
+        self.assertEqual(Image.objects.get(pk=self.images[0].pk).derivatives, {})
+        self.assertTrue(Image.objects.get(pk=self.images[2].pk).derivatives)
+
+    def test_parallel_workers(self):
+        Image.objects.update(derivatives={})
+        out = io.StringIO()
+        call_command('rebuild_thumbnails', '--workers', '2', '--checkpoint', self.checkpoint, stdout=out)
+        self.assertIn('3 rebuilt', out.getvalue())
+        self.assertTrue(all(image.derivatives for image in Image.objects.all()))
+
+
+class SingleWriteUploadTest(MediaTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='uploader', password='testpass123')
+        self.client.login(username='uploader', password='testpass123')
+
+    def image_writes(self, queries):
+        return [q['sql'] for q in queries if 'onnanoko_image"' in q['sql'] and q['sql'].startswith(('INSERT', 'UPDATE'))]
+
+    def test_model_create_writes_row_once(self):
+        with CaptureQueriesContext(connection) as ctx:
+            image = Image.objects.create(file=make_upload(size=(640, 480)), uploader=self.user)
+        self.assertEqual(len(self.image_writes(ctx.captured_queries)), 1)
+        self.assertEqual((image.width, image.height, image.format), (640, 480, 'JPEG'))
+        self.assertEqual(image.derivatives['source'], image.file.name)
+
+    def test_html_upload_writes_row_once(self):
+        tag = Tag.objects.create(name='cute')
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.post(reverse('image_upload'), {
+                'files': [make_upload('a.png', (320, 200), fmt='PNG', content_type='image/png')],
+                'tags': [tag.pk],
+            })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.image_writes(ctx.captured_queries)), 1)
+        image = Image.objects.get()
+        self.assertEqual((image.width, image.height, image.format), (320, 200, 'PNG'))
+        self.assertEqual(list(image.tags.all()), [tag])
+
+    def test_api_create_fills_dimensions(self):
+        response = self.client.post('/api/images/', {'file': make_upload('api.webp', (50, 70), fmt='WEBP', content_type='image/webp')})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual((response.json()['width'], response.json()['height'], response.json()['format']), (50, 70, 'WEBP'))
+
+
+class ContentAddressedStorageTest(MediaTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='uploader', password='testpass123')
+        self.client.login(username='uploader', password='testpass123')
+
+    def test_file_stored_under_content_hash(self):
+        upload = make_upload('holiday.jpeg')
+        digest = hashlib.sha256(upload.read()).hexdigest()
+        image = Image.objects.create(file=upload, uploader=self.user)
+        self.assertEqual(image.sha256, digest)
+        self.assertEqual(image.file.name, f'images/{digest[:2]}/{digest[2:4]}/{digest}.jpg')
+
+    def test_identical_bytes_share_one_blob(self):
+        first = Image.objects.create(file=make_upload('a.jpg'), uploader=self.user)
+        second = Image.objects.create(file=make_upload('b.jpg'), uploader=self.user)
+        self.assertEqual(first.file.name, second.file.name)
+        self.assertEqual(first.derivatives, second.derivatives)
+        blobs = os.listdir(os.path.dirname(first.file.path))
+        self.assertEqual(blobs, [os.path.basename(first.file.name)])
+
+    def test_upload_view_short_circuits_duplicates(self):
+        existing = Image.objects.create(file=make_upload(), uploader=self.user)
+        response = self.client.post(reverse('image_upload'), {'files': [make_upload('again.jpg')]})
+        self.assertEqual(Image.objects.count(), 1)
+        self.assertEqual(response.context['duplicates'], [existing])
+        self.assertContains(response, reverse('image_detail', args=[existing.pk]))
+
+    def test_upload_handler_hashes_stream(self):
+        upload = make_upload(color=(1, 2, 3))
+        digest = hashlib.sha256(upload.read()).hexdigest()
+        upload.seek(0)
+        self.client.post(reverse('image_upload'), {'files': [upload]})
+        self.assertEqual(Image.objects.get().sha256, digest)
+
+    def test_api_create_returns_existing_image(self):
+        existing = Image.objects.create(file=make_upload(), uploader=self.user)
+        response = self.client.post('/api/images/', {'file': make_upload('copy.jpg')})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['id'], existing.pk)
+        self.assertEqual(Image.objects.count(), 1)
+
+    def test_backfill_hashes(self):
+        image = Image.objects.create(file=make_upload(), uploader=self.user)
+        digest = image.sha256
+        Image.objects.update(sha256='')
+        call_command('backfill_hashes', '--workers', '2', stdout=io.StringIO())
+        image.refresh_from_db()
+        self.assertEqual(image.sha256, digest)
+
+
+
+class NearDuplicateTest(MediaTestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser(username='admin', password='adminpass123', email='admin@example.com')
+        self.client.login(username='admin', password='adminpass123')
+        near_duplicate_index.rebuild()
+
+    def gradient(self, size=(400, 300)):
+        img = PILImage.effect_mandelbrot(size, (-2, -1.5, 1, 1.5), 100).convert('RGB')
+        buf = io.BytesIO()
+        img.save(buf, format='JPEG', quality=95)
+        return img, buf.getvalue()
+
+    def test_dhash_survives_resize_and_reencode(self):
+        img, _ = self.gradient()
+        small = img.resize((200, 150))
+        buf = io.BytesIO()
+        small.save(buf, format='JPEG', quality=40)
+        buf.seek(0)
+        with PILImage.open(buf) as reencoded:
+            self.assertLessEqual(hamming(dhash(img), dhash(reencoded)), 4)
+
+    def test_multi_index_matches_brute_force(self):
+        import random
+        rng = random.Random(1)
+        hashes = {i: rng.getrandbits(64) for i in range(2000)}
+        base = hashes[0]
+        for i in range(1, 30):
+            hashes[i] = base ^ sum(1 << bit for bit in rng.sample(range(64), i % 12))
+        index = MultiIndexHash()
+        for item_id, value in hashes.items():
+            index.add(item_id, value)
+        for radius in (0, 4, 10):
+            expected = sorted((hamming(v, base), i) for i, v in hashes.items() if hamming(v, base) <= radius)
+            self.assertEqual(index.search(base, radius), expected)
+        index.discard(0)
+        self.assertNotIn(0, [i for _, i in index.search(base, 10)])
+
+    def test_upload_records_phash_and_finds_variant(self):
+        img, original = self.gradient()
+        first = Image.objects.create(file=SimpleUploadedFile('a.jpg', original, content_type='image/jpeg'), uploader=self.admin)
+        buf = io.BytesIO()
+        img.resize((300, 225)).save(buf, format='JPEG', quality=50)
+        second = Image.objects.create(file=SimpleUploadedFile('b.jpg', buf.getvalue(), content_type='image/jpeg'), uploader=self.admin)
+        unrelated = Image.objects.create(file=make_upload(color=(10, 200, 30)), uploader=self.admin)
+        self.assertIsNotNone(first.phash)
+        self.assertNotEqual(first.sha256, second.sha256)
+
+        response = self.client.get(f'/api/images/{second.pk}/near-duplicates/')
+        self.assertEqual(response.status_code, 200)
+        ids = [match['image']['id'] for match in response.json()]
+        self.assertIn(first.pk, ids)
+        self.assertNotIn(second.pk, ids)
+        self.assertNotIn(unrelated.pk, ids)
+
+    def test_pending_page_lists_possible_duplicates(self):
+        _, original = self.gradient()
+        approved = Image.objects.create(file=SimpleUploadedFile('a.jpg', original, content_type='image/jpeg'), uploader=self.admin, is_approved=True)
+        pending = Image.objects.create(file=SimpleUploadedFile('b.png', self.png(), content_type='image/png'), uploader=self.admin)
+        response = self.client.get(reverse('admin_pending_uploads'))
+        self.assertEqual(response.status_code, 200)
+        candidates = {image.pk: image.near_duplicates for image in response.context['images']}
+        self.assertIn(approved.pk, [other.pk for _, other in candidates[pending.pk]])
+        self.assertContains(response, 'Possible duplicates')
+
+    def png(self):
+        img, _ = self.gradient()
+        buf = io.BytesIO()
+        img.save(buf, format='PNG')
+        return buf.getvalue()
+
+    def test_backfill_fills_phash(self):
+        image = Image.objects.create(file=make_upload(), uploader=self.admin)
+        phash = image.phash
+        Image.objects.update(phash=None)
+        call_command('backfill_hashes', stdout=io.StringIO())
+        image.refresh_from_db()
+        self.assertLessEqual(hamming(image.phash, phash), 2)
+
+
+class JobQueueTest(MediaTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='uploader', password='testpass123')
+        self.client.login(username='uploader', password='testpass123')
+
+    def test_upload_view_defers_processing(self):
+        self.client.post(reverse('image_upload'), {'files': [make_upload('big.jpg', (1600, 1200))]})
+        image = Image.objects.get()
+        self.assertEqual(image.status, Image.PROCESSING)
+        self.assertEqual(image.derivatives, {})
+        self.assertEqual((image.width, image.height), (1600, 1200))
+        job = Job.objects.get()
+        self.assertEqual((job.kind, job.payload), ('image.process', {'image_id': image.pk}))
+
+        out = io.StringIO()
+        call_command('run_worker', '--burst', stdout=out)
+        self.assertIn('1 jobs completed', out.getvalue())
+        image.refresh_from_db()
+        self.assertEqual(image.status, Image.READY)
+        self.assertEqual(image.derivatives['source'], image.file.name)
+        self.assertIsNotNone(image.phash)
+        self.assertFalse(Job.objects.exists())
+
+    def test_api_reports_status(self):
+        response = self.client.post('/api/images/', {'file': make_upload('api.jpg')})
+        self.assertEqual(response.json()['status'], Image.PROCESSING)
+        call_command('run_worker', '--burst', stdout=io.StringIO())
+        response = self.client.get(f"/api/images/{response.json()['id']}/")
+        self.assertEqual(response.json()['status'], Image.READY)
+
+    def test_duplicate_of_processed_image_is_ready_immediately(self):
+        Image.objects.create(file=make_upload(), uploader=self.user)
+        twin = Image.objects.create(file=make_upload('twin.jpg'), uploader=self.user, status=Image.PROCESSING)
+        self.assertEqual(twin.status, Image.READY)
+        self.assertFalse(Job.objects.exists())
+
+    def test_failing_job_retries_then_marks_image_failed(self):
+        data = make_upload().read()
+        upload = SimpleUploadedFile('broken.jpg', data[:len(data) // 3], content_type='image/jpeg')
+        image = Image.objects.create(file=upload, uploader=self.user, status=Image.PROCESSING)
+        job = Job.objects.get()
+        job.max_attempts = 2
+        job.save()
+
+        [claimed] = jobs.claim('test')
+        self.assertFalse(jobs.run(claimed))
+        claimed.refresh_from_db()
+        self.assertEqual((claimed.status, claimed.attempts), (Job.QUEUED, 1))
+        self.assertEqual(jobs.claim('test'), [])  # backing off
+
+        Job.objects.update(run_after=claimed.created_at)
+        [claimed] = jobs.claim('test')
+        self.assertFalse(jobs.run(claimed))
+        claimed.refresh_from_db()
+        self.assertEqual(claimed.status, Job.FAILED)
+        self.assertIn('Traceback', claimed.last_error)
+        image.refresh_from_db()
+        self.assertEqual(image.status, Image.FAILED)
+
+    def test_stale_running_jobs_are_requeued(self):
+        job = Job.enqueue('image.process', image_id=0)
+        jobs.claim('dead-worker')
+        Job.objects.update(locked_at=job.created_at - timedelta(hours=1))
+        self.assertEqual(jobs.requeue_stale(), 1)
+        self.assertEqual(Job.objects.get().status, Job.QUEUED)
+
+
+class ChunkedUploadTest(MediaTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='uploader', password='testpass123')
+        self.client.login(username='uploader', password='testpass123')
+        self.data = make_upload('large.png', (300, 200), fmt='PNG', content_type='image/png').read()
+        self.digest = hashlib.sha256(self.data).hexdigest()
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir, ignore_errors=True)
+        patcher = override_settings(CHUNKED_UPLOAD_TEMP_DIR=temp_dir)
+        patcher.enable()
+        self.addCleanup(patcher.disable)
+
+    def start(self, **overrides):
+        body = {'filename': 'large.png', 'content_type': 'image/png', 'size': len(self.data), 'sha256': self.digest}
+        body.update(overrides)
+        response = self.client.post('/api/images/uploads/', body, content_type='application/json')
+        self.assertEqual(response.status_code, 201, response.content)
+        return f"/api/images/uploads/{response.json()['id']}/"
+
+    def put(self, url, start, end, data=None, **headers):
+        body = self.data[start:end] if data is None else data
+        return self.client.put(url, body, content_type='application/octet-stream',
+                               HTTP_CONTENT_RANGE=f'bytes {start}-{end - 1}/{len(self.data)}', **headers)
+
+    def test_out_of_order_chunks_then_finalize(self):
+        url = self.start()
+        middle = len(self.data) // 2
+        response = self.put(url, middle, len(self.data), HTTP_X_CHUNK_SHA256=hashlib.sha256(self.data[middle:]).hexdigest())
+        self.assertEqual(response.json()['received'], [[middle, len(self.data)]])
+        self.assertEqual(self.client.post(url + 'finalize/').status_code, 409)
+
+        self.put(url, 0, middle)
+        self.assertEqual(self.client.get(url).json()['received_bytes'], len(self.data))
+        tag = Tag.objects.create(name='Chunked')
+        response = self.client.post(url + 'finalize/', {'description': 'Big one', 'tag_ids': [tag.pk]}, content_type='application/json')
+        self.assertEqual(response.status_code, 201, response.content)
+        image = Image.objects.get()
+        self.assertEqual((image.sha256, image.status, image.description), (self.digest, Image.PROCESSING, 'Big one'))
+        self.assertEqual(list(image.tags.all()), [tag])
+        with image.file.open('rb') as fh:
+            self.assertEqual(fh.read(), self.data)
+        self.assertEqual(os.listdir(settings.CHUNKED_UPLOAD_TEMP_DIR), [])
+
+        # A retried finalize returns the same image.
+        response = self.client.post(url + 'finalize/')
+        self.assertEqual((response.status_code, response.json()['id']), (200, image.pk))
+
+    def test_checksum_mismatch_resets_session(self):
+        url = self.start(sha256='0' * 64)
+        self.put(url, 0, len(self.data))
+        response = self.client.post(url + 'finalize/')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(UploadSession.objects.get().received, [])
+        self.assertFalse(Image.objects.exists())
+
+    def test_rejects_bad_ranges_and_chunks(self):
+        url = self.start()
+        response = self.client.put(url, b'x', content_type='application/octet-stream', HTTP_CONTENT_RANGE=f'bytes 0-0/{len(self.data) + 1}')
+        self.assertEqual(response.status_code, 416)
+        response = self.put(url, 0, 10, HTTP_X_CHUNK_SHA256='0' * 64)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(UploadSession.objects.get().received, [])
+
+    @override_settings(IMAGE_MAX_PIXELS=100 * 100)
+    def test_finalize_enforces_the_pixel_limit(self):
+        url = self.start()
+        self.put(url, 0, len(self.data))
+        response = self.client.post(url + 'finalize/')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('too large', response.json()['detail'])
+        self.assertFalse(Image.objects.exists())
+
+    def test_finalize_returns_existing_duplicate(self):
+        existing = Image.objects.create(file=SimpleUploadedFile('a.png', self.data, content_type='image/png'), uploader=self.user)
+        url = self.start()
+        self.put(url, 0, len(self.data))
+        response = self.client.post(url + 'finalize/')
+        self.assertEqual((response.status_code, response.json()['id']), (200, existing.pk))
+        self.assertEqual(Image.objects.count(), 1)
+
+    def test_purge_removes_stale_sessions(self):
+        url = self.start()
+        self.put(url, 0, 10)
+        UploadSession.objects.update(updated_at=UploadSession.objects.get().created_at - timedelta(days=2))
+        call_command('purge_upload_sessions', stdout=io.StringIO())
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertEqual(os.listdir(settings.CHUNKED_UPLOAD_TEMP_DIR), [])
+
+    def test_sessions_are_private(self):
+        url = self.start()
+        User.objects.create_user(username='other', password='testpass123')
+        self.client.login(username='other', password='testpass123')
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+
+class BatchUploadTest(MediaTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='uploader', password='testpass123')
+        self.client.login(username='uploader', password='testpass123')
+
+    def test_batch_is_inserted_with_one_query_per_table(self):
+        character = Character.objects.create(name='Batch Girl')
+        tags = [Tag.objects.create(name='One'), Tag.objects.create(name='Two')]
+        files = [make_upload(f'{i}.jpg', color=(i * 40, 10, 10)) for i in range(4)]
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.post(reverse('image_upload'), {
+                'files': files, 'characters': [character.pk], 'tags': [tag.pk for tag in tags],
+            })
+        self.assertTrue(response.context['success'])
+        inserts = [q['sql'] for q in ctx.captured_queries if q['sql'].startswith(('INSERT INTO "onnanoko_image', 'INSERT INTO "onnanoko_job'))]
+        self.assertEqual(len(inserts), 4)  # images, jobs, characters, tags
+        self.assertEqual(Image.objects.count(), 4)
+        self.assertEqual(Job.objects.count(), 4)
+        for image in Image.objects.all():
+            self.assertEqual(list(image.characters.all()), [character])
+            self.assertEqual(set(image.tags.all()), set(tags))
+
+    def test_errors_are_reported_per_file(self):
+        good = make_upload('good.jpg')
+        data = make_upload('broken.jpg', color=(1, 1, 1)).read()
+        broken = SimpleUploadedFile('broken.jpg', data[:len(data) // 2], content_type='image/jpeg')
+        text = SimpleUploadedFile('notes.txt', b'hello', content_type='text/plain')
+        response = self.client.post(reverse('image_upload'), {'files': [good, broken, text]})
+        self.assertEqual(response.context['errors'], [
+            'broken.jpg: Invalid image file.',
+            'notes.txt: Only JPEG, PNG, and WEBP images are allowed.',
+        ])
+        self.assertEqual(Image.objects.count(), 1)
+
+    @override_settings(IMAGE_MAX_PIXELS=100 * 100)
+    def test_rejects_images_over_pixel_limit(self):
+        response = self.client.post(reverse('image_upload'), {'files': [make_upload('huge.png', (200, 200), fmt='PNG', content_type='image/png')]})
+        self.assertEqual(response.context['errors'], ['huge.png: Image is too large (200×200 pixels).'])
+        self.assertFalse(Image.objects.exists())
+
+    def test_repeated_file_in_batch_is_stored_once(self):
+        self.client.post(reverse('image_upload'), {'files': [make_upload('a.jpg'), make_upload('b.jpg')]})
+        self.assertEqual(Image.objects.count(), 1)
+
+
+class PlaceholderTest(MediaTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='uploader', password='testpass123')
+
+    def test_image_gets_placeholder_and_dominant_color(self):
+        image = Image.objects.create(file=make_upload(color=(200, 100, 50), fmt='PNG', content_type='image/png'), uploader=self.user)
+        self.assertTrue(image.placeholder.startswith('data:image/webp;base64,'))
+        self.assertLess(len(image.placeholder), 400)
+        self.assertEqual(image.dominant_color, '#c86432')
+
+    def test_placeholder_inlined_in_cards_and_api(self):
+        image = Image.objects.create(file=make_upload(), uploader=self.user, is_approved=True)
+        response = self.client.get(reverse('image_gallery'))
+        self.assertContains(response, f'background-color: {image.dominant_color};')
+        self.assertContains(response, image.placeholder)
+        data = self.client.get(f'/api/images/{image.pk}/').json()
+        self.assertEqual((data['placeholder'], data['dominant_color']), (image.placeholder, image.dominant_color))
+
+    def test_character_portrait_placeholder_follows_field(self):
+        character = Character.objects.create(name='Placeholder', primary_image=make_upload('p.png', color=(0, 0, 255), fmt='PNG', content_type='image/png'))
+        self.assertEqual(character.primary_image_color, '#0000ff')
+        self.assertTrue(character.primary_image_placeholder)
+        character.primary_image = None
+        character.save()
+        self.assertEqual((character.primary_image_placeholder, character.primary_image_color), ('', ''))
+
+    def test_backfill_placeholders(self):
+        image = Image.objects.create(file=make_upload(), uploader=self.user)
+        character = Character.objects.create(name='Backfill', primary_image=make_upload('c.jpg'))
+        Image.objects.update(placeholder='', dominant_color='')
+        Character.objects.update(primary_image_placeholder='', primary_image_color='')
+        card_key = cards.key(image)
+        out = io.StringIO()
+        call_command('backfill_placeholders', '--workers', '2', stdout=out)
+        self.assertIn('2 placeholders computed', out.getvalue())
+        image.refresh_from_db()
+        character.refresh_from_db()
+        self.assertTrue(image.placeholder.startswith('data:image/webp;base64,'))
+        self.assertTrue(character.primary_image_color)
+        # Cached cards carry the placeholder: the rows get new card versions.
+        self.assertNotEqual(cards.key(image), card_key)
+
+
+class ShardMediaTest(MediaTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='uploader', password='testpass123')
+
+    def legacy_image(self, name, **kwargs):
+        """An Image row as older code left it: flat file name, flat thumbnails."""
+        from django.core.files.storage import default_storage
+        from .thumbnails import render_thumbnails
+        upload = make_upload(name, **kwargs)
+        default_storage.save(f'images/{name}', upload)
+        with PILImage.open(upload) as img:
+            derivatives = render_thumbnails(img, f'images/{name}')
+        image = Image.objects.create(file=make_upload(), uploader=self.user)
+        Image.objects.filter(pk=image.pk).update(file=f'images/{name}', sha256='', format='', derivatives=derivatives)
+        return Image.objects.get(pk=image.pk)
+
+    def test_character_uploads_are_sharded(self):
+        character = Character.objects.create(name='Sharded', primary_image=make_upload('portrait.jpg'))
+        self.assertEqual(character.primary_image.name, sharded_name('characters', 'portrait.jpg'))
+
+    def test_moves_files_and_repoints_rows(self):
+        image = self.legacy_image('old.jpg', color=(9, 9, 9))
+        old_thumb = image.derivatives['sizes']['256']['webp']
+        out = io.StringIO()
+        call_command('shard_media', '--workers', '2', stdout=out)
+        self.assertIn('rows moved, 0 failed', out.getvalue())
+
+        image.refresh_from_db()
+        self.assertEqual(image.file.name, sharded_name('images', 'old.jpg'))
+        self.assertTrue(os.path.exists(image.file.path))
+        self.assertEqual(image.derivatives['source'], image.file.name)
+        new_thumb = image.derivatives['sizes']['256']['webp']
+        self.assertTrue(new_thumb.startswith(f'thumbs/{os.path.splitext(image.file.name)[0]}'))
+        self.assertTrue(os.path.exists(os.path.join(settings.MEDIA_ROOT, new_thumb)))
+        self.assertFalse(os.path.exists(os.path.join(settings.MEDIA_ROOT, 'images', 'old.jpg')))
+        self.assertFalse(os.path.exists(os.path.join(settings.MEDIA_ROOT, old_thumb)))
+
+    def test_old_paths_keep_resolving_when_kept(self):
+        self.legacy_image('keep.jpg')
+        call_command('shard_media', '--keep-old', stdout=io.StringIO())
+        self.assertTrue(os.path.exists(os.path.join(settings.MEDIA_ROOT, 'images', 'keep.jpg')))
+
+    def test_unmigrated_rows_keep_their_files(self):
+        image = self.legacy_image('present.jpg')
+        Image.objects.filter(pk=image.pk).update(file='images/missing.jpg')
+        other = self.legacy_image('other.jpg', color=(1, 200, 1))
+        out = io.StringIO()
+        call_command('shard_media', stdout=out)
+        self.assertIn('1 failed', out.getvalue())
+        self.assertEqual(Image.objects.get(pk=image.pk).file.name, 'images/missing.jpg')
+        other.refresh_from_db()
+        self.assertEqual(other.file.name, sharded_name('images', 'other.jpg'))
+
+
+class SearchTest(MediaTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='searcher', password='testpass123')
+        self.series = Series.objects.create(name='Starlight Stage')
+        self.idol = Tag.objects.create(name='Idol')
+        self.miku = Character.objects.create(name='Hatsune Miku', description='Virtual singer', series=self.series)
+        self.miku.tags.add(self.idol)
+        self.rin = Character.objects.create(name='Kagamine Rin', description='Often seen next to Hatsune Miku')
+
+    def ids(self, kind, query):
+        return search.search_ids(kind, query)
+
+    def test_matches_names_series_and_tags_by_word_prefix(self):
+        self.assertEqual(self.ids('character', 'starl'), [self.miku.pk])
+        self.assertEqual(self.ids('character', 'idol'), [self.miku.pk])
+        self.assertEqual(self.ids('character', 'virtual sing'), [self.miku.pk])
+        self.assertEqual(self.ids('character', '"); drop table --'), [])
+
+    def test_name_matches_rank_above_description_matches(self):
+        self.assertEqual(self.ids('character', 'miku'), [self.miku.pk, self.rin.pk])
+
+    def test_index_follows_m2m_and_renames(self):
+        group = Group.objects.create(name='Crypton')
+        self.rin.groups.add(group)
+        self.assertEqual(self.ids('character', 'crypton'), [self.rin.pk])
+        group.name = 'Piapro'
+        group.save()
+        self.assertEqual(self.ids('character', 'crypton'), [])
+        self.assertEqual(self.ids('character', 'piapro'), [self.rin.pk])
+        self.idol.characters.clear()
+        self.assertEqual(self.ids('character', 'idol'), [])
+        self.series.delete()
+        self.assertEqual(self.ids('character', 'starlight'), [])
+
+    def test_image_documents(self):
+        image = Image.objects.create(file=make_upload(), uploader=self.user, illustrator='KEI', is_approved=True)
+        image.characters.add(self.miku)
+        self.assertEqual(self.ids('image', 'hatsune kei'), [image.pk])
+        self.miku.name = 'Miku Hatsune (V3)'
+        self.miku.save()
+        self.assertEqual(self.ids('image', 'v3'), [image.pk])
+        image.delete()
+        self.assertEqual(self.ids('image', 'kei'), [])
+
+    @override_settings(SEARCH_SYNC_REINDEX_LIMIT=1)
+    def test_large_renames_are_queued(self):
+        self.rin.tags.add(self.idol)
+        self.idol.name = 'Singer'
+        self.idol.save()
+        self.assertEqual(Job.objects.filter(kind='search.reindex').count(), 2)
+        call_command('run_worker', '--burst', stdout=io.StringIO())
+        self.assertEqual(sorted(self.ids('character', 'singer')), sorted([self.miku.pk, self.rin.pk]))
+
+    def test_views_and_api_use_the_index(self):
+        response = self.client.get(reverse('character_list'), {'search': 'miku'})
+        self.assertEqual([c.pk for c in response.context['characters']], [self.miku.pk, self.rin.pk])
+        response = self.client.get(reverse('character_list'), {'search': 'miku', 'type': '3d'})
+        self.assertEqual(list(response.context['characters']), [])
+        response = self.client.get('/api/characters/', {'search': 'idol'})
+        self.assertEqual([c['id'] for c in response.json()['results']], [self.miku.pk])
+
+        approved = Image.objects.create(file=make_upload(), uploader=self.user, description='Stage photo', is_approved=True)
+        Image.objects.create(file=make_upload(color=(5, 5, 5)), uploader=self.user, description='Stage draft')
+        response = self.client.get(reverse('image_gallery'), {'search': 'stage'})
+        self.assertEqual([i.pk for i in response.context['images']], [approved.pk])
+
+    def test_capped_results_say_so(self):
+        response = self.client.get('/api/characters/', {'search': 'miku'})
+        self.assertNotIn('truncated', response.json())
+        with self.settings(SEARCH_MAX_RESULTS=1):
+            response = self.client.get('/api/characters/', {'search': 'miku'})
+            self.assertEqual(response.json()['results'][0]['id'], self.miku.pk)
+            self.assertIs(response.json()['truncated'], True)
+            response = self.client.get(reverse('character_list'), {'search': 'miku'})
+            self.assertContains(response, 'of the best 1 characters')
+
+    def test_batch_uploads_are_indexed(self):
+        self.client.login(username='searcher', password='testpass123')
+        self.client.post(reverse('image_upload'), {'files': [make_upload()], 'characters': [self.rin.pk], 'description': 'Bulk'})
+        self.assertEqual(self.ids('image', 'kagamine bulk'), [Image.objects.get().pk])
+
+    def test_rebuild_search_index(self):
+        from .models import SearchDocument
+        SearchDocument.objects.all().delete()
+        call_command('rebuild_search_index', stdout=io.StringIO())
+        self.assertEqual(self.ids('character', 'idol'), [self.miku.pk])
+
+
+class TagQueryTest(MediaTestCase):
+    def setUp(self):
+        tag_index.invalidate()
+        self.user = User.objects.create_user(username='tagger', password='testpass123')
+        self.idolmaster = Series.objects.create(name='Idolmaster')
+        self.unit = Group.objects.create(name='765 Pro')
+        self.haruka = Character.objects.create(name='Haruka Amami', series=self.idolmaster)
+        self.haruka.groups.add(self.unit)
+        self.chihaya = Character.objects.create(name='Chihaya Kisaragi', series=self.idolmaster)
+        self.cute, self.school, self.swimsuit = (Tag.objects.create(name=n) for n in ('cute', 'school', 'swimsuit'))
+        self.images = []
+        for i, (tags, characters) in enumerate([
+            ([self.cute, self.school], [self.haruka]),
+            ([self.cute, self.school, self.swimsuit], [self.haruka]),
+            ([self.cute], [self.chihaya]),
+            ([self.school], []),
+        ]):
+            image = Image.objects.create(file=make_upload(size=(40, 30), color=(i, 0, 0)), uploader=self.user, is_approved=True)
+            image.tags.set(tags)
+            image.characters.set(characters)
+            self.images.append(image)
+        a, b, c, d = self.images
+        self.a, self.b, self.c, self.d = a, b, c, d
+
+    def ids(self, text):
+        return tag_index.match(parse(text)).ids()
+
+    def test_parse(self):
+        self.assertEqual(
+            parse('cute -swimsuit ~maid ~nurse Character:Haruka-Amami series:idolmaster re:zero'),
+            Query(
+                required=[('tag', 'cute'), ('character', 'haruka-amami'), ('series', 'idolmaster'), ('tag', 'rezero')],
+                any=[('tag', 'maid'), ('tag', 'nurse')],
+                excluded=[('tag', 'swimsuit')],
+            ),
+        )
+        self.assertEqual(parse('~solo'), Query(required=[('tag', 'solo')]))
+        self.assertFalse(parse('  '))
+        with self.assertRaises(QueryError):
+            parse('cute -')
+
+    def test_intersect_union_and_subtract_newest_first(self):
+        self.assertEqual(self.ids('cute school'), [self.b.pk, self.a.pk])
+        self.assertEqual(self.ids('cute school -swimsuit character:haruka-amami series:idolmaster'), [self.a.pk])
+        self.assertEqual(self.ids('~swimsuit ~character:chihaya-kisaragi'), [self.c.pk, self.b.pk])
+        self.assertEqual(self.ids('group:765-pro'), [self.b.pk, self.a.pk])
+        self.assertEqual(self.ids('-cute'), [self.d.pk])
+        self.assertEqual(self.ids('cute nosuchtag'), [])
+        match = tag_index.match(parse('school'))
+        self.assertEqual(match.count(), 3)
+        self.assertEqual(match.ids(1, 2), [self.b.pk])
+        self.assertIn(self.a.pk, match)
+        self.assertNotIn(self.c.pk, match)
+
+    def test_index_follows_approval_tags_and_deletes(self):
+        self.ids('cute')
+        self.b.is_approved = False
+        self.b.save()
+        self.assertEqual(self.ids('cute'), [self.c.pk, self.a.pk])
+        self.d.tags.add(self.cute)
+        self.cute.images.remove(self.a)
+        self.assertEqual(self.ids('cute'), [self.d.pk, self.c.pk])
+        self.c.delete()
+        self.assertEqual(self.ids('cute'), [self.d.pk])
+        self.haruka.series = None
+        self.haruka.save()
+        self.assertEqual(self.ids('series:idolmaster'), [])
+
+    def test_late_approval_keeps_upload_order(self):
+        self.ids('cute')
+        Image.objects.filter(pk=self.b.pk).update(is_approved=False)
+        tag_index.invalidate()
+        self.ids('cute')
+        self.b.is_approved = True
+        self.b.save()
+        self.assertEqual(self.ids('cute'), [self.c.pk, self.b.pk, self.a.pk])
+
+    def test_other_processes_changes_trigger_a_rebuild(self):
+        self.ids('cute')
+        Image.objects.filter(pk=self.a.pk).update(is_approved=False)
+        tag_index.invalidate()
+        self.assertEqual(self.ids('cute'), [self.c.pk, self.b.pk])
+
+    def test_sparse_postings_are_arrays(self):
+        snapshot = Snapshot(((pk, None) for pk in range(100)), [(0, 'rare'), *((pk, 'common') for pk in range(50))])
+        self.assertNotIsInstance(snapshot.postings['rare'], int)
+        self.assertIsInstance(snapshot.postings['common'], int)
+        self.assertEqual(snapshot.bitmap('rare'), 1)
+        self.assertEqual(snapshot.size('common'), 50)
+
+    def test_gallery_explore_and_api(self):
+        self.ids('cute')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('image_gallery'), {'q': 'cute -swimsuit'})
+        self.assertEqual([i.pk for i in response.context['images']], [self.c.pk, self.a.pk])
+        # Only the page's own prefetch touches the tag tables.
+        joins = [q for q in queries if 'onnanoko_image_tags' in q['sql'] and '_prefetch_related_val' not in q['sql']]
+        self.assertFalse(joins)
+
+        response = self.client.get(reverse('image_gallery'), {'q': '-'})
+        self.assertTrue(response.context['query_error'])
+
+        response = self.client.get(reverse('series_explore', args=[self.idolmaster.slug]))
+        self.assertEqual([i.pk for i in response.context['images']], [self.c.pk, self.b.pk, self.a.pk])
+
+        response = self.client.get('/api/images/', {'q': 'school -swimsuit'})
+        self.assertEqual([i['id'] for i in response.json()['results']], [self.d.pk, self.a.pk])
+        response = self.client.get('/api/images/', {'q': 'school', 'characters': self.haruka.pk})
+        self.assertEqual([i['id'] for i in response.json()['results']], [self.b.pk, self.a.pk])
+        self.assertEqual(self.client.get('/api/images/', {'q': '~'}).status_code, 400)
+
+    def test_bulk_approval_updates_the_index(self):
+        self.ids('cute')
+        Image.objects.filter(pk=self.a.pk).update(is_approved=False)
+        tag_index.invalidate()
+        self.assertEqual(self.ids('cute'), [self.c.pk, self.b.pk])
+        admin = User.objects.create_user(username='boss', password='testpass123', is_staff=True)
+        self.client.force_login(admin)
+        self.client.post(reverse('admin_pending_uploads'), {'action': 'approve', 'image_ids': str(self.a.pk)})
+        self.assertEqual(self.ids('cute'), [self.c.pk, self.b.pk, self.a.pk])
+
+    def test_other_workers_rebuild_after_the_commit(self):
+        Image.objects.filter(pk=self.d.pk).update(is_approved=False)
+        tag_index.invalidate()
+        self.assertEqual(self.ids('school'), [self.b.pk, self.a.pk])
+        other_worker = TagIndex()
+        other_worker.current()
+        self.client.force_login(User.objects.create_user(username='boss', password='testpass123', is_staff=True))
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                self.client.post(reverse('admin_pending_uploads'), {'action': 'approve', 'image_ids': str(self.d.pk)})
+                # Rebuilt before the commit: another worker would read the old rows here.
+                seen_early = other_worker.current()
+        snapshot = tag_index.snapshot
+        self.assertIsNot(other_worker.current(), seen_early)
+        self.assertIs(tag_index.current(), snapshot)
+        self.assertEqual(self.ids('school'), [self.d.pk, self.b.pk, self.a.pk])
+
+
+class CursorPaginationTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='pager', password='testpass123')
+        Image.objects.bulk_create([Image(uploader=self.user, is_approved=True) for _ in range(7)])
+        # Two uploads in the same instant must still page in a stable order.
+        ids = list(Image.objects.order_by('pk').values_list('pk', flat=True))
+        same = Image.objects.get(pk=ids[3]).uploaded_at
+        Image.objects.filter(pk=ids[4]).update(uploaded_at=same)
+        self.expected = list(Image.objects.order_by('-uploaded_at', '-id').values_list('pk', flat=True))
+
+    def walk(self, paginator):
+        seen, page = [], paginator.page()
+        while True:
+            seen += [image.pk for image in page]
+            if not page.has_next():
+                return seen, page
+            page = paginator.page(page.next_cursor)
+
+    def test_forward_and_back(self):
+        paginator = CursorPaginator(Image.objects.all(), 3)
+        seen, page = self.walk(paginator)
+        self.assertEqual(seen, self.expected)
+        back = []
+        while page.has_previous():
+            page = paginator.page(page.previous_cursor)
+            back = [image.pk for image in page] + back
+        self.assertEqual(back, self.expected[:6])
+        self.assertFalse(page.has_previous())
+
+    def test_pages_use_keyset_queries(self):
+        paginator = CursorPaginator(Image.objects.all(), 3)
+        cursor = paginator.page().next_cursor
+        with CaptureQueriesContext(connection) as queries:
+            paginator.page(cursor)
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('OFFSET', queries[0]['sql'])
+        self.assertNotIn('COUNT', queries[0]['sql'])
+        self.assertEqual(approximate_count(Image.objects.all()), (7, False))
+
+    def test_views_and_api(self):
+        response = self.client.get(reverse('image_gallery'))
+        page = response.context['page_obj']
+        self.assertEqual([i.pk for i in page], self.expected[:7])
+        self.assertFalse(page.has_next())
+        self.assertEqual(self.client.get(reverse('image_gallery'), {'cursor': 'nonsense'}).status_code, 404)
+
+        response = self.client.get('/api/images/', {'page_size': 4}).json()
+        self.assertEqual([i['id'] for i in response['results']], self.expected[:4])
+        self.assertIsNone(response['previous'])
+        response = self.client.get(response['next']).json()
+        self.assertEqual([i['id'] for i in response['results']], self.expected[4:])
+        self.assertIsNone(response['next'])
+        self.assertEqual(self.client.get('/api/images/', {'cursor': 'e30'}).status_code, 404)
+        # Without paging parameters the API returns the first page.
+        response = self.client.get('/api/images/').json()
+        self.assertEqual([i['id'] for i in response['results']], self.expected)
+        self.assertIsNone(response['next'])
+
+        staff = User.objects.create_user(username='admin', password='testpass123', is_staff=True)
+        self.client.force_login(staff)
+        response = self.client.get(reverse('admin_users'))
+        self.assertEqual([u.pk for u in response.context['users']], [staff.pk, self.user.pk])
+
+
+# Measures the rendering itself, which the page cache would skip.
+@override_settings(PAGE_CACHE_TIMEOUT=0)
+class ExplorePagesTest(TestCase):
+    def setUp(self):
+        tag_index.invalidate()
+        self.user = User.objects.create_user(username='explorer', password='testpass123')
+        self.tag = Tag.objects.create(name='Maid')
+        self.series = Series.objects.create(name='Love Live')
+        self.characters = [Character.objects.create(name=f'Idol {i:02}', series=self.series) for i in range(15)]
+        for character in self.characters:
+            character.tags.add(self.tag)
+        self.images = []
+        for i in range(30):
+            image = Image.objects.create(uploader=self.user, is_approved=True)
+            image.tags.add(self.tag)
+            image.characters.add(self.characters[i % 15])
+            self.images.append(image)
+        self.newest_first = [image.pk for image in reversed(self.images)]
+
+    def test_missing_slug_is_404(self):
+        for name in ('tag_explore', 'group_explore', 'series_explore'):
+            self.assertEqual(self.client.get(reverse(name, args=['nope'])).status_code, 404)
+        url = reverse('tag_explore_fragment', args=[self.tag.slug, 'everything'])
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_first_page_is_bounded(self):
+        url = reverse('tag_explore', args=[self.tag.slug])
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual([c.name for c in response.context['characters']], [f'Idol {i:02}' for i in range(12)])
+        self.assertEqual([i.pk for i in response.context['images']], self.newest_first[:24])
+        self.assertLessEqual(len(queries), 6)
+        self.assertFalse([q for q in queries if 'onnanoko_image_characters' in q['sql']])
+
+    def test_fragments_continue_from_the_cursor(self):
+        response = self.client.get(reverse('series_explore', args=[self.series.slug]))
+        data = self.client.get(response.context['images_next']).json()
+        self.assertEqual(data['html'].count('<a href="/image/'), 6)
+        self.assertIn(f'/image/{self.newest_first[24]}/', data['html'])
+        self.assertIsNone(data['next'])
+
+        data = self.client.get(response.context['characters_next']).json()
+        self.assertIn('Idol 12', data['html'])
+        self.assertIn('Love Live', data['html'])
+        self.assertIsNone(data['next'])
+        url = reverse('series_explore_fragment', args=[self.series.slug, 'images'])
+        self.assertEqual(self.client.get(url, {'cursor': 'garbage'}).status_code, 404)
+
+    def test_resumes_after_the_cursor_image_is_deleted(self):
+        response = self.client.get(reverse('tag_explore', args=[self.tag.slug]))
+        Image.objects.filter(pk=response.context['images'][-1].pk).delete()
+        tag_index.invalidate()
+        data = self.client.get(response.context['images_next']).json()
+        self.assertIn(f'/image/{self.newest_first[24]}/', data['html'])
+
+
+class TopNPrefetchTest(MediaTestCase):
+    def setUp(self):
+        tag_index.invalidate()
+        self.user = User.objects.create_user(username='carder', password='testpass123')
+        self.tags = [Tag.objects.create(name=f'tag {i}') for i in range(6)]
+        self.characters = []
+        for i in range(3):
+            character = Character.objects.create(name=f'Card {i}')
+            character.tags.set(self.tags[:i * 3])
+            self.characters.append(character)
+        for i in range(5):
+            image = Image.objects.create(file=make_upload(size=(20, 20), color=(i, 0, 0)), uploader=self.user, is_approved=True)
+            image.characters.set(self.characters)
+
+    def test_prefetch_top_and_counts(self):
+        qs = annotate_counts(
+            Character.objects.order_by('name').prefetch_related(prefetch_top('tags', Tag.objects.order_by('name'), 4, 'card_tags')),
+            tag_count='tags', linked_images='images',
+        )
+        with CaptureQueriesContext(connection) as queries:
+            characters = list(qs)
+        self.assertEqual(len(queries), 2)
+        self.assertIn('ROW_NUMBER', queries[1]['sql'])
+        self.assertEqual([len(c.card_tags) for c in characters], [0, 3, 4])
+        self.assertEqual([t.name for t in characters[2].card_tags], ['tag 0', 'tag 1', 'tag 2', 'tag 3'])
+        self.assertEqual([c.tag_count for c in characters], [0, 3, 6])
+        self.assertEqual([c.linked_images for c in characters], [5, 5, 5])
+
+    def test_cards_use_bounded_prefetches(self):
+        response = self.client.get(reverse('character_list'))
+        self.assertContains(response, '+2')
+        self.assertEqual([c.tag_count for c in response.context['characters']], [0, 3, 6])
+        response = self.client.get(reverse('image_gallery'))
+        self.assertEqual({len(i.card_characters) for i in response.context['images']}, {2})
+        self.assertContains(response, '+1')
+        response = self.client.get(reverse('character_detail', args=[self.characters[0].slug]))
+        self.assertEqual(response.context['image_count'], 5)
+        self.assertContains(response, '?q=character:card-0')
+
+    @override_settings(CHARACTER_OTHER_GIRLS_LIMIT=1)
+    def test_other_girls_are_bounded(self):
+        group = Group.objects.create(name='Card Club')
+        group.characters.set(self.characters)
+        response = self.client.get(reverse('character_detail', args=[self.characters[0].slug]))
+        self.assertEqual([c.pk for c in response.context['other_girls']], [self.characters[1].pk])
+        self.assertTrue(response.context['more_other_girls'])
+        self.assertContains(response, 'View All Related Characters')
+
+
+class RelatedImagesTest(MediaTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='relater', password='testpass123')
+        self.rare, self.common = Character.objects.create(name='Rare'), Character.objects.create(name='Common')
+        self.tag = Tag.objects.create(name='shared')
+        self.images = [
+            Image.objects.create(file=make_upload(size=(20, 20), color=(i, 0, 0)), uploader=self.user, is_approved=i < 4)
+            for i in range(5)
+        ]
+        for image, characters in zip(self.images, [[self.rare], [self.rare], [self.common], [self.common], [self.rare]]):
+            image.characters.set(characters)
+        self.images[0].tags.add(self.tag)
+        self.images[2].tags.add(self.tag)
+
+    def test_neighbours_ranked_by_weighted_overlap(self):
+        first, second, third, fourth, pending = self.images
+        # A shared character outweighs a shared tag; pending and unrelated images never appear.
+        self.assertEqual(related_images(first), [second, third])
+        self.assertEqual(related_images(second), [first])
+        self.assertEqual(related_images(pending), [])
+        self.assertFalse(RelatedImage.objects.filter(related=pending).exists())
+
+    def test_refreshed_incrementally(self):
+        first, second, third, fourth, pending = self.images
+        fourth.characters.add(self.rare)
+        self.assertIn(fourth, related_images(first))
+        self.assertIn(first, related_images(fourth))
+        pending.is_approved = True
+        pending.save()
+        self.assertIn(pending, related_images(second))
+        second.characters.clear()
+        self.assertNotIn(second, related_images(first))
+        self.assertEqual(related_images(second), [])
+
+    def test_refresh_reads_only_the_newest_postings(self):
+        first, second, third, fourth, pending = self.images
+        keys = {('character', self.rare.pk), ('tag', self.tag.pk)}
+        postings, counts = related._newest(keys, 1)
+        self.assertEqual(postings, {('character', self.rare.pk): [second.pk], ('tag', self.tag.pk): [third.pk]})
+        self.assertEqual(counts, {('character', self.rare.pk): 2, ('tag', self.tag.pk): 2})
+        with self.settings(RELATED_MAX_POSTINGS=1):
+            # first is no longer among the newest images of its keys; the weights still count it.
+            self.assertEqual([row.related_id for row in related.refresh([fourth.pk])], [])
+            self.assertEqual([row.related_id for row in related.refresh([second.pk])], [])
+            stored = {row.related_id: row.score for row in related.refresh([first.pk])}
+        self.assertEqual(set(stored), {second.pk, third.pk})
+        self.assertAlmostEqual(stored[second.pk], 2.0 * math.log(5 / 2))
+
+    def test_rebuild_matches_incremental(self):
+        stored = sorted(RelatedImage.objects.values_list('image_id', 'related_id', 'rank'))
+        RelatedImage.objects.all().delete()
+        call_command('rebuild_related_images', stdout=io.StringIO())
+        stats.reconcile()
+        self.assertEqual(sorted(RelatedImage.objects.values_list('image_id', 'related_id', 'rank')), stored)
+
+    def test_detail_page_and_api(self):
+        first, second, third = self.images[:3]
+        response = self.client.get(reverse('image_detail', args=[first.pk]))
+        self.assertEqual(response.context['related_images'], [second, third])
+        response = self.client.get(reverse('image-related', args=[first.pk]))
+        self.assertEqual([item['id'] for item in response.json()], [second.pk, third.pk])
+
+
+class CountersTest(MediaTestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user(username='counted', password='testpass123')
+        self.other = User.objects.create_user(username='recounted', password='testpass123')
+        self.series = Series.objects.create(name='Counted Series')
+        self.group = Group.objects.create(name='Counted Group')
+        self.a = Character.objects.create(name='A', series=self.series)
+        self.a.groups.add(self.group)
+        self.b = Character.objects.create(name='B', series=self.series)
+        self.t1, self.t2 = Tag.objects.create(name='one'), Tag.objects.create(name='two')
+        self.shown = Image.objects.create(file=make_upload(size=(20, 20)), uploader=self.owner, is_approved=True)
+        self.shown.characters.set([self.a, self.b])
+        self.shown.tags.set([self.t1])
+        self.pending = Image.objects.create(file=make_upload(size=(20, 20), color=(1, 2, 3)), uploader=self.owner)
+        self.pending.characters.add(self.a)
+        self.pending.tags.add(self.t1, self.t2)
+
+    def counts(self, obj):
+        obj.refresh_from_db()
+        return obj.image_count, obj.pending_image_count
+
+    def assertConsistent(self):
+        for model in counters.COUNTED:
+            self.assertEqual(counters.drifted(model), [], model.__name__)
+
+    def test_counts(self):
+        self.assertEqual(self.counts(self.t1), (1, 1))
+        self.assertEqual(self.counts(self.t2), (0, 1))
+        self.assertEqual(self.counts(self.a), (1, 1))
+        self.assertEqual(self.counts(self.b), (1, 0))
+        # The approved image has two characters in the series but is counted once.
+        self.assertEqual(self.counts(self.series), (1, 1))
+        self.assertEqual(self.series.character_count, 2)
+        self.assertEqual(self.counts(self.group), (1, 1))
+        self.assertEqual(self.group.character_count, 1)
+        self.assertEqual(self.counts(self.owner.stats), (1, 1))
+        self.assertEqual(self.counts(self.other.stats), (0, 0))
+        self.assertConsistent()
+
+    def test_maintained_through_edits(self):
+        self.pending.is_approved = True
+        self.pending.save()
+        self.assertEqual(self.counts(self.t2), (1, 0))
+        self.assertEqual(self.counts(self.owner.stats), (2, 0))
+        self.assertConsistent()
+        self.shown.tags.remove(self.t2)
+        self.assertEqual(self.counts(self.t2), (1, 0))
+        self.t1.images.clear()
+        self.a.images.remove(self.shown)
+        self.assertConsistent()
+        self.b.series = None
+        self.b.save()
+        self.group.characters.add(self.b)
+        self.shown.characters.clear()
+        self.assertConsistent()
+        self.shown.uploader = self.other
+        self.shown.save()
+        self.assertEqual(self.counts(self.other.stats), (1, 0))
+        self.shown.delete()
+        self.a.delete()
+        self.assertConsistent()
+
+    def test_bulk_paths(self):
+        staff = User.objects.create_user(username='bulk', password='testpass123', is_staff=True)
+        self.client.login(username='bulk', password='testpass123')
+        self.client.post(reverse('admin_pending_uploads'), {'action': 'approve', 'image_ids': str(self.pending.pk)})
+        self.assertEqual(self.counts(self.t2), (1, 0))
+        self.assertConsistent()
+        # A resubmitted form finds nothing pending.
+        self.client.post(reverse('admin_pending_uploads'), {'action': 'approve', 'image_ids': str(self.pending.pk)})
+        self.assertEqual(self.counts(self.t2), (1, 0))
+        Image.create_uploads(
+            [Image(file=make_upload(f'bulk{i}.jpg', (20, 20), color=(i, 9, 9)), uploader=staff, is_approved=i == 0) for i in range(3)],
+            characters=[self.b], tags=[self.t2],
+        )
+        self.assertEqual(self.counts(self.b), (2, 2))
+        self.assertConsistent()
+        Image.objects.filter(uploader=staff, is_approved=False).delete()
+        self.assertEqual(self.counts(self.b), (2, 0))
+        self.owner.delete()
+        self.assertEqual(self.counts(self.b), (1, 0))
+        self.assertConsistent()
+
+    def test_reconcile(self):
+        Tag.objects.update(image_count=99)
+        UserStats.objects.filter(user=self.other).delete()
+        out = io.StringIO()
+        call_command('reconcile_counters', '--dry-run', stdout=out)
+        self.assertIn('tags: 2 drifted', out.getvalue())
+        self.assertEqual(self.counts(self.t1), (99, 1))
+        call_command('reconcile_counters', stdout=io.StringIO())
+        self.assertEqual(self.counts(self.t1), (1, 1))
+        self.assertTrue(UserStats.objects.filter(user=self.other).exists())
+        self.assertConsistent()
+
+    def test_sorted_and_shown(self):
+        data = self.client.get('/api/tags/?ordering=-image_count,name').json()['results']
+        self.assertEqual([(tag['name'], tag['image_count']) for tag in data], [('one', 1), ('two', 0)])
+        response = self.client.get(reverse('character_list'), {'sort': 'popular'})
+        self.assertEqual([c.name for c in response.context['characters']], ['A', 'B'])
+        self.assertContains(response, '1 image')
+        response = self.client.get(reverse('series_explore', args=[self.series.slug]))
+        self.assertContains(response, '2 characters · 1 images')
+
+
+class DashboardStatsTest(MediaTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='stats', password='testpass123')
+        Image.objects.create(file=make_upload(size=(20, 20)), uploader=self.user, is_approved=True)
+
+    def test_snapshot_follows_writes(self):
+        self.assertEqual(stats.snapshot()['images'], 1)
+        with self.assertNumQueries(1):
+            totals = stats.snapshot()
+        self.assertEqual((totals['users'], totals['pending_images']), (1, 0))
+        other = User.objects.create_user(username='stats2', password='testpass123')
+        tag = Tag.objects.create(name='counted')
+        pending = Image.objects.create(file=make_upload(size=(20, 20), color=(5, 5, 5)), uploader=other)
+        self.assertEqual(stats.snapshot()['pending_images'], 1)
+        pending.is_approved = True
+        pending.save()
+        tag.delete()
+        self.assertEqual(stats.reconcile(dry_run=True), {})
+        other.delete()
+        self.assertEqual(stats.reconcile(dry_run=True), {})
+        self.assertEqual(stats.snapshot()['images'], 1)
+
+    def test_stale_snapshot_is_reconciled_by_the_job_queue(self):
+        stats.snapshot()
+        Statistic.objects.filter(name='images').update(value=40, reconciled_at=timezone.now() - timedelta(days=1))
+        self.assertEqual(stats.snapshot()['images'], 40)
+        stats.snapshot()
+        self.assertEqual(Job.objects.filter(kind='stats.reconcile').count(), 1)
+        for job in jobs.claim('test', limit=5):
+            jobs.run(job)
+        self.assertEqual(stats.snapshot()['images'], 1)
+
+    def test_user_counts_in_one_query(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(stats.user_counts(self.user), {'approved_count': 1, 'pending_count': 0, 'total_uploads': 1})
+        UserStats.objects.all().delete()
+        with self.assertNumQueries(2):
+            self.assertEqual(stats.user_counts(self.user)['total_uploads'], 1)
+        self.client.login(username='stats', password='testpass123')
+        response = self.client.get(reverse('user_dashboard'))
+        self.assertEqual(response.context['approved_count'], 1)
+
+
+class SiteSettingsCacheTest(TestCase):
+    def setUp(self):
+        SiteSetting.get_solo()
+        site_settings.invalidate()
+        self.addCleanup(site_settings.invalidate)
+        self.staff = User.objects.create_user(username='settings', password='testpass123', is_staff=True)
+
+    def test_reads_are_free_once_loaded(self):
+        site_settings.get()
+        with self.assertNumQueries(0):
+            self.assertTrue(site_settings.get().allow_self_registration)
+        with self.assertNumQueries(0):
+            self.client.get(reverse('register'))
+
+    def test_saving_reaches_other_workers(self):
+        other_worker = SiteSettingsCache()
+        self.assertTrue(other_worker.get().allow_self_registration)
+        self.client.login(username='settings', password='testpass123')
+        self.client.post(reverse('admin_settings'), {})
+        self.assertFalse(other_worker.get().allow_self_registration)
+        self.client.logout()
+        response = self.client.get(reverse('register'))
+        self.assertRedirects(response, reverse('login'))
+
+    def test_stamps_live_in_the_shared_store(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location, ignore_errors=True)
+        backend = {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': location}
+        with self.settings(CACHES={**settings.CACHES, 'pages': backend}):
+            site_settings.get()
+            self.assertEqual(len(os.listdir(location)), 1)
+            tag_index.invalidate()
+            self.assertEqual(len(os.listdir(location)), 2)
+
+    def test_context_is_lazy(self):
+        from .context_processors import site_settings as processor
+        with self.assertNumQueries(0):
+            lazy = processor(None)['site_settings']
+        self.assertIsNone(site_settings.value)
+        self.assertTrue(lazy.allow_self_registration)
+        self.assertIsNotNone(site_settings.value)
+
+
+
+class PageCacheTest(MediaTestCase):
+    def setUp(self):
+        page_cache.pages().clear()
+        self.user = User.objects.create_user(username='cached', password='testpass123')
+        self.series = Series.objects.create(name='Cached Series')
+        self.tag = Tag.objects.create(name='cached-tag')
+        self.girl = Character.objects.create(name='Cached Girl', series=self.series)
+        self.other = Character.objects.create(name='Other Girl')
+        self.image = Image.objects.create(file=make_upload(size=(20, 20)), uploader=self.user, is_approved=True)
+        self.image.characters.add(self.girl)
+        self.pending = Image.objects.create(file=make_upload(size=(20, 20), color=(1, 2, 3)), uploader=self.user)
+
+    def assertCached(self, url, cached=True):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(queries) == 0, cached, f'{url} was {"not " if cached else ""}served from the cache')
+        return response
+
+    def test_anonymous_gets_are_served_from_the_cache(self):
+        url = reverse('character_detail', args=[self.girl.slug])
+        first = self.assertCached(url, cached=False)
+        self.assertEqual(self.assertCached(url).content, first.content)
+        self.assertCached(f'{url}?search=', cached=True)
+        self.client.login(username='cached', password='testpass123')
+        self.assertCached(url, cached=False)
+
+    def test_query_string_is_normalized(self):
+        factory = RequestFactory()
+        self.assertEqual(
+            page_cache.key(factory.get('/', {'type': '2d', 'search': '', 'sort': 'popular'})),
+            page_cache.key(factory.get('/?sort=popular&type=2d')),
+        )
+        self.assertNotEqual(page_cache.key(factory.get('/?type=2d')), page_cache.key(factory.get('/?type=3d')))
+
+    def test_writes_purge_exactly_the_dependent_pages(self):
+        image = reverse('image_detail', args=[self.image.pk])
+        girl = reverse('character_detail', args=[self.girl.slug])
+        other = reverse('character_detail', args=[self.other.slug])
+        series = reverse('series_explore', args=[self.series.slug])
+        tag = reverse('tag_explore', args=[self.tag.slug])
+        pages = [image, girl, other, series, tag, reverse('image_gallery'), reverse('character_list')]
+        for url in pages:
+            self.client.get(url)
+
+        self.image.tags.add(self.tag)
+        for url in (image, girl, series, tag, reverse('image_gallery')):
+            self.assertCached(url, cached=False)
+        self.assertCached(other)
+
+        self.tag.name = 'renamed'
+        self.tag.save()
+        self.assertIn('renamed', self.assertCached(image, cached=False).content.decode())
+        self.assertCached(girl)
+
+        self.client.force_login(User.objects.create_user(username='staff', password='x', is_staff=True))
+        self.client.post(reverse('admin_pending_uploads'), {'image_ids': str(self.pending.pk), 'action': 'approve'})
+        self.client.logout()
+        self.assertCached(reverse('image_gallery'), cached=False)
+        self.assertCached(other)
+
+        self.other.series = self.series
+        self.other.save()
+        self.assertCached(series, cached=False)
+        self.assertCached(reverse('character_list'), cached=False)
+
+        self.image.delete()
+        self.assertEqual(self.client.get(image).status_code, 404)
+        self.assertCached(girl, cached=False)
+
+    def test_site_settings_purge_every_page(self):
+        url = reverse('character_list')
+        self.client.get(url)
+        SiteSetting.objects.update_or_create(pk=1, defaults={'allow_self_registration': False})
+        self.assertNotIn(reverse('register'), self.assertCached(url, cached=False).content.decode())
+
+    def test_file_backend_is_shared(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location, ignore_errors=True)
+        backend = {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': location}
+        with self.settings(CACHES={**settings.CACHES, 'pages': backend}):
+            url = reverse('image_detail', args=[self.image.pk])
+            self.assertCached(url, cached=False)
+            self.assertTrue(os.listdir(location))
+            self.assertCached(url)
+            self.image.characters.add(self.other)
+            self.assertCached(url, cached=False)
+
+
+class CardFragmentsTest(MediaTestCase):
+    def setUp(self):
+        page_cache.pages().clear()
+        self.user = User.objects.create_user(username='carder', password='testpass123')
+        self.client.force_login(self.user)
+        self.tag = Tag.objects.create(name='card-tag')
+        self.girls = [Character.objects.create(name=f'Card Girl {i}') for i in range(3)]
+        self.images = [
+            Image.objects.create(file=make_upload(size=(20, 20), color=(i, 0, 0)), uploader=self.user, is_approved=True)
+            for i in range(3)
+        ]
+        for image, girl in zip(self.images, self.girls):
+            image.characters.add(girl)
+
+    def rendered(self, url, card):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return sum(1 for template in response.templates if template.name == card)
+
+    def test_cards_render_once(self):
+        gallery, characters = reverse('image_gallery'), reverse('character_list')
+        self.assertEqual(self.rendered(gallery, 'onnanoko/image_card.html'), 3)
+        self.assertEqual(self.rendered(gallery, 'onnanoko/image_card.html'), 0)
+        self.assertEqual(self.rendered(characters, 'onnanoko/character_card.html'), 3)
+        self.assertEqual(self.rendered(characters, 'onnanoko/character_card.html'), 0)
+        self.assertContains(self.client.get(gallery), 'Card Girl 1')
+
+    def test_changes_re_render_only_their_cards(self):
+        gallery, characters = reverse('image_gallery'), reverse('character_list')
+        self.rendered(gallery, 'onnanoko/image_card.html')
+        self.rendered(characters, 'onnanoko/character_card.html')
+
+        self.girls[0].name = 'Renamed Girl'
+        self.girls[0].save()
+        self.assertEqual(self.rendered(gallery, 'onnanoko/image_card.html'), 1)
+        self.assertContains(self.client.get(gallery), 'Renamed Girl')
+        self.assertEqual(self.rendered(characters, 'onnanoko/character_card.html'), 1)
+
+        self.girls[1].tags.add(self.tag)
+        self.assertEqual(self.rendered(characters, 'onnanoko/character_card.html'), 1)
+        self.tag.name = 'renamed-tag'
+        self.tag.save()
+        self.assertEqual(self.rendered(characters, 'onnanoko/character_card.html'), 1)
+        self.assertContains(self.client.get(characters), 'renamed-tag')
+
+        self.images[2].characters.add(self.girls[0])
+        self.assertEqual(self.rendered(gallery, 'onnanoko/image_card.html'), 1)
+        # The link also moved Card Girl 0's image_count, which is part of that card's key.
+        self.assertEqual(self.rendered(characters, 'onnanoko/character_card.html'), 1)
+
+        self.tag.delete()
+        self.assertEqual(self.rendered(characters, 'onnanoko/character_card.html'), 1)
+        self.assertNotContains(self.client.get(characters), 'renamed-tag')
+
+    def test_warm_fills_the_first_pages(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location, ignore_errors=True)
+        backend = {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': location}
+        with self.settings(CACHES={**settings.CACHES, 'pages': backend}):
+            call_command('warm_cards', pages=1, stdout=io.StringIO())
+            self.assertEqual(self.rendered(reverse('image_gallery'), 'onnanoko/image_card.html'), 0)
+            self.assertEqual(cards.warm(1, 2), 2)
+
+    def test_only_renames_touch_the_cards_showing_a_row(self):
+        key = cards.key(Image.objects.get(pk=self.images[0].pk))
+        self.girls[0].description = 'Not on any card'
+        self.girls[0].save()
+        self.assertEqual(cards.key(Image.objects.get(pk=self.images[0].pk)), key)
+        self.girls[0].name = 'Renamed Girl'
+        self.girls[0].save()
+        self.assertNotEqual(cards.key(Image.objects.get(pk=self.images[0].pk)), key)
+
+    def test_warm_refuses_a_per_process_cache(self):
+        with self.assertRaises(CommandError):
+            call_command('warm_cards', pages=1, stdout=io.StringIO())
+
+class ConditionalRequestsTest(MediaTestCase):
+    def setUp(self):
+        page_cache.pages().clear()
+        self.user = User.objects.create_user(username='revalidator', password='testpass123')
+        self.series = Series.objects.create(name='Conditional Series')
+        self.tag = Tag.objects.create(name='conditional-tag')
+        self.girl = Character.objects.create(name='Conditional Girl', series=self.series)
+        self.other = Character.objects.create(name='Bystander')
+        self.image = Image.objects.create(file=make_upload(size=(20, 20)), uploader=self.user, is_approved=True)
+        self.image.characters.add(self.girl)
+        stats.reconcile()
+
+    def revalidate(self, url, response, **headers):
+        return self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'], **headers)
+
+    def test_unchanged_pages_answer_304(self):
+        self.client.force_login(self.user)
+        url = reverse('character_detail', args=[self.girl.slug])
+        first = self.client.get(url)
+        self.assertEqual(first.status_code, 200)
+        self.assertTrue(first['ETag'].startswith('W/"'))
+        self.assertIn('private', first['Cache-Control'])
+        self.assertEqual(self.revalidate(url, first).status_code, 304)
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=first['Last-Modified']).status_code, 304)
+
+        changes = [
+            lambda: self.girl.save(),
+            lambda: self.girl.tags.add(self.tag),
+            lambda: self.image.tags.add(self.tag),
+            lambda: self.other.delete(),
+            lambda: Series.objects.create(name='Another Series'),
+        ]
+        response = first
+        for change in changes:
+            change()
+            fresh = self.revalidate(url, response)
+            self.assertEqual(fresh.status_code, 200)
+            self.assertNotEqual(fresh['ETag'], response['ETag'])
+            response = fresh
+
+    def test_validators_depend_on_the_user(self):
+        url = reverse('image_gallery')
+        anonymous = self.client.get(url)
+        self.client.force_login(self.user)
+        self.assertEqual(self.revalidate(url, anonymous).status_code, 200)
+
+    def test_api_answers_304_before_serializing(self):
+        url = f'/api/images/{self.image.pk}/'
+        first = self.client.get(url)
+        self.assertIn('public', first['Cache-Control'])
+        with self.assertNumQueries(1):
+            self.assertEqual(self.revalidate(url, first).status_code, 304)
+        listing = self.client.get('/api/characters/')
+        self.assertEqual(self.revalidate('/api/characters/', listing).status_code, 304)
+        self.assertEqual(self.revalidate('/api/characters/', listing, HTTP_ACCEPT='text/html').status_code, 200)
+        self.other.name = 'Renamed Bystander'
+        self.other.save()
+        self.assertEqual(self.revalidate('/api/characters/', listing).status_code, 200)
+
+    def test_cached_pages_revalidate_without_queries(self):
+        url = reverse('image_detail', args=[self.image.pk])
+        first = self.client.get(url)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.revalidate(url, first).status_code, 304)
+
+    def test_no_validators_without_totals(self):
+        Statistic.objects.all().delete()
+        response = self.client.get('/api/tags/')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('ETag'))
+
+class FieldSetTest(MediaTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='shaper', password='testpass123')
+        self.series = Series.objects.create(name='Shaped Series')
+        self.tag = Tag.objects.create(name='shaped-tag')
+        self.girl = Character.objects.create(name='Shaped Girl', series=self.series, description='Long story')
+        self.girl.tags.add(self.tag)
+        self.image = Image.objects.create(file=make_upload(size=(20, 20)), uploader=self.user, is_approved=True, description='Shaped')
+        self.image.characters.add(self.girl)
+        self.image.tags.add(self.tag)
+
+    def get(self, url, **params):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return response.json(), ' '.join(query['sql'] for query in queries)
+
+    def test_relations_are_keys_unless_expanded(self):
+        data, _ = self.get('/api/images/')
+        image = data['results'][0]
+        self.assertEqual((image['characters'], image['tags'], image['uploader']), ([self.girl.pk], [self.tag.pk], 'shaper'))
+
+        data, _ = self.get('/api/images/', expand='characters,tags')
+        image = data['results'][0]
+        self.assertEqual(image['tags'], [{'id': self.tag.pk, 'name': 'shaped-tag', 'slug': 'shaped-tag', 'image_count': 1}])
+        self.assertEqual(image['characters'][0]['name'], 'Shaped Girl')
+        self.assertEqual(image['characters'][0]['series'], self.series.pk)
+
+        data, _ = self.get(f'/api/images/{self.image.pk}/', expand='characters.series', omit='characters.description')
+        character = data['characters'][0]
+        self.assertEqual(character['series']['name'], 'Shaped Series')
+        self.assertNotIn('description', character)
+        self.assertEqual(character['tags'], [self.tag.pk])
+
+        data, _ = self.get('/api/characters/', expand='series')
+        self.assertEqual(data['results'][0]['series']['id'], self.series.pk)
+        self.assertEqual(self.client.get('/api/characters/').json()['results'][0]['series'], self.series.pk)
+
+    def test_fields_and_omit(self):
+        data, _ = self.get('/api/images/', fields='id,tags')
+        self.assertEqual(data['results'], [{'id': self.image.pk, 'tags': [self.tag.pk]}])
+        data, _ = self.get('/api/images/', fields='id,characters.name', expand='characters')
+        self.assertEqual(data['results'], [{'id': self.image.pk, 'characters': [{'name': 'Shaped Girl'}]}])
+        data, _ = self.get('/api/tags/', omit='slug,image_count')
+        self.assertEqual(data['results'], [{'id': self.tag.pk, 'name': 'shaped-tag'}])
+
+    def test_queryset_loads_only_what_is_shown(self):
+        _, sql = self.get('/api/images/', fields='id,description')
+        self.assertNotIn('onnanoko_image_characters', sql)
+        self.assertNotIn('onnanoko_image_tags', sql)
+        self.assertNotIn('auth_user', sql)
+        _, sql = self.get('/api/images/')
+        self.assertIn('onnanoko_image_characters', sql)
+        self.assertNotIn('onnanoko_character_tags', sql)
+        _, sql = self.get('/api/images/', expand='characters')
+        self.assertIn('onnanoko_character_tags', sql)
+
+    def test_writes_answer_in_the_default_shape(self):
+        self.client.force_login(self.user)
+        response = self.client.post('/api/images/?fields=id', {'file': make_upload('shape.jpg', size=(30, 30), color=(9, 9, 9)), 'tag_ids': [self.tag.pk]})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['tags'], [self.tag.pk])
+
+    def test_lists_are_paged_in_their_ordering(self):
+        for name in ('b-tag', 'a-tag', 'c-tag'):
+            Tag.objects.create(name=name)
+        names, url = [], '/api/tags/?ordering=name&page_size=2'
+        while url:
+            data = self.client.get(url).json()
+            names += [tag['name'] for tag in data['results']]
+            url = data['next']
+        self.assertEqual(names, ['a-tag', 'b-tag', 'c-tag', 'shaped-tag'])
+
+        for i in range(3):
+            Character.objects.create(name=f'Shaped Twin {i}', description='twin')
+        search.index('character', Character.objects.values_list('pk', flat=True))
+        data = self.client.get('/api/characters/', {'search': 'twin', 'page_size': 2}).json()
+        self.assertEqual(len(data['results']), 2)
+        rest = self.client.get(data['next']).json()
+        self.assertEqual(len(rest['results']), 1)
+        self.assertIsNone(rest['next'])
+        self.assertEqual(self.client.get(rest['previous']).json()['results'], data['results'])
+
+class FastReadTest(MediaTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='fast\u2028reader', password='testpass123')
+        self.series = Series.objects.create(name='Fast Series', description='Épisode « un »')
+        self.group = Group.objects.create(name='Fast Group')
+        self.tags = [Tag.objects.create(name=name) for name in ('fast-tag', 'schnell', 'はやい')]
+        self.girl = Character.objects.create(
+            name='Fast Girl', series=self.series, birth_date='2001-02-03', height_cm='158.50', weight_kg='45',
+            primary_image=make_upload('portrait.png', size=(30, 40), fmt='PNG', content_type='image/png'),
+        )
+        self.girl.groups.add(self.group)
+        self.girl.tags.add(*self.tags)
+        self.loner = Character.objects.create(name='Loner', age=17, is_2d=False, description='line\nbreak "quoted"')
+        for i in range(5):
+            image = Image.objects.create(file=make_upload(f'fast{i}.jpg', size=(20 + i, 20), color=(i, 9, 9)), uploader=self.user,
+                                         is_approved=i != 2, description=f'Fast image {i}')
+            image.characters.add(*([self.girl, self.loner] if i % 2 else [self.girl]))
+            image.tags.add(*self.tags[:i % 3 + 1])
+        # Bypasses save(), which would analyse the (missing) file; urljoin() rewrites this name.
+        Image.objects.bulk_create([Image(file='images/loose/../odd name.jpg', uploader=self.user, description='Hand-made row')])
+        search.index('character', Character.objects.values_list('pk', flat=True))
+
+    def assertSameBytes(self, url, **params):
+        with override_settings(API_FAST_READ=False):
+            expected = self.client.get(url, params)
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.plain_json, f'{url} {params} was not rendered by the read path')
+        self.assertEqual(response.content, expected.content)
+        return response
+
+    def test_lists_match_the_serializers(self):
+        for url in ('/api/images/', '/api/characters/', '/api/tags/', '/api/series/', '/api/groups/'):
+            self.assertSameBytes(url)
+        self.assertSameBytes('/api/images/', expand='characters,tags')
+        self.assertSameBytes('/api/images/', expand='characters.series,characters.groups,characters.tags', omit='characters.description')
+        self.assertSameBytes('/api/images/', fields='id,uploader,thumbnails,characters.name', expand='characters')
+        self.assertSameBytes('/api/characters/', expand='series,groups,tags')
+        self.assertSameBytes('/api/characters/', search='fast')
+        self.assertSameBytes('/api/images/', q='fast-tag -schnell', page_size=1)
+        self.assertSameBytes('/api/tags/', ordering='-image_count,name', page_size=2)
+        self.assertSameBytes('/api/images/', is_approved='true', page_size=2)
+        data = self.assertSameBytes('/api/images/', expand='characters').json()
+        self.assertEqual(data['results'][-1]['characters'][0]['primary_image_url'][:18], 'http://testserver/')
+        self.assertIn('\\u2028', self.assertSameBytes('/api/images/', fields='uploader').content.decode())
+
+    def test_cursor_pages_match(self):
+        url, params = '/api/images/', {'page_size': 2, 'expand': 'tags'}
+        while url:
+            response = self.assertSameBytes(url, **params)
+            url, params = response.json()['next'], {}
+
+    def test_unsupported_shapes_fall_back(self):
+        with self.assertRaises(fast_read.Unsupported):
+            fast_read.Plan(UploadSessionSerializer(), None)
+        response = self.client.get('/api/images/', HTTP_ACCEPT='application/json; indent=2')
+        self.assertIn(b'\n  ', response.content)
+
+    def test_benchmark_command(self):
+        out = io.StringIO()
+        call_command('benchmark_serializers', repeat=2, stdout=out)
+        self.assertIn('identical', out.getvalue())
+
+class QueryBudgetTest(QueryBudgetMixin, MediaTestCase):
+    """Every route runs a fixed number of queries, however much data there is.
+
+    The dataset is big enough that a per-row query on any list page would
+    blow its budget. New routes fail test_every_route_has_a_budget until
+    they are added to ROUTES.
+    """
+
+    # name -> (role, method, args, data, status, budget); args/data are callables of the test case.
+    # Deletes cascade through every owned row, so their budgets grow with the seeded data.
+    ROUTES = {
+        'character_list': ('anon', 'get', None, None, 200, 7),
+        'character_create': ('staff', 'get', None, None, 200, 8),
+        'character_edit': ('staff', 'get', lambda t: [t.character.slug], None, 200, 12),
+        # The other girls are cards: one bounded prefetch each for tags and groups.
+        'character_detail': ('anon', 'get', lambda t: [t.character.slug], None, 200, 10),
+        'image_gallery': ('anon', 'get', None, None, 200, 6),
+        'image_detail': ('anon', 'get', lambda t: [t.image.pk], None, 200, 8),
+        'image_edit': ('staff', 'get', lambda t: [t.image.pk], None, 200, 12),
+        'image_delete': ('staff', 'post', lambda t: [t.image.pk], None, 302, 40),
+        'image_upload': ('member', 'get', None, None, 200, 8),
+        'tag_explore': ('anon', 'get', lambda t: [t.tag.slug], None, 200, 5),
+        'group_explore': ('anon', 'get', lambda t: [t.group.slug], None, 200, 5),
+        'series_explore': ('anon', 'get', lambda t: [t.series.slug], None, 200, 5),
+        'tag_explore_fragment': ('anon', 'get', lambda t: [t.tag.slug, 'images'], None, 200, 3),
+        'group_explore_fragment': ('anon', 'get', lambda t: [t.group.slug, 'characters'], None, 200, 3),
+        'series_explore_fragment': ('anon', 'get', lambda t: [t.series.slug, 'characters'], None, 200, 3),
+        'login': ('anon', 'get', None, None, 200, 2),
+        'logout': ('member', 'post', None, None, 302, 4),
+        'register': ('anon', 'get', None, None, 200, 3),
+        'user_dashboard': ('member', 'get', None, None, 200, 12),
+        'user_profile': ('member', 'get', None, None, 200, 10),
+        'user_profile_update': ('member', 'post', None, lambda t: {'first_name': 'New', 'last_name': 'Name', 'email': 'member@example.com'}, 302, 8),
+        'user_password_change': ('member', 'get', None, None, 200, 6),
+        'user_account_delete': ('member', 'get', None, None, 200, 8),
+        'admin_panel': ('staff', 'get', None, None, 200, 13),
+        'admin_users': ('staff', 'get', None, None, 200, 6),
+        'admin_user_edit': ('staff', 'get', lambda t: [t.member.pk], None, 200, 6),
+        'admin_user_delete': ('staff', 'post', lambda t: [t.uploader.pk], None, 302, 100),
+        'admin_pending_uploads': ('staff', 'get', None, None, 200, 10),
+        # Approval refreshes the related images of the image and of its neighbours, and moves its counts,
+        # under a row lock (a savepoint here).
+        'admin_approve_image': ('staff', 'post', lambda t: [t.pending.pk], lambda t: {'action': 'approve'}, 302, 46),
+        'admin_settings': ('staff', 'get', None, None, 200, 5),
+        'admin_content_management': ('staff', 'get', None, None, 200, 10),
+        'admin_create_content': ('staff', 'post', None, lambda t: {'content_type': 'tag', 'name': 'brand new'}, 302, 8),
+        'api-root': ('anon', 'get', None, None, 200, 2),
+        'series-list': ('anon', 'get', None, None, 200, 3),
+        'series-detail': ('anon', 'get', lambda t: [t.series.pk], None, 200, 3),
+        'group-list': ('anon', 'get', None, None, 200, 3),
+        'group-detail': ('anon', 'get', lambda t: [t.group.pk], None, 200, 3),
+        'tag-list': ('anon', 'get', None, None, 200, 3),
+        'tag-detail': ('anon', 'get', lambda t: [t.tag.pk], None, 200, 3),
+        'character-list': ('anon', 'get', None, None, 200, 5),
+        'character-detail': ('anon', 'get', lambda t: [t.character.pk], None, 200, 5),
+        'image-list': ('anon', 'get', None, None, 200, 8),
+        'image-detail': ('anon', 'get', lambda t: [t.image.pk], None, 200, 8),
+        'image-related': ('anon', 'get', lambda t: [t.image.pk], None, 200, 11),
+        'image-near-duplicates': ('staff', 'get', lambda t: [t.image.pk], None, 200, 13),
+        'image-pending-near-duplicates': ('staff', 'get', None, None, 200, 12),
+        'upload-session-list': ('member', 'post', None, lambda t: {'filename': 'big.jpg', 'size': 1000, 'sha256': '0' * 64}, 201, 6),
+        'upload-session-detail': ('member', 'get', lambda t: [t.session.pk], None, 200, 4),
+        # Finalizing re-reads the session under a row lock.
+        'upload-session-finalize': ('member', 'post', lambda t: [t.session.pk], None, 409, 6),
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff = User.objects.create_user(username='staff', password='testpass123', is_staff=True)
+        cls.member = User.objects.create_user(username='member', password='testpass123')
+        cls.uploaders = [User.objects.create_user(username=f'uploader{i}', password='testpass123') for i in range(3)]
+        cls.uploader = cls.uploaders[0]
+        series = [Series.objects.create(name=f'Series {i}') for i in range(4)]
+        groups = [Group.objects.create(name=f'Group {i}') for i in range(5)]
+        tags = [Tag.objects.create(name=f'Tag {i}') for i in range(12)]
+        characters = Character.objects.bulk_create([
+            Character(name=f'Girl {i:02}', slug=f'girl-{i:02}', series=series[i % 4]) for i in range(40)
+        ])
+        Character.groups.through.objects.bulk_create([
+            Character.groups.through(character_id=c.pk, group_id=groups[(i + k) % 5].pk)
+            for i, c in enumerate(characters) for k in range(2)
+        ])
+        Character.tags.through.objects.bulk_create([
+            Character.tags.through(character_id=c.pk, tag_id=tags[(i + k) % 12].pk)
+            for i, c in enumerate(characters) for k in range(5)
+        ])
+
+        # One real upload; the other rows share its file and derivatives.
+        first = Image.objects.create(file=make_upload(size=(64, 48)), uploader=cls.uploader, is_approved=True)
+        shared = {f: getattr(first, f) for f in ('file', 'sha256', 'phash', 'width', 'height', 'format', 'derivatives', 'placeholder', 'dominant_color')}
+        images = Image.objects.bulk_create([
+            Image(uploader=cls.uploaders[i % 3], is_approved=i < 150, description=f'Picture {i}', **shared)
+            for i in range(180)
+        ]) + [first]
+        Image.characters.through.objects.bulk_create([
+            Image.characters.through(image_id=image.pk, character_id=characters[(i + k) % 40].pk)
+            for i, image in enumerate(images) for k in range(2)
+        ])
+        Image.tags.through.objects.bulk_create([
+            Image.tags.through(image_id=image.pk, tag_id=tags[(i + k) % 12].pk)
+            for i, image in enumerate(images) for k in range(4)
+        ])
+        search.index('character', [c.pk for c in characters])
+        search.index('image', [image.pk for image in images])
+        call_command('rebuild_related_images', stdout=io.StringIO())
+        stats.reconcile()
+        SiteSetting.get_solo()
+
+        cls.series, cls.group, cls.tag, cls.character = series[0], groups[0], tags[0], characters[0]
+        cls.image = first
+        cls.pending = Image.objects.filter(is_approved=False).first()
+        cls.session = UploadSession.objects.create(uploader=cls.member, filename='a.jpg', size=10, sha256='0' * 64)
+
+    def setUp(self):
+        tag_index.invalidate()
+        near_duplicate_index.index = None
+
+    def route_names(self):
+        from django.urls import get_resolver
+        names = set()
+        for urlconf in ('onnanoko.urls', 'onnanoko.api_urls'):
+            for pattern in get_resolver(urlconf).url_patterns:
+                if pattern.name:
+                    names.add(pattern.name)
+        return names
+
+    def test_every_route_has_a_budget(self):
+        self.assertEqual(self.route_names() - set(self.ROUTES), set())
+
+    def request(self, name):
+        role, method, args, data, status, budget = self.ROUTES[name]
+        client = Client()
+        if role != 'anon':
+            client.force_login(getattr(self, role))
+        url = reverse(name, args=args(self) if args else None)
+        payload = data(self) if data else None
+        if name.startswith('upload-session') and method == 'post':
+            return client, lambda: client.post(url, payload, content_type='application/json'), status, budget
+        return client, lambda: getattr(client, method)(url, payload), status, budget
+
+    def test_routes_stay_within_budget(self):
+        for name in sorted(self.ROUTES):
+            with self.subTest(route=name):
+                sid = transaction.savepoint()
+                try:
+                    client, send, status, budget = self.request(name)
+                    # Warm the process-local indexes once; they are not per-request work.
+                    tag_index.current()
+                    near_duplicate_index.refresh()
+                    with self.assertQueryBudget(budget, name) as recorder:
+                        response = send()
+                    self.assertEqual(response.status_code, status, name)
+                finally:
+                    transaction.savepoint_rollback(sid)
+                    tag_index.invalidate()
+
+    def test_middleware_reports_queries(self):
+        with self.settings(DEBUG=True):
+            response = self.client.get(reverse('image_gallery'))
+        self.assertGreater(int(response['X-Query-Count']), 0)
+        self.assertIn('X-Query-Time-Ms', response)
+        with self.assertLogs('onnanoko.queries', 'WARNING') as logs, self.settings(QUERY_COUNT_WARNING=0, PAGE_CACHE_TIMEOUT=0):
+            self.client.get(reverse('image_gallery'))
+        self.assertIn('GET /gallery/', logs.output[0])
+
+    def test_fingerprints_group_repeated_statements(self):
+        self.assertEqual(
+            fingerprint('SELECT * FROM t WHERE id IN (%s, %s) LIMIT 21'),
+            fingerprint('SELECT * FROM t WHERE id IN (%s) LIMIT 1'),
+        )
+        with QueryRecorder() as recorder:
+            for image in Image.objects.order_by('pk')[:3]:
+                image.uploader.username
+        self.assertEqual(list(recorder.duplicates().values()), [3])
@@ -0,0 +1,182 @@
+import base64
+import os
+from io import BytesIO
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image as PILImage
+from PIL import ImageOps
+
+# Longest edge in pixels of each derivative, largest first so every size can be
+# downscaled from the previous one instead of from the full-resolution source.
+THUMBNAIL_SIZES = (1024, 512, 256)
+DEFAULT_SIZE = 512
+
+# Longest edge of the inline placeholder; browsers upscale it into a blur.
+PLACEHOLDER_SIZE = 16
+
+# (file extension, Pillow format, save options)
+THUMBNAIL_FORMATS = (
+    ('webp', 'WEBP', {'quality': 80, 'method': 4}),
+    ('jpeg', 'JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+)
+
+
+def thumbnail_name(source_name, size, ext):
+    stem, _ = os.path.splitext(source_name)
+    return f'thumbs/{stem}_{size}.{ext}'
+
+
+def _flatten(img):
+    """Return an RGB copy of img with any transparency composited onto white."""
+    if img.mode == 'RGB':
+        return img
+    if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+        rgba = img.convert('RGBA')
+        background = PILImage.new('RGB', rgba.size, (255, 255, 255))
+        background.paste(rgba, mask=rgba.getchannel('A'))
+        return background
+    return img.convert('RGB')
+
+
+def render_thumbnails(img, source_name, storage=default_storage, fingerprint=None):
+    """Write every size/format derivative of an open PIL image to storage.
+
+    Returns the derivative map that is stored on the model:
+    ``{'source': <name>, 'fingerprint': <mtime-size>,
+    'sizes': {'256': {'width': 192, 'webp': <name>, 'jpeg': <name>}, ...}}``
+    """
+    img = ImageOps.exif_transpose(img)
+    if img.mode not in ('RGB', 'RGBA'):
+        img = img.convert('RGBA' if 'transparency' in img.info or img.mode in ('LA', 'PA') else 'RGB')
+
+    sizes = {}
+    current = img
+    for size in THUMBNAIL_SIZES:
+        current = current.copy()
+        current.thumbnail((size, size), PILImage.Resampling.LANCZOS)
+        entry = {'width': current.width}
+        for ext, fmt, options in THUMBNAIL_FORMATS:
+            out = current if fmt == 'WEBP' else _flatten(current)
+            buf = BytesIO()
+            out.save(buf, format=fmt, **options)
+            name = thumbnail_name(source_name, size, ext)
+            if storage.exists(name):
+                storage.delete(name)
+            entry[ext] = storage.save(name, ContentFile(buf.getvalue()))
+        sizes[str(size)] = entry
+    if fingerprint is None:
+        fingerprint = source_fingerprint(source_name, storage)
+    return {'source': source_name, 'fingerprint': fingerprint, 'sizes': sizes}
+
+
+def source_fingerprint(name, storage=default_storage):
+    """Cheap change detector for a stored source file: modification time plus size."""
+    try:
+        modified = storage.get_modified_time(name).timestamp()
+    except NotImplementedError:
+        modified = 0
+    return f'{modified:.0f}-{storage.size(name)}'
+
+
+def is_current(derivatives, name, fingerprint):
+    return (
+        bool(derivatives.get('sizes'))
+        and derivatives.get('source') == name
+        and derivatives.get('fingerprint') == fingerprint
+    )
+
+
+def open_source(fh):
+    """Decode a source image for thumbnailing and return (width, height, img).
+
+    The returned size is the real one; the decoded image may already be
+    downscaled by the JPEG decoder.
+    """
+    img = PILImage.open(fh)
+    width, height = img.size
+    # Let the JPEG decoder downscale by a power of two while decoding.
+    img.draft('RGB', (THUMBNAIL_SIZES[0], THUMBNAIL_SIZES[0]))
+    img.load()
+    return width, height, img
+
+
+def render_placeholder(img):
+    """Return (data URI of a tiny WebP, dominant colour as ``#rrggbb``) for an open PIL image.
+
+    Both are small enough to inline into a page so cards have something to
+    paint before any thumbnail request completes.
+    """
+    small = img.copy()
+    small.thumbnail((64, 64), PILImage.Resampling.BOX)
+    small = _flatten(ImageOps.exif_transpose(small))
+
+    quantized = small.quantize(colors=5)
+    _, index = max(quantized.getcolors())
+    red, green, blue = quantized.getpalette()[index * 3:index * 3 + 3]
+
+    small.thumbnail((PLACEHOLDER_SIZE, PLACEHOLDER_SIZE), PILImage.Resampling.LANCZOS)
+    buf = BytesIO()
+    small.save(buf, format='WEBP', quality=40)
+    data_uri = 'data:image/webp;base64,' + base64.b64encode(buf.getvalue()).decode('ascii')
+    return data_uri, f'#{red:02x}{green:02x}{blue:02x}'
+
+
+def delete_thumbnails(derivatives, storage=default_storage):
+    for entry in (derivatives or {}).get('sizes', {}).values():
+        for ext, _, _ in THUMBNAIL_FORMATS:
+            if entry.get(ext):
+                storage.delete(entry[ext])
+
+
+class ThumbnailSet:
+    """Template/serializer friendly view over a stored derivative map."""
+
+    def __init__(self, derivatives, source, storage=default_storage, placeholder='', color=''):
+        self.derivatives = derivatives or {}
+        self.source = source
+        self.storage = storage
+        self.placeholder = placeholder
+        self.color = color
+
+    def __bool__(self):
+        return bool(self.derivatives.get('sizes')) or bool(self.source)
+
+    def _sizes(self):
+        sizes = self.derivatives.get('sizes', {})
+        return sorted(((int(size), entry) for size, entry in sizes.items()), key=lambda item: item[0])
+
+    def get_url(self, size=DEFAULT_SIZE, ext='jpeg'):
+        entry = self.derivatives.get('sizes', {}).get(str(size))
+        if entry and entry.get(ext):
+            return self.storage.url(entry[ext])
+        return None
+
+    @property
+    def url(self):
+        url = self.get_url(DEFAULT_SIZE, 'jpeg')
+        if url:
+            return url
+        return self.source.url if self.source else ''
+
+    def _srcset(self, ext):
+        return ', '.join(
+            f"{self.storage.url(entry[ext])} {entry.get('width', size)}w"
+            for size, entry in self._sizes() if entry.get(ext)
+        )
+
+    @property
+    def srcset(self):
+        return self._srcset('jpeg')
+
+    @property
+    def webp_srcset(self):
+        return self._srcset('webp')
+
+    def urls(self, url=None):
+        """{size: {ext: url}}; ``url(name)`` builds each URL, ``self.storage.url`` by default."""
+        url = url or self.storage.url
+        return {
+            str(size): {ext: url(entry[ext]) for ext, _, _ in THUMBNAIL_FORMATS if entry.get(ext)}
+            for size, entry in self._sizes()
+        }
@@ -0,0 +1,36 @@
+import hashlib
+
+from django.core.files.uploadhandler import MemoryFileUploadHandler, TemporaryFileUploadHandler
+
+
+class HashingUploadMixin:
+    """Compute the SHA-256 of each uploaded file while its chunks stream in.
+
+    The digest is attached to the resulting UploadedFile as ``sha256`` so the
+    bytes never have to be read a second time to deduplicate them.
+    """
+
+    def new_file(self, *args, **kwargs):
+        # Set up first: the wrapped handlers may raise StopFutureHandlers.
+        self.hasher = hashlib.sha256()
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        remaining = super().receive_data_chunk(raw_data, start)
+        if remaining is None:
+            self.hasher.update(raw_data)
+        return remaining
+
+    def file_complete(self, file_size):
+        uploaded = super().file_complete(file_size)
+        if uploaded is not None:
+            uploaded.sha256 = self.hasher.hexdigest()
+        return uploaded
+
+
+class HashingMemoryFileUploadHandler(HashingUploadMixin, MemoryFileUploadHandler):
+    pass
+
+
+class HashingTemporaryFileUploadHandler(HashingUploadMixin, TemporaryFileUploadHandler):
+    pass
@@ -14,6 +14,9 @@ urlpatterns = [
     path('tag/<slug:slug>/', views.TagExploreView.as_view(), name='tag_explore'),
     path('group/<slug:slug>/', views.GroupExploreView.as_view(), name='group_explore'),
     path('series/<slug:slug>/', views.SeriesExploreView.as_view(), name='series_explore'),
+    path('tag/<slug:slug>/<str:section>/', views.TagExploreView.as_view(fragment=True), name='tag_explore_fragment'),
+    path('group/<slug:slug>/<str:section>/', views.GroupExploreView.as_view(fragment=True), name='group_explore_fragment'),
+    path('series/<slug:slug>/<str:section>/', views.SeriesExploreView.as_view(fragment=True), name='series_explore_fragment'),
     # Auth
     path('login/', views.LoginView.as_view(), name='login'),
     path('logout/', views.LogoutView.as_view(), name='logout'),
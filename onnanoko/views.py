@@ -1,13 +1,33 @@
 from django.shortcuts import render
-from rest_framework import viewsets, permissions, filters
+from rest_framework import viewsets, permissions, filters, status, mixins
+from rest_framework.decorators import action
+from rest_framework.response import Response
+from django.conf import settings
+from django.db import transaction
+from .near_duplicates import attach_near_duplicates
+from .imaging import InvalidImage, sha256_file, verify_image
+from concurrent.futures import ThreadPoolExecutor
 from rest_framework.parsers import MultiPartParser, FormParser
 from django_filters.rest_framework import DjangoFilterBackend
-from .models import Series, Group, Tag, Character, Image, SiteSetting
-from .serializers import SeriesSerializer, GroupSerializer, TagSerializer, CharacterSerializer, ImageSerializer
-from django.db.models import Prefetch, Q, Count
+from .models import Series, Group, Tag, Character, Image, RelatedImage, SiteSetting, UploadSession
+from .serializers import SeriesSerializer, GroupSerializer, TagSerializer, CharacterSerializer, ImageSerializer, UploadSessionSerializer
+from . import chunked_uploads
+from .search import FullTextSearchFilter, SearchResults, ranked, search_hits
+from . import cards, counters, related, stats
+from .related import related_images
+from .site_settings import site_settings
+from . import page_cache
+from .page_cache import CachedPageMixin
+from .conditional import ConditionalPageMixin, ConditionalViewSetMixin
+from .fast_read import FastListMixin
+from .fieldsets import FieldSetMixin
+from .pagination import IMAGE_ORDERING, CursorPaginationMixin, CursorPaginator, InvalidCursor
+from .tag_query import Query, QueryError, TagQueryFilter, filter_images, parse, tag_index
+from django.db.models import Q
 from django.views.generic import ListView, DetailView, TemplateView
 from django.contrib.auth.decorators import login_required
 import json
+from django.utils import timezone
 from django.utils.decorators import method_decorator
 from django import forms
 from django.contrib.auth import login, logout
@@ -16,14 +36,14 @@ from .forms import UserProfileForm, CustomPasswordChangeForm, AccountDeleteForm
 from django.contrib.auth.models import User
 from django.shortcuts import redirect
 from django.urls import reverse
-from PIL import Image as PILImage
 from django.contrib.auth.decorators import user_passes_test
 from django.contrib import messages
 from .models import Tag, Character, Series, Group, Image, SiteSetting
 from django.shortcuts import get_object_or_404
 from django.views import View
 from django.core.paginator import Paginator
-from django.http import JsonResponse
+from django.http import Http404, JsonResponse
+from django.template.loader import render_to_string
 from io import BytesIO
 from django.core.files.uploadedfile import InMemoryUploadedFile
 
@@ -38,98 +58,277 @@ class IsAdminOrReadOnly(permissions.BasePermission):
             return True
         return request.user and request.user.is_staff
 
-class SeriesViewSet(viewsets.ModelViewSet):
+class SeriesViewSet(ConditionalViewSetMixin, FieldSetMixin, FastListMixin, viewsets.ModelViewSet):
+    conditional_models = (Series,)
     queryset = Series.objects.all()
     serializer_class = SeriesSerializer
     permission_classes = [IsAuthenticatedOrReadOnly]
-    filter_backends = [filters.SearchFilter]
+    filter_backends = [filters.SearchFilter, filters.OrderingFilter]
     search_fields = ['name']
+    ordering_fields = ['name', 'character_count', 'image_count']
 
-class GroupViewSet(viewsets.ModelViewSet):
+class GroupViewSet(ConditionalViewSetMixin, FieldSetMixin, FastListMixin, viewsets.ModelViewSet):
+    conditional_models = (Group,)
     queryset = Group.objects.all()
     serializer_class = GroupSerializer
     permission_classes = [IsAuthenticatedOrReadOnly]
-    filter_backends = [filters.SearchFilter]
+    filter_backends = [filters.SearchFilter, filters.OrderingFilter]
     search_fields = ['name']
+    ordering_fields = ['name', 'character_count', 'image_count']
 
-class TagViewSet(viewsets.ModelViewSet):
+class TagViewSet(ConditionalViewSetMixin, FieldSetMixin, FastListMixin, viewsets.ModelViewSet):
+    conditional_models = (Tag,)
     queryset = Tag.objects.all()
     serializer_class = TagSerializer
     permission_classes = [IsAuthenticatedOrReadOnly]
-    filter_backends = [filters.SearchFilter]
+    filter_backends = [filters.SearchFilter, filters.OrderingFilter]
     search_fields = ['name']
+    ordering_fields = ['name', 'image_count']
 
-class CharacterViewSet(viewsets.ModelViewSet):
-    queryset = Character.objects.select_related('series').prefetch_related('groups', 'tags', 'images')
+class CharacterViewSet(ConditionalViewSetMixin, FieldSetMixin, FastListMixin, viewsets.ModelViewSet):
+    conditional_models = (Character, Series, Group, Tag)
+    # FieldSetMixin adds the relations a request shows.
+    queryset = Character.objects.all()
     serializer_class = CharacterSerializer
     permission_classes = [IsAdminOrReadOnly]
-    filter_backends = [DjangoFilterBackend, filters.SearchFilter]
+    # Ordering goes before the search filter: ranked search results keep their rank order.
+    filter_backends = [DjangoFilterBackend, filters.OrderingFilter, FullTextSearchFilter]
     filterset_fields = ['is_2d', 'series', 'groups', 'tags']
+    ordering_fields = ['name', 'image_count', 'created_at']
     search_fields = ['name', 'description']
+    search_document = 'character'
 
-class ImageViewSet(viewsets.ModelViewSet):
-    queryset = Image.objects.select_related('uploader').prefetch_related('characters', 'tags')
+class ImageViewSet(ConditionalViewSetMixin, FieldSetMixin, FastListMixin, viewsets.ModelViewSet):
+    conditional_models = (Image, Character, Series, Group, Tag)
+    queryset = Image.objects.all()
     serializer_class = ImageSerializer
     permission_classes = [IsAuthenticatedOrReadOnly]
     parser_classes = [MultiPartParser, FormParser]
-    filter_backends = [DjangoFilterBackend, filters.SearchFilter]
+    filter_backends = [DjangoFilterBackend, FullTextSearchFilter, TagQueryFilter]
+    cursor_ordering = IMAGE_ORDERING
     filterset_fields = ['is_approved', 'tags', 'characters']
     search_fields = ['description', 'uploader__username']
+    search_document = 'image'
+
+    def create(self, request, *args, **kwargs):
+        upload = request.FILES.get('file')
+        duplicate = Image.find_duplicate(upload) if upload else None
+        if duplicate:
+            # Same bytes already exist: hand back that image instead of storing a copy.
+            serializer = self.get_serializer(duplicate)
+            return Response(serializer.data, status=status.HTTP_200_OK)
+        return super().create(request, *args, **kwargs)
 
     def perform_create(self, serializer):
-        serializer.save(uploader=self.request.user)
+        serializer.save(uploader=self.request.user, status=Image.PROCESSING)
+
+    def _distance(self):
+        try:
+            distance = int(self.request.query_params.get('distance', settings.NEAR_DUPLICATE_DISTANCE))
+        except ValueError:
+            distance = settings.NEAR_DUPLICATE_DISTANCE
+        return max(0, min(distance, 32))
+
+    @action(detail=True, url_path='near-duplicates')
+    def near_duplicates(self, request, pk=None):
+        image = self.get_object()
+        attach_near_duplicates([image], self._distance(), limit=50, queryset=self.get_queryset())
+        return Response([
+            {'distance': distance, 'image': self.get_serializer(other).data}
+            for distance, other in image.near_duplicates
+        ])
+
+    @action(detail=True)
+    def related(self, request, pk=None):
+        image = self.get_object()
+        ids = list(RelatedImage.objects.filter(image=image, related__is_approved=True).order_by('rank').values_list('related_id', flat=True))
+        found = self.get_queryset().in_bulk(ids)
+        return Response(self.get_serializer([found[other] for other in ids if other in found], many=True).data)
+
+    @action(detail=False, url_path='pending/near-duplicates')
+    def pending_near_duplicates(self, request):
+        pending = Image.objects.filter(is_approved=False).order_by('-uploaded_at')[:100]
+        images = attach_near_duplicates(pending, self._distance())
+        return Response([
+            {
+                'id': image.pk,
+                'candidates': [{'id': other.pk, 'distance': distance} for distance, other in image.near_duplicates],
+            }
+            for image in images
+        ])
+
+class UploadSessionViewSet(mixins.CreateModelMixin, mixins.RetrieveModelMixin, mixins.DestroyModelMixin, viewsets.GenericViewSet):
+    """Resumable chunked uploads.
+
+    POST a session with the file's name, size and SHA-256, PUT byte ranges to it
+    in any order (``Content-Range: bytes <start>-<end>/<size>``, optionally with
+    an ``X-Chunk-SHA256`` digest of the body), GET it to see which ranges have
+    arrived, then POST ``finalize/`` with the usual image fields.
+    """
+    serializer_class = UploadSessionSerializer
+    permission_classes = [permissions.IsAuthenticated]
 
-class CharacterListView(ListView):
+    def get_queryset(self):
+        return UploadSession.objects.filter(uploader=self.request.user)
+
+    def perform_create(self, serializer):
+        session = serializer.save(uploader=self.request.user)
+        chunked_uploads.allocate(session)
+
+    def perform_destroy(self, instance):
+        chunked_uploads.discard(instance)
+        instance.delete()
+
+    def update(self, request, pk=None):
+        session = self.get_object()
+        if session.image_id:
+            return Response({'detail': 'Upload already finalized.'}, status=status.HTTP_409_CONFLICT)
+        try:
+            start, end = chunked_uploads.parse_content_range(request.headers.get('Content-Range'), session.size)
+        except chunked_uploads.RangeError as e:
+            return Response({'detail': str(e)}, status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+        if end - start > settings.CHUNKED_UPLOAD_MAX_CHUNK:
+            return Response({'detail': f'Chunks may be at most {settings.CHUNKED_UPLOAD_MAX_CHUNK} bytes.'},
+                            status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        if int(request.headers.get('Content-Length') or 0) != end - start:
+            return Response({'detail': 'Content-Length does not match Content-Range.'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            digest = chunked_uploads.write_range(session, start, end, request.stream)
+        except chunked_uploads.RangeError as e:
+            return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        expected = request.headers.get('X-Chunk-SHA256')
+        if expected and expected.lower() != digest:
+            return Response({'detail': 'Chunk checksum mismatch.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Parallel chunks land in disjoint parts of the file; only the range
+        # bookkeeping needs the row lock.
+        with transaction.atomic():
+            session = UploadSession.objects.select_for_update().get(pk=session.pk)
+            session.received = chunked_uploads.merge_range(session.received, start, end)
+            session.save(update_fields=['received', 'updated_at'])
+        return Response(self.get_serializer(session).data)
+
+    @action(detail=True, methods=['post'])
+    def finalize(self, request, pk=None):
+        session = self.get_object()
+        # Locked until the image is saved: a concurrent finalize waits, then
+        # returns that image instead of creating a second one from the part file.
+        with transaction.atomic():
+            session = UploadSession.objects.select_for_update().get(pk=session.pk)
+            if session.image_id:
+                return Response(ImageSerializer(session.image, context=self.get_serializer_context()).data)
+            if not chunked_uploads.is_complete(session.received, session.size):
+                data = self.get_serializer(session).data
+                data['detail'] = 'Upload is incomplete.'
+                return Response(data, status=status.HTTP_409_CONFLICT)
+            digest = chunked_uploads.sha256_part(session)
+            if digest != session.sha256:
+                session.received = []
+                session.save(update_fields=['received', 'updated_at'])
+                return Response({'detail': 'Checksum mismatch; upload the file again.'}, status=status.HTTP_400_BAD_REQUEST)
+
+            with open(chunked_uploads.part_path(session), 'rb') as fh:
+                upload = chunked_uploads.AssembledUpload(fh, name=session.filename, content_type=session.content_type, size=session.size)
+                upload.sha256 = digest
+                try:
+                    verify_image(upload, settings.IMAGE_MAX_PIXELS)
+                except InvalidImage as e:
+                    return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+                image = Image.find_duplicate(upload)
+                code = status.HTTP_200_OK
+                if image is None:
+                    data = request.data.copy()
+                    data['file'] = upload
+                    serializer = ImageSerializer(data=data, context=self.get_serializer_context())
+                    serializer.is_valid(raise_exception=True)
+                    image = serializer.save(uploader=request.user, status=Image.PROCESSING)
+                    code = status.HTTP_201_CREATED
+            session.image = image
+            session.save(update_fields=['image', 'updated_at'])
+        chunked_uploads.discard(session)
+        return Response(ImageSerializer(image, context=self.get_serializer_context()).data, status=code)
+
+class CharacterListView(CachedPageMixin, ConditionalPageMixin, ListView):
+    conditional_models = (Character, Series, Group, Tag)
     model = Character
     template_name = 'onnanoko/character_list.html'
     context_object_name = 'characters'
     paginate_by = 20
 
     def get_queryset(self):
-        qs = Character.objects.select_related('series').prefetch_related('groups', 'tags', 'images').all()
+        qs = cards.character_cards()
         search = self.request.GET.get('search')
         type_filter = self.request.GET.get('type')
+        if self.request.GET.get('sort') == 'popular':
+            qs = qs.order_by('-image_count', 'name', 'id')
 
-        if search:
-            qs = qs.filter(
-                Q(name__icontains=search)
-                | Q(description__icontains=search)
-                | Q(tags__name__icontains=search)
-                | Q(series__name__icontains=search)
-                | Q(groups__name__icontains=search)
-            )
         if type_filter == '2d':
             qs = qs.filter(is_2d=True)
         elif type_filter == '3d':
             qs = qs.filter(is_2d=False)
         # If type_filter is 'all' or empty, show all types
-        
-        return qs.distinct()
+
+        if search:
+            qs = ranked(qs, 'character', search)
+        return qs
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['selected'] = {
             'search': self.request.GET.get('search', ''),
             'type': self.request.GET.get('type', 'all'),
+            'sort': self.request.GET.get('sort', ''),
         }
+        context['characters'] = cards.attach(context['characters'])
         return context
 
-class CharacterDetailView(DetailView):
+    def page_dependencies(self, context):
+        names = {'characters'}
+        if self.request.GET.get('sort') == 'popular':
+            names.add('images')
+        for character in context.get('characters', ()):
+            names.add(page_cache.name('character', character.pk))
+            if character.series_id:
+                names.add(page_cache.name('series', character.series_id))
+            names.update(page_cache.name('tag', tag.pk) for tag in character.card_tags)
+            names.update(page_cache.name('group', group.pk) for group in character.card_groups)
+        return names
+
+class CharacterDetailView(CachedPageMixin, ConditionalPageMixin, DetailView):
+    conditional_models = (Character, Series, Group, Tag, Image)
     model = Character
     template_name = 'onnanoko/character_detail.html'
     context_object_name = 'character'
     slug_field = 'slug'
     slug_url_kwarg = 'slug'
 
+    gallery_size = 20
+
     def get_queryset(self):
-        return Character.objects.select_related('series').prefetch_related('groups', 'tags', 'images')
+        return Character.objects.select_related('series').prefetch_related('groups', 'tags')
+
+    def page_dependencies(self, context):
+        # Its images name it, and the other girls share one of its groups.
+        character = self.object
+        names = {page_cache.name('character', character.pk)}
+        if character.series_id:
+            names.add(page_cache.name('series', character.series_id))
+        names.update(page_cache.name('group', group.pk) for group in character.groups.all())
+        names.update(page_cache.name('tag', tag.pk) for tag in character.tags.all())
+        return names
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         character = self.object
-        other_girls = Character.objects.filter(groups__in=character.groups.all()).exclude(id=character.id).distinct()
-        context['other_girls'] = other_girls
-        
+        images = filter_images(Image.objects.all(), Query([('character', character.slug)]))
+        context['images'] = images[:self.gallery_size]
+        context['image_count'] = character.image_count
+        # One row past the limit tells whether to link to the full list.
+        limit = settings.CHARACTER_OTHER_GIRLS_LIMIT
+        other_girls = list(cards.character_cards().filter(groups__in=character.groups.all()).exclude(id=character.id).distinct().order_by('name')[:limit + 1])
+        context['other_girls'] = other_girls[:limit]
+        context['more_other_girls'] = len(other_girls) > limit
+
         # Breadcrumbs
         context['breadcrumbs'] = [
             {
@@ -150,35 +349,53 @@ class CharacterDetailView(DetailView):
         
         return context
 
-class ImageGalleryView(ListView):
+class ImageGalleryView(CachedPageMixin, ConditionalPageMixin, CursorPaginationMixin, ListView):
+    conditional_models = (Image, Character)
     model = Image
     template_name = 'onnanoko/image_gallery.html'
     context_object_name = 'images'
     paginate_by = 24
 
     def get_queryset(self):
-        qs = Image.objects.select_related('uploader').prefetch_related('characters', 'tags').filter(is_approved=True)
+        qs = cards.image_cards()
         search = self.request.GET.get('search')
-        
+        self.query_error = None
+        try:
+            query = parse(self.request.GET.get('q'))
+        except QueryError as e:
+            self.query_error = str(e)
+            return Image.objects.none()
+
+        if query:
+            # The tag index only holds approved images, so qs needs no filter here.
+            if search:
+                match = tag_index.match(query)
+                ids, truncated = search_hits('image', search)
+                return SearchResults(qs, [pk for pk in ids if pk in match], truncated)
+            return filter_images(qs, query)
+        qs = qs.filter(is_approved=True)
         if search:
-            qs = qs.filter(
-                Q(description__icontains=search)
-                | Q(illustrator__icontains=search)
-                | Q(uploader__username__icontains=search)
-                | Q(characters__name__icontains=search)
-                | Q(tags__name__icontains=search)
-            ).distinct()
-        
-        return qs.order_by('-uploaded_at')
+            return ranked(qs, 'image', search)
+        return qs.order_by('-uploaded_at', '-id')
     
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['selected'] = {
             'search': self.request.GET.get('search', ''),
+            'q': self.request.GET.get('q', ''),
         }
+        context['query_error'] = self.query_error
+        context['images'] = cards.attach(context['images'])
         return context
 
-class ImageDetailView(DetailView):
+    def page_dependencies(self, context):
+        names = {'images'}
+        for image in context.get('images', ()):
+            names.update(page_cache.name('character', character.pk) for character in image.card_characters)
+        return names
+
+class ImageDetailView(CachedPageMixin, ConditionalPageMixin, DetailView):
+    conditional_models = (Image, Character, Tag)
     model = Image
     template_name = 'onnanoko/image_detail.html'
     context_object_name = 'image'
@@ -189,12 +406,19 @@ class ImageDetailView(DetailView):
             qs = qs.filter(is_approved=True)
         return qs
 
+    def page_dependencies(self, context):
+        image = self.object
+        names = {page_cache.name('image', image.pk), page_cache.name('user', image.uploader_id), 'related'}
+        names.update(page_cache.name('character', character.pk) for character in image.characters.all())
+        names.update(page_cache.name('tag', tag.pk) for tag in image.tags.all())
+        names.update(page_cache.name('image', other.pk) for other in context.get('related_images', ()))
+        return names
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         img = self.object
-        # Related images that share any character, excluding current
-        related = Image.objects.filter(characters__in=img.characters.all()).exclude(id=img.id).filter(is_approved=True).distinct()[:12]
-        context['related_images'] = related
+        # Precomputed neighbours by shared characters and tags (see related.py)
+        context['related_images'] = related_images(img)
         context['can_delete'] = self.request.user.is_authenticated and (self.request.user.is_staff or self.request.user == img.uploader)
         context['can_edit'] = self.request.user.is_authenticated and (self.request.user.is_staff or self.request.user == img.uploader)
         
@@ -228,77 +452,125 @@ class ImageDeleteView(View):
         messages.success(request, 'Image deleted.')
         return redirect('image_gallery')
 
-class TagExploreView(TemplateView):
-    template_name = 'onnanoko/explore.html'
-
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
-        tag_slug = kwargs.get('slug')
-        tag = Tag.objects.get(slug=tag_slug)
-        characters = (Character.objects.select_related('series')
-                      .prefetch_related('groups', 'tags', 'images')
-                      .filter(tags=tag).distinct())
-        images = (Image.objects.select_related('uploader')
-                  .prefetch_related('characters', 'tags')
-                  .filter(tags=tag, is_approved=True)
-                  .order_by('-uploaded_at'))
-        context.update({
-            'mode': 'tag',
-            'tag': tag,
-            'title': f'Tag: {tag.name}',
-            'characters': characters,
-            'images': images,
-        })
-        return context
+class ExploreView(CachedPageMixin, ConditionalPageMixin, TemplateView):
+    """Characters and approved images for one tag, group or series, a page of each at a time.
 
-class GroupExploreView(TemplateView):
+    The page shows the first page of both sections; ``<slug>/characters/``
+    and ``<slug>/images/`` return the following ones as JSON fragments
+    (``{"html": ..., "next": url}``) for infinite scroll.
+    """
     template_name = 'onnanoko/explore.html'
+    model = None
+    mode = None
+    character_filter = None
+    fragment = False
+    conditional_models = (Image, Character, Series, Group, Tag)
+    characters_per_page = 12
+    images_per_page = 24
+    sections = {
+        'characters': 'onnanoko/explore_characters.html',
+        'images': 'onnanoko/explore_images.html',
+    }
 
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
-        group_slug = kwargs.get('slug')
-        group = Group.objects.get(slug=group_slug)
-        characters = (Character.objects.select_related('series')
-                      .prefetch_related('groups', 'tags', 'images')
-                      .filter(groups=group).distinct())
-        images = (Image.objects.select_related('uploader')
-                  .prefetch_related('characters', 'tags')
-                  .filter(characters__groups=group, is_approved=True)
-                  .distinct()
-                  .order_by('-uploaded_at'))
-        context.update({
-            'mode': 'group',
-            'group': group,
-            'title': f'Group: {group.name}',
-            'characters': characters,
-            'images': images,
-        })
-        return context
-
-class SeriesExploreView(TemplateView):
-    template_name = 'onnanoko/explore.html'
+    def get(self, request, *args, **kwargs):
+        self.object = get_object_or_404(self.model, slug=kwargs['slug'])
+        self.pages = {}
+        if self.fragment:
+            return self.render_fragment(kwargs.get('section'))
+        return super().get(request, *args, **kwargs)
+
+    def get_characters(self):
+        # Cards show the portrait, name and series; nothing else is prefetched.
+        return Character.objects.select_related('series').filter(**{self.character_filter: self.object})
+
+    def get_images(self):
+        images = Image.objects.only('id', 'file', 'derivatives', 'placeholder', 'dominant_color')
+        return filter_images(images, Query([(self.mode, self.object.slug)]))
+
+    def get_page(self, section, cursor):
+        try:
+            if section == 'characters':
+                page = CursorPaginator(self.get_characters(), self.characters_per_page, ordering=('name', 'id')).page(cursor)
+            else:
+                page = self.get_images().cursor_page(cursor, self.images_per_page)
+        except InvalidCursor:
+            raise Http404('Invalid cursor.')
+        self.pages[section] = page
+        return page
+
+    def page_dependencies(self, context):
+        # Images are purged through their tags, characters, series and groups.
+        names = {page_cache.name(self.mode, self.object.pk)}
+        for character in self.pages.get('characters', ()):
+            names.add(page_cache.name('character', character.pk))
+            if character.series_id:
+                names.add(page_cache.name('series', character.series_id))
+        return names
+
+    def next_url(self, section, page):
+        if not page.has_next():
+            return None
+        url = reverse(f'{self.mode}_explore_fragment', args=[self.object.slug, section])
+        return f'{url}?cursor={page.next_cursor}'
+
+    def render_fragment(self, section):
+        if section not in self.sections:
+            raise Http404('No such section.')
+        page = self.get_page(section, self.request.GET.get('cursor'))
+        html = render_to_string(self.sections[section], {section: page}, request=self.request)
+        return JsonResponse({'html': html, 'next': self.next_url(section, page)})
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        series_slug = kwargs.get('slug')
-        series = Series.objects.get(slug=series_slug)
-        characters = (Character.objects.select_related('series')
-                      .prefetch_related('groups', 'tags', 'images')
-                      .filter(series=series).distinct())
-        images = (Image.objects.select_related('uploader')
-                  .prefetch_related('characters', 'tags')
-                  .filter(characters__series=series, is_approved=True)
-                  .distinct()
-                  .order_by('-uploaded_at'))
+        characters = self.get_page('characters', None)
+        images = self.get_page('images', None)
         context.update({
-            'mode': 'series',
-            'series': series,
-            'title': f'Series: {series.name}',
+            'mode': self.mode,
+            'object': self.object,
+            self.mode: self.object,
+            'title': f'{self.mode.title()}: {self.object.name}',
             'characters': characters,
+            'characters_next': self.next_url('characters', characters),
             'images': images,
+            'images_next': self.next_url('images', images),
         })
         return context
 
+class TagExploreView(ExploreView):
+    model = Tag
+    mode = 'tag'
+    character_filter = 'tags'
+
+class GroupExploreView(ExploreView):
+    model = Group
+    mode = 'group'
+    character_filter = 'groups'
+
+class SeriesExploreView(ExploreView):
+    model = Series
+    mode = 'series'
+    character_filter = 'series'
+
+_upload_validation_pool = None
+
+def upload_validation_pool():
+    global _upload_validation_pool
+    if _upload_validation_pool is None:
+        _upload_validation_pool = ThreadPoolExecutor(max_workers=settings.UPLOAD_VALIDATION_WORKERS, thread_name_prefix='upload-validation')
+    return _upload_validation_pool
+
+def validate_upload(f):
+    """Return (sha256, error) for one file of a multi-file upload."""
+    if f.content_type not in ['image/jpeg', 'image/png', 'image/webp']:
+        return None, 'Only JPEG, PNG, and WEBP images are allowed.'
+    if f.size > 5 * 1024 * 1024:
+        return None, 'Each file must be under 5MB.'
+    try:
+        verify_image(f, settings.IMAGE_MAX_PIXELS)
+    except InvalidImage as e:
+        return None, str(e)
+    return sha256_file(f), None
+
 class ImageUploadForm(forms.Form):
     characters = forms.ModelMultipleChoiceField(queryset=Character.objects.all(), required=False, widget=forms.SelectMultiple)
     tags = forms.ModelMultipleChoiceField(queryset=Tag.objects.all(), required=False, widget=forms.SelectMultiple)
@@ -352,39 +624,36 @@ class ImageUploadView(TemplateView):
     def post(self, request, *args, **kwargs):
         form = ImageUploadForm(request.POST)
         errors = []
+        duplicates = []
         if form.is_valid():
             files = request.FILES.getlist('files')
-            characters = form.cleaned_data['characters']
-            tags = form.cleaned_data['tags']
-            description = form.cleaned_data['description']
-            illustrator = form.cleaned_data['illustrator']
-            for f in files:
-                if f.content_type not in ['image/jpeg', 'image/png', 'image/webp']:
-                    errors.append(f'{f.name}: Only JPEG, PNG, and WEBP images are allowed.')
-                    continue
-                if f.size > 5 * 1024 * 1024:
-                    errors.append(f'{f.name}: Each file must be under 5MB.')
-                    continue
-                try:
-                    img = PILImage.open(f)
-                    img.verify()
-                except Exception:
-                    errors.append(f'{f.name}: Invalid image file.')
-                    continue
-                image = Image.objects.create(
-                    file=f,
-                    uploader=request.user,
-                    description=description,
-                    illustrator=illustrator,
-                    is_approved=request.user.is_staff,
-                )
-                image.characters.set(characters)
-                image.tags.set(tags)
-                image.save()
+            # Pillow and hashlib release the GIL, so a batch is checked in parallel.
+            results = list(upload_validation_pool().map(validate_upload, files))
+            existing = {}
+            for image in Image.objects.filter(sha256__in=[digest for digest, _ in results if digest]).order_by('-pk'):
+                existing[image.sha256] = image
+            images = []
+            seen = set()
+            for f, (digest, error) in zip(files, results):
+                if error:
+                    errors.append(f'{f.name}: {error}')
+                elif digest in existing:
+                    duplicates.append(existing[digest])
+                elif digest not in seen:
+                    seen.add(digest)
+                    images.append(Image(
+                        file=f,
+                        uploader=request.user,
+                        description=form.cleaned_data['description'],
+                        illustrator=form.cleaned_data['illustrator'],
+                        is_approved=request.user.is_staff,
+                        status=Image.PROCESSING,
+                    ))
+            Image.create_uploads(images, form.cleaned_data['characters'], form.cleaned_data['tags'])
             if not errors:
-                return self.render_to_response({'form': ImageUploadForm(), 'success': True, 'auto_approved': request.user.is_staff})
+                return self.render_to_response({'form': ImageUploadForm(), 'success': True, 'auto_approved': request.user.is_staff, 'duplicates': duplicates})
             else:
-                return self.render_to_response({'form': form, 'errors': errors})
+                return self.render_to_response({'form': form, 'errors': errors, 'duplicates': duplicates})
         return self.render_to_response({'form': form})
 
 @method_decorator(user_passes_test(lambda u: u.is_staff), name='dispatch')
@@ -431,7 +700,7 @@ class RegisterView(TemplateView):
     template_name = 'auth/register.html'
 
     def dispatch(self, request, *args, **kwargs):
-        if not SiteSetting.get_solo().allow_self_registration:
+        if not site_settings.get().allow_self_registration:
             return redirect('login')
         if request.user.is_authenticated:
             return redirect('user_dashboard')
@@ -453,16 +722,11 @@ class UserDashboardView(TemplateView):
     template_name = 'auth/dashboard.html'
 
     def get(self, request, *args, **kwargs):
-        user_images = Image.objects.filter(uploader=request.user)
-        uploads = user_images.order_by('-uploaded_at')[:24]
-        approved_count = user_images.filter(is_approved=True).count()
-        pending_count = user_images.filter(is_approved=False).count()
-        
+        uploads = Image.objects.filter(uploader=request.user).order_by('-uploaded_at')[:24]
         return self.render_to_response({
             'user': request.user, 
             'uploads': uploads,
-            'approved_count': approved_count,
-            'pending_count': pending_count,
+            **stats.user_counts(request.user),
         })
 
 @method_decorator(login_required, name='dispatch')
@@ -474,13 +738,7 @@ class UserProfileView(TemplateView):
         context['profile_form'] = UserProfileForm(instance=self.request.user)
 
         
-        # Calculate user stats
-        user_images = Image.objects.filter(uploader=self.request.user)
-        context['user_stats'] = {
-            'total_uploads': user_images.count(),
-            'approved_count': user_images.filter(is_approved=True).count(),
-            'pending_count': user_images.filter(is_approved=False).count(),
-        }
+        context['user_stats'] = stats.user_counts(self.request.user)
         
         # Breadcrumbs
         context['breadcrumbs'] = [
@@ -566,13 +824,7 @@ class UserAccountDeleteView(TemplateView):
         context = super().get_context_data(**kwargs)
         context['form'] = AccountDeleteForm(user=self.request.user)
         
-        # Calculate user stats
-        user_images = Image.objects.filter(uploader=self.request.user)
-        context['user_stats'] = {
-            'total_uploads': user_images.count(),
-            'approved_count': user_images.filter(is_approved=True).count(),
-            'pending_count': user_images.filter(is_approved=False).count(),
-        }
+        context['user_stats'] = stats.user_counts(self.request.user)
         
         # Breadcrumbs
         context['breadcrumbs'] = [
@@ -717,27 +969,28 @@ class AdminPanelView(TemplateView):
         context = super().get_context_data(**kwargs)
         
         # Dashboard stats
+        totals = stats.snapshot()
         context['stats'] = {
-            'total_users': User.objects.count(),
-            'total_characters': Character.objects.count(),
-            'total_images': Image.objects.count(),
-            'pending_images': Image.objects.filter(is_approved=False).count(),
+            'total_users': totals['users'],
+            'total_characters': totals['characters'],
+            'total_images': totals['images'] + totals['pending_images'],
+            'pending_images': totals['pending_images'],
             'recent_uploads': Image.objects.order_by('-uploaded_at')[:5],
         }
         
         return context
 
 @method_decorator(user_passes_test(lambda u: u.is_staff), name='dispatch')
-class AdminUsersView(ListView):
+class AdminUsersView(CursorPaginationMixin, ListView):
     model = User
     template_name = 'admin/users.html'
     context_object_name = 'users'
     paginate_by = 20
+    cursor_ordering = ('-date_joined', '-id')
+    approximate_count = False
 
     def get_queryset(self):
-        qs = User.objects.annotate(
-            upload_count=Count('uploaded_images')
-        ).order_by('-date_joined')
+        qs = User.objects.select_related('stats').order_by('-date_joined', '-id')
         
         search = self.request.GET.get('search')
         if search:
@@ -778,14 +1031,19 @@ class AdminUserEditView(TemplateView):
         return self.render_to_response(context)
 
 @method_decorator(user_passes_test(lambda u: u.is_staff), name='dispatch')
-class AdminPendingUploadsView(ListView):
+class AdminPendingUploadsView(CursorPaginationMixin, ListView):
     model = Image
     template_name = 'admin/pending_uploads.html'
     context_object_name = 'images'
     paginate_by = 24
 
     def get_queryset(self):
-        return Image.objects.filter(is_approved=False).select_related('uploader').prefetch_related('characters', 'tags').order_by('-uploaded_at')
+        return Image.objects.filter(is_approved=False).select_related('uploader').prefetch_related('characters', 'tags').order_by('-uploaded_at', '-id')
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['images'] = attach_near_duplicates(context['images'])
+        return context
 
     def post(self, request, *args, **kwargs):
         form = BulkApprovalForm(request.POST)
@@ -794,15 +1052,22 @@ class AdminPendingUploadsView(ListView):
             image_ids = form.cleaned_data['image_ids'].split(',')
             image_ids = [int(id) for id in image_ids if id.isdigit()]
             
-            images = Image.objects.filter(id__in=image_ids, is_approved=False)
-            
-            if action == 'approve':
-                images.update(is_approved=True)
-                messages.success(request, f'Approved {images.count()} images.')
-            elif action == 'reject':
-                count = images.count()
-                images.delete()
-                messages.success(request, f'Deleted {count} images.')
+            # Locked until the counters have moved: a double or concurrent
+            # submit waits, then finds the images no longer pending.
+            with transaction.atomic():
+                pending = list(Image.objects.select_for_update().filter(id__in=image_ids, is_approved=False).values_list('pk', flat=True))
+                images = Image.objects.filter(pk__in=pending)
+
+                if action == 'approve':
+                    images.update(is_approved=True, updated_at=timezone.now())
+                    tag_index.changed(pending)
+                    related.changed(pending)
+                    counters.approved(pending)
+                    page_cache.changed(Image, pending)
+                    messages.success(request, f'Approved {len(pending)} images.')
+                elif action == 'reject':
+                    images.delete()
+                    messages.success(request, f'Deleted {len(pending)} images.')
         
         return redirect('admin_pending_uploads')
 
@@ -837,11 +1102,12 @@ class AdminContentManagementView(TemplateView):
         context = super().get_context_data(**kwargs)
         
         # Get counts and recent items
+        totals = stats.snapshot()
         context['content_stats'] = {
-            'series_count': Series.objects.count(),
-            'groups_count': Group.objects.count(),
-            'tags_count': Tag.objects.count(),
-            'characters_count': Character.objects.count(),
+            'series_count': totals['series'],
+            'groups_count': totals['groups'],
+            'tags_count': totals['tags'],
+            'characters_count': totals['characters'],
             'recent_series': Series.objects.order_by('name')[:5],
             'recent_groups': Group.objects.order_by('name')[:5],
             'recent_tags': Tag.objects.order_by('name')[:5],
@@ -852,16 +1118,19 @@ class AdminContentManagementView(TemplateView):
 @method_decorator(user_passes_test(lambda u: u.is_staff), name='dispatch')
 class AdminApproveImageView(View):
     def post(self, request, pk):
-        image = get_object_or_404(Image, pk=pk)
         action = request.POST.get('action')
-        
-        if action == 'approve':
-            image.is_approved = True
-            image.save()
-            messages.success(request, 'Image approved.')
-        elif action == 'reject':
-            image.delete()
-            messages.success(request, 'Image deleted.')
+
+        # The row lock makes a concurrent submit wait for this one, so the
+        # counted state save() reads (signals.remember_counted_state) is current.
+        with transaction.atomic():
+            image = get_object_or_404(Image.objects.select_for_update(), pk=pk)
+            if action == 'approve':
+                image.is_approved = True
+                image.save()
+                messages.success(request, 'Image approved.')
+            elif action == 'reject':
+                image.delete()
+                messages.success(request, 'Image deleted.')
         
         # Return to pending uploads or the specific image
         next_url = request.POST.get('next', 'admin_pending_uploads')